@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Pascal Winter
+www.winter-aas.com
+
+Benchmark suite of the ESG, run from the repository root:
+
+    python -m benchmarks                                  # default grid, bench_results.json
+    python -m benchmarks --sims 1000 5000 --years 10 65 --stocks 3 10 --stages Simulation Export_CSV
+    python -m benchmarks --output new.json --compare old.json   # time ratios new / old
+
+Each case of the grid (simulations * years * stocks * rates) runs in a fresh process
+"""
+
+import pandas as pd
+import argparse
+import itertools
+import json
+import multiprocessing
+import os
+import platform
+import subprocess
+import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from benchmarks import bench_esg
+
+
+
+
+l_case_keys = ['NumSim', 'NumYears', 'NumStocks', 'NumRates']
+
+
+def get_meta():
+    '''
+    Run information: commit, versions, machine
+    '''
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output = True, text = True,
+                                cwd = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))).stdout.strip()
+    except OSError:
+        commit = None
+    return {'Commit': commit or None, 'Date': datetime.datetime.now().isoformat(timespec = 'seconds'),
+            'Python': platform.python_version(), 'Numpy': np.__version__, 'Pandas': pd.__version__,
+            'Platform': platform.platform(), 'CPU': os.cpu_count()}
+
+
+def run_grid(l_Case, l_stages = None, i_block_size = 250, i_num_workers = 1, i_repeat = 1):
+    '''
+    Benchmark of the cases, each one in a fresh process (spawned: memory of the case only)
+    Returns the list of results by case and stage (best time and highest peak over the repeats)
+    '''
+    l_Result = []
+    mp_context = multiprocessing.get_context('spawn')
+    for d_Case in l_Case:
+        l_Run = []
+        for _ in range(i_repeat):
+            with ProcessPoolExecutor(1, mp_context = mp_context) as executor:
+                l_Run += executor.submit(bench_esg.run_case, d_Case, l_stages, i_block_size,
+                                         i_num_workers).result()
+        dF_Run = pd.DataFrame(l_Run)
+        d_agg = {'Time': 'min', 'PeakRSS': 'max'}
+        if 'Bytes' in dF_Run:
+            d_agg['Bytes'] = 'max'
+        dF_Run = dF_Run.groupby(l_case_keys + ['Stage'], sort = False).agg(d_agg).reset_index()
+        l_Result += [{key: (None if pd.isna(val) else val.item() if hasattr(val, 'item') else val)
+                      for key, val in d_Row.items()} for d_Row in dF_Run.to_dict('records')]
+        print(dF_Run.to_string(index = False))
+    return l_Result
+
+
+def compare_results(l_Result, l_Base):
+    '''
+    Time and peak memory ratios (new / base) by case and stage
+    '''
+    dF_New = pd.DataFrame(l_Result).set_index(l_case_keys + ['Stage'])
+    dF_Base = pd.DataFrame(l_Base).set_index(l_case_keys + ['Stage'])
+    dF_Comp = dF_New[['Time', 'PeakRSS']].join(dF_Base[['Time', 'PeakRSS']], rsuffix = '_Base', how = 'inner')
+    dF_Comp['TimeRatio'] = dF_Comp['Time'] / dF_Comp['Time_Base']
+    dF_Comp['RSSRatio'] = dF_Comp['PeakRSS'] / dF_Comp['PeakRSS_Base']
+    return dF_Comp
+
+
+def main():
+    parser = argparse.ArgumentParser(prog = 'python -m benchmarks', description = __doc__,
+                                     formatter_class = argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--sims', type = int, nargs = '+', default = [1000, 5000], help = 'simulations')
+    parser.add_argument('--years', type = int, nargs = '+', default = [10, 65], help = 'projection years')
+    parser.add_argument('--stocks', type = int, nargs = '+', default = [3], help = 'number of stocks')
+    parser.add_argument('--rates', type = int, nargs = '+', default = [1], help = 'number of short rates')
+    parser.add_argument('--stages', nargs = '+', default = None, choices = bench_esg.l_all_stages,
+                        help = 'stages measured (default: all)')
+    parser.add_argument('--block-size', type = int, default = 250, help = 'simulations per block')
+    parser.add_argument('--workers', type = int, default = 1, help = 'processes of the simulation stage')
+    parser.add_argument('--repeat', type = int, default = 1, help = 'runs per case (best time kept)')
+    parser.add_argument('--output', default = 'bench_results.json', help = 'JSON file of the results')
+    parser.add_argument('--compare', default = None, help = 'JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    l_Case = [dict(zip(l_case_keys, t_case))
+              for t_case in itertools.product(args.sims, args.years, args.stocks, args.rates)]
+    l_Result = run_grid(l_Case, args.stages, args.block_size, args.workers, args.repeat)
+    d_Out = {'Meta': dict(get_meta(), BlockSize = args.block_size, Workers = args.workers,
+                          Repeat = args.repeat), 'Results': l_Result}
+    with open(args.output, 'w') as f:
+        json.dump(d_Out, f, indent = 1)
+    print('Results written to ' + args.output)
+    if args.compare is not None:
+        with open(args.compare) as f:
+            d_Base = json.load(f)
+        print('Compared with ' + args.compare + ' (commit ' + str(d_Base['Meta'].get('Commit')) + ')')
+        print(compare_results(l_Result, d_Base['Results']).to_string())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Pascal Winter
+www.winter-aas.com
+
+Benchmark of the ESG stages on synthetic parameters (no workbook read, files written
+in a temporary directory): wall time and peak resident memory by stage
+
+    d_Case = {'NumSim': 1000, 'NumYears': 10, 'NumStocks': 3, 'NumRates': 1}
+    l_Result = run_case(d_Case)
+"""
+
+import pandas as pd
+import numpy as np
+import os
+import gc
+import time
+import tempfile
+from functools import partial
+
+import libpw.esglib as esglib
+import libpw.gmdblib as gmdblib
+from libpw.esgengine import ESGenerator
+
+
+# Stages in calculation order (exports before the corresponding loads)
+l_all_stages = ['Setup', 'Random', 'StockPaths', 'RatePaths', 'Simulation',
+                'Export_DB', 'Export_CSV', 'Export_XLSX', 'Export_NPY',
+                'Load_DB', 'Load_CSV', 'Load_XLSX', 'Load_NPY',
+                'Stats', 'StatsOnline', 'NetOfDiv', 'NetOfDiv_NumPy']
+l_quantile = [0.005, 0.01, 0.05, 0.1, 0.25, 0.50, 0.75, 0.9, 0.95, 0.99, 0.995]
+
+
+
+
+#%%#############################################################################
+########################## 0. SYNTHETIC PARAMETERS #############################
+################################################################################
+
+
+def make_parameters(i_num_stocks = 3, i_num_rates = 1, i_num_years = 65, seed_val = 0):
+    '''
+    Random parameter tables in the layout of esglib.load_parameters
+    ----------
+    i_num_stocks, i_num_rates : number of stocks and of short rates
+    i_num_years : projection years (the yield curve goes beyond)
+    Returns a dict 'Stock_Param', 'Int_Param', 'Yield_Curve', 'Correlation' (positive definite)
+    '''
+    rng = np.random.default_rng(seed_val)
+    dF_StockParam = pd.DataFrame({'Return': rng.uniform(0.02, 0.08, i_num_stocks),
+                                  'Dividend': rng.uniform(0, 0.02, i_num_stocks),
+                                  'Volatility': rng.uniform(0.05, 0.25, i_num_stocks)},
+                                 index = pd.Index(['Stock_' + str(i) for i in range(i_num_stocks)],
+                                                  name = 'StockName'))
+    # CIR parameters within the Feller condition (2 a b > sigma^2)
+    dF_IntParam = pd.DataFrame({'Int_a': rng.uniform(0.1, 0.3, i_num_rates),
+                                'Int_b': rng.uniform(0.02, 0.05, i_num_rates),
+                                'Int_sigma': rng.uniform(0.01, 0.04, i_num_rates),
+                                'Int_r0': rng.uniform(0.005, 0.03, i_num_rates)},
+                               index = pd.Index(['Rate_' + str(i) for i in range(i_num_rates)], name = 'IntName'))
+    nA_Year = np.concatenate([[0, 1 / 12, 0.25, 0.5], np.arange(1, max(80, i_num_years + 5) + 1)])
+    dF_YieldCurve = pd.DataFrame({'Spot': 0.03 - 0.025 * np.exp(-nA_Year / 10)},
+                                 index = pd.Index(nA_Year, name = 'Year'))
+    # Correlation from random factors
+    i_num_assets = i_num_stocks + i_num_rates
+    nA_temp = rng.normal(size = (i_num_assets, max(1, i_num_assets // 2)))
+    nA_temp = nA_temp @ nA_temp.T + np.diag(rng.uniform(0.5, 1.5, i_num_assets))
+    nA_Std = np.sqrt(np.diag(nA_temp))
+    dF_Correlation = pd.DataFrame(nA_temp / nA_Std[:, None] / nA_Std[None, :])
+    return {'Stock_Param': dF_StockParam, 'Int_Param': dF_IntParam,
+            'Yield_Curve': dF_YieldCurve, 'Correlation': dF_Correlation}
+
+
+def make_gmdb_parameters(i_num_years = 65):
+    '''
+    Fees by policy year and dividend bands in the layout of gmdblib.load_gmdb_parameters
+    '''
+    dF_PolParamY = pd.DataFrame({'Year': np.arange(i_num_years + 1), 'DMPFee': 0.015})
+    dF_Dividend = pd.DataFrame({'NAVmin': [0, 8, 10, 12, 15], 'DivRate': [0, 0.005, 0.01, 0.02, 0.03]})
+    return dF_PolParamY, dF_Dividend
+
+
+
+
+#%%#############################################################################
+############################## 1. MEASURES #####################################
+################################################################################
+
+
+def _get_size(l_path):
+    # Size in bytes of files / directories
+    i_size = 0
+    for path in l_path:
+        if os.path.isdir(path):
+            i_size += sum(os.path.getsize(os.path.join(root, name))
+                          for root, _, l_files in os.walk(path) for name in l_files)
+        else:
+            i_size += os.path.getsize(path)
+    return i_size
+
+
+def _time_stage(l_Result, d_Case, stage, func, *args):
+    # Wall time and peak memory of func(*args) added to l_Result, returns the result of func
+    # (a 'Time' in a returned dict replaces the wall time: stages timed inside a loop)
+    gc.collect()
+    esglib.reset_peak_rss()
+    d_time = time.perf_counter()
+    result = func(*args)
+    d_time = time.perf_counter() - d_time
+    if isinstance(result, dict) and 'Time' in result:
+        d_time = result.pop('Time')
+    d_Row = dict(d_Case, Stage = stage, Time = d_time, PeakRSS = esglib.get_peak_rss())
+    if isinstance(result, dict) and 'Path' in result:
+        d_Row['Bytes'] = _get_size(result['Path'])
+    l_Result.append(d_Row)
+    return result
+
+
+
+
+#%%#############################################################################
+############################### 2. STAGES ######################################
+################################################################################
+
+
+def _bench_random(d_Model, l_blocks):
+    # Correlated normals of all the blocks
+    for i_start, i_end in l_blocks:
+        l_rng = esglib.get_sim_rngs(d_Model['Seed'], i_start, i_end, d_Model['RngType'])
+        shape = (i_end - i_start, d_Model['NumTime'], d_Model['Factor'].shape[0])
+        esglib.generate_correlated_normals(l_rng, d_Model['Factor'], i_end - i_start, d_Model['NumTime'],
+                                           d_Model['Dtype'], esglib.get_buffer('Rand', shape, d_Model['Dtype']),
+                                           esglib.get_buffer('Multvar', shape, d_Model['Dtype']))
+
+
+def _bench_paths(d_Model, l_blocks, key):
+    # Stock or rate paths of all the blocks (the random numbers are not timed)
+    d_time = 0
+    n_stocks = len(d_Model['Vol'])
+    for i_start, i_end in l_blocks:
+        l_rng = esglib.get_sim_rngs(d_Model['Seed'], i_start, i_end, d_Model['RngType'])
+        nA_Multvar = esglib.generate_correlated_normals(l_rng, d_Model['Factor'], i_end - i_start,
+                                                        d_Model['NumTime'], d_Model['Dtype'])
+        d_start = time.perf_counter()
+        if key == 'StockPaths':
+            esglib.simulate_stock_block(nA_Multvar[:, :, :n_stocks], d_Model['Drift'], d_Model['Vol'],
+                                        d_Model['DeltaT'], d_Model['StepOut'])
+        else:
+            esglib.simulate_rate_block(nA_Multvar[:, :, n_stocks:], d_Model['Rate'], d_Model['DeltaT'],
+                                       d_Model['StepOut'])
+        d_time += time.perf_counter() - d_start
+    return {'Time': d_time}
+
+
+def _export_db(esg, d_Scen, path_temp):
+    l_path = []
+    for key, col_res in [('StockRet', 'Return'), ('Rate', 'Value')]:
+        spath = os.path.join(path_temp, key + '_db.csv')
+        for i_start, i_end in esg.l_blocks:
+            esglib.export_block_db(d_Scen[key][i_start:i_end], i_start, list(d_Scen['Year'][key]),
+                                   d_Scen['Asset'][key], spath, i_start == 0, col_res)
+        l_path.append(spath)
+    return {'Path': l_path}
+
+
+def _export_csv(d_Scen, path_temp):
+    d_Path = {}
+    for key in ['StockRet', 'Rate']:
+        for i, asset in enumerate(d_Scen['Asset'][key]):
+            d_Path[asset] = os.path.join(path_temp, asset + '_results.csv')
+            esglib.export_matrix_csv(d_Scen[key][:, :, i].T, d_Path[asset])
+    return {'Path': list(d_Path.values()), 'Files': d_Path}
+
+
+def _export_xlsx(d_Scen, path_temp):
+    l_path = []
+    for key in ['StockRet', 'Rate']:
+        spath = os.path.join(path_temp, key + '_results.xlsx')
+        esglib.export_matrix_xlsx(d_Scen[key].transpose(2, 1, 0), d_Scen['Asset'][key], spath)
+        l_path.append(spath)
+    return {'Path': l_path}
+
+
+def _export_npy(d_Scen, path_temp):
+    spath_store = os.path.join(path_temp, 'store')
+    l_keys = ['StockRet', 'StockVal', 'Rate']
+    d_Store = esglib.create_store(spath_store, {key: {'Year': d_Scen['Year'][key], 'Asset': d_Scen['Asset'][key]}
+                                                for key in l_keys}, {}, len(d_Scen['Simulation']))
+    for key in l_keys:
+        d_Store[key][:] = d_Scen[key]
+    esglib.close_store(spath_store, d_Store)
+    return {'Path': [spath_store]}
+
+
+def _bench_stats(d_Scen):
+    # Statistics of scripts/esg_results.py
+    d_Scen['Val'] = esglib.calculate_prices(d_Scen['Ret'])
+    esglib.describe_scenarios(d_Scen, 'Ret', 'Return', l_quantile, False, 12)
+    esglib.describe_scenarios(d_Scen, 'Ret', 'Return', l_quantile, True, 12)
+    esglib.describe_scenarios(d_Scen, 'Val', 'Price', l_quantile, True)
+
+
+def _bench_stats_online(esg, d_Scen):
+    # Statistics of esg_main.py (online_stats) collected block by block
+    l_year = esg.l_step_year
+    t_range_ret = esglib.get_sketch_range(esglib.aggregate_drift(esg.d_Model['Drift'],
+                                                                 len(esg.d_Model['Drift']) // len(l_year)),
+                                          esg.d_Model['Vol'], 1 / 12)
+    d_AccRet = esglib.create_accumulator(len(l_year), len(esg.l_stocks),
+                                         esglib.get_sketch_edges(*t_range_ret, 4000), 'Return')
+    d_AccVal = esglib.create_accumulator(len(l_year), len(esg.l_stocks),
+                                         esglib.get_sketch_edges(*esglib.d_sketch_range['Price'], 4000), 'Price')
+    for i_start, i_end in esg.l_blocks:
+        esglib.update_accumulator(d_AccRet, d_Scen['StockRet'][i_start:i_end])
+        esglib.update_accumulator(d_AccVal, d_Scen['StockVal'][i_start:i_end, 1:])
+    esglib.describe_accumulator(d_AccRet, esg.l_stocks, l_year, 'Return', l_quantile, False, 12)
+    esglib.describe_accumulator(d_AccRet, esg.l_stocks, l_year, 'Return', l_quantile, True, 12)
+    esglib.describe_accumulator(d_AccVal, esg.l_stocks, l_year, 'Price', l_quantile, True)
+
+
+def _bench_netofdiv(d_Scen, dF_PolParamY, dF_Dividend, b_jit):
+    # Monthly returns of each stock (Time * Simulation)
+    for i in range(d_Scen['StockRet'].shape[2]):
+        gmdblib.calc_ret_netofdiv(d_Scen['StockRet'][:, :, i].T, dF_PolParamY, dF_Dividend, 10, b_jit)
+
+
+def run_case(d_Case, l_stages = None, i_block_size = 250, i_num_workers = 1):
+    '''
+    Time the stages on one case of the grid
+    ----------
+    d_Case : dict 'NumSim', 'NumYears', 'NumStocks', 'NumRates'
+    l_stages : stages measured among l_all_stages (None: all), the stages needed by
+               a selected one are calculated but not reported
+    i_block_size, i_num_workers : blocks and processes of the simulation
+    Returns a list of dict by stage: the case, 'Stage', 'Time' (seconds), 'PeakRSS' (bytes,
+    peak of the stage on Linux, of the process so far otherwise), 'Bytes' (exports)
+    '''
+    l_stages = l_all_stages if l_stages is None else l_stages
+    l_Result = []
+    d_Param = make_parameters(d_Case['NumStocks'], d_Case['NumRates'], d_Case['NumYears'])
+    dF_PolParamY, dF_Dividend = make_gmdb_parameters(d_Case['NumYears'])
+    def stage(name, func, *args):
+        # Measured if selected, calculated anyway
+        return _time_stage(l_Result if name in l_stages else [], d_Case, name, func, *args)
+
+    esg = stage('Setup', partial(ESGenerator, i_num_sim = d_Case['NumSim'], i_num_steps = d_Case['NumYears'],
+                                 i_block_size = i_block_size, i_num_workers = i_num_workers,
+                                 rate_model = 'CIR' if d_Case['NumRates'] > 0 else None), d_Param)
+    if 'Random' in l_stages:
+        stage('Random', _bench_random, esg.d_Model, esg.l_blocks)
+    for key in ['StockPaths', 'RatePaths']:
+        if key in l_stages:
+            stage(key, _bench_paths, esg.d_Model, esg.l_blocks, key)
+    if not any(name in l_stages for name in l_all_stages[l_all_stages.index('Simulation'):]):
+        return l_Result
+    d_Scen = stage('Simulation', esg.run)
+    with tempfile.TemporaryDirectory() as path_temp:
+        for input_type, func, args in [('DB', _export_db, (esg, d_Scen, path_temp)),
+                                       ('CSV', _export_csv, (d_Scen, path_temp)),
+                                       ('XLSX', _export_xlsx, (d_Scen, path_temp)),
+                                       ('NPY', _export_npy, (d_Scen, path_temp))]:
+            if 'Export_' + input_type not in l_stages and 'Load_' + input_type not in l_stages:
+                continue
+            d_Export = stage('Export_' + input_type, func, *args)
+            if 'Load_' + input_type in l_stages:
+                path = {'DB': d_Export['Path'][0], 'CSV': d_Export.get('Files'),
+                        'XLSX': d_Export['Path'][0], 'NPY': d_Export['Path'][0]}[input_type]
+                if input_type == 'CSV':
+                    path = {asset: path[asset] for asset in esg.l_stocks}
+                stage('Load_' + input_type, esglib.load_scenarios, input_type, path, None, 12)
+    if 'Stats' in l_stages:
+        stage('Stats', _bench_stats, esg.get_scenarios(d_Scen, 'StockRet'))
+    if 'StatsOnline' in l_stages:
+        stage('StatsOnline', _bench_stats_online, esg, d_Scen)
+    if 'NetOfDiv' in l_stages:
+        # Compilation (numba) not timed
+        gmdblib.calc_ret_netofdiv(np.zeros((2, 2)), dF_PolParamY, dF_Dividend, 10)
+        stage('NetOfDiv', _bench_netofdiv, d_Scen, dF_PolParamY, dF_Dividend, True)
+    if 'NetOfDiv_NumPy' in l_stages:
+        stage('NetOfDiv_NumPy', _bench_netofdiv, d_Scen, dF_PolParamY, dF_Dividend, False)
+    return l_Result
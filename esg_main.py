@@ -1,4 +1,3 @@
-
 # -*- coding: utf-8 -*-
 """
 @author: Pascal Winter
@@ -10,12 +9,14 @@ import numpy as np
 
 import libpw.esglib as esglib
 
+import os
+import shutil
+import tempfile
 from pathlib import Path
 CWD = Path(__file__).parent
 
 '''
 --------------------------- Further work to be done ---------------------------
-Interest model
 Optimisation on append + Numpyfication for speed
 
 
@@ -23,7 +24,8 @@ Optimisation on append + Numpyfication for speed
 0. PARAMETERS / INITITIALISATION
 1. RANDOM NUMBER GENERATION
 2. STOCK MODEL - B&S
-3. INTEREST RATE MODEL - CIR 
+3. INTEREST RATE MODEL - CIR / HW
+4. SIMULATION (by blocks)
 
 ----------------------------------- Inputs ------------------------------------
 Correlation starts with stocks then rates
@@ -33,10 +35,48 @@ Correlation starts with stocks then rates
 ----------------------------------- Outputs -----------------------------------
 Stock Model: 
     => output_type
-        - 'DB': Return a csv files in a DB format with fields ['Asset', 'Simulation', 'Year', Return]
-        - 'XLSX': Return a xlsx files with several sheets (one per Asset) and format [Time * Simulation]
+        - 'DB': Return a csv files in a DB format with fields ['Simulation', 'Year', 'Asset', Return]
+                (or a parquet dataset directory if db_format = 'PARQUET'), written block by block
+        - 'XLSX': Return a xlsx files with several sheets (one per Asset) and format [Time * Simulation],
+                  streamed row by row (constant memory), or one workbook per asset written in
+                  parallel if xlsx_split (name_output_<Asset>_results.xlsx)
         - 'CSV': Return several CSV file (one per asset ) and format [Time * Simulation]
+        - 'NPY': Return a binary store (directory name_output_store) with one .npy file per
+                 array [Simulation * Time * Asset] (StockRet, StockVal, Rate) and a JSON header
+                 (meta.json: assets, time grid, seed, parameters), read with esglib.load_store
     => output_field
+    => online_stats: analysis workbook name_output_analysis.xlsx (as scripts/esg_results.py),
+       with statistics collected during the simulation - memory independent of i_num_sim,
+       percentiles from histograms (i_stats_bins over t_stats_range_ret / t_stats_range_val) - no scenario file needed (output_type = None)
+    => adaptive_sim: simulations added by batches (i_adapt_batch) until the relative standard error
+       of the discounted mean prices (and l_adapt_quantile) is below d_adapt_tol on all stocks and
+       output steps, i_num_sim being the maximum - the number used only depends on the seed
+    => l_sensitivity: each variant (shifted yield curve, scaled vol, shifted return / dividend) is
+       calculated on the random numbers of the base run and exported as the base run under
+       name_output_<Name> (rates only if they depend on the curve: Hull-White)
+    => validate: name_output_validation.csv, tests of the scenarios against the model with Monte
+       Carlo standard errors (mean value / expected value by stock and output step, realised vs
+       input vol, realised vs input correlation of the shocks), computed block by block
+    => run_report: name_output_report.json with the run settings (seed, precision, variance reduction...)
+       and the time / peak memory by stage
+    => name_output_meta.json: run settings (seed, random generator, precision, variance reduction,
+       parameters...) written with every output type
+       and the time and peak memory of each stage (loading, curve, random generation, paths,
+       extraction, exports...), optionally logged (report_log),
+       see esglib.subscribe_report for hooks
+    => precision: 'float32' halves the memory of the draws, the block buffers and the outputs (spools,
+       store, files); increments and outputs are float32, paths are summed in log space and the
+       statistics accumulated in float64: on identical shocks (65 years, 48 steps a year) values,
+       means and percentiles are within 1e-5 (relative) of float64 - float32 draws are another
+       sample of the same seed, so runs differ from float64 by the Monte Carlo error
+    => path_cache: outputs stored in a cache directory by hash of the parameter tables, seed and
+       settings, copied back instead of simulating when a run has the same inputs
+Interest Rate Model (rate_model):
+    Opt-in (default None: stocks only), 'CIR' or 'HW' fitted on the yield curve
+    Short rate, deflator and ZC bond prices (l_zc_maturity) at output steps, from time 0
+        - 'DB': csv file name_output_rates_results.csv with fields ['Simulation', 'Year', 'Asset', Value]
+        - 'XLSX': xlsx file name_output_rates_results.xlsx, one sheet per rate and output [Time * Simulation]
+        - 'CSV': one csv file per rate and output [Time * Simulation]
     
     
 '''
@@ -51,12 +91,67 @@ i_step_length = 48 # Step Per years (in calculation)
 d_deltaT = 1 / i_step_length
 # ------ Ouptut
 i_outpoutstep_length = 12 # 12: month, 1: year
-output_type = 'CSV' #   'DB'   'XLSX'   'CSV'
+output_type = 'CSV' #   'DB'   'XLSX'   'CSV'   'NPY'   None (no scenario file)
+db_format = 'CSV' #   'CSV'   'PARQUET' (DB output only, requires pyarrow)
+xlsx_split = False # XLSX output only: one workbook per asset, written by i_num_workers processes
+# ------ Stepping
+stepping = 'calc' # 'calc': simulated on calculation steps, 'exact': directly on output steps
+# ------ Memory
+i_block_size = 250 # Simulations calculated at once (None: all), results do not depend on it
 
 
 # --------------------- Random Generation -------------------------------------#
 seed_rand = True
 seed_val = 453624
+rng_type = 'PCG64' #  'PCG64'  'Philox'
+precision = 'float64' #  'float64'  'float32' (draws, increments and outputs: half the memory,
+                      #  paths summed in log space and statistics accumulated in float64)
+variance_reduction = None #  None   'antithetic' (pairs of opposite shocks)   'moment' (moment matching)
+                          #  'sobol' (quasi Monte Carlo: scrambled Sobol on the coarse levels of a Brownian bridge, needs scipy)
+i_mm_group = 500 # simulations matched together (moment matching)
+
+# --------------------- Parallel Calculation ----------------------------------#
+i_num_workers = 1 # Processes calculating the blocks, results do not depend on it (without fork,
+                  # e.g. Windows, this script runs in a single process: see esglib.get_process_context)
+worker_export = False # if True, workers write their slice of the output directly
+
+# --------------------- Streaming Statistics ----------------------------------#
+online_stats = False # if True, analysis workbook from statistics collected block by block
+l_quantile = [0.005, 0.01, 0.05, 0.1, 0.25, 0.50, 0.75, 0.9, 0.95, 0.99, 0.995]
+i_stats_bins = 4000 # bins of the percentile histograms (log space)
+t_stats_range_ret = None # log(1 + return) range of the return histograms (bin width: range / i_stats_bins),
+                         # None: by stock, drift +/- 8 std of an output step (see esglib.get_sketch_range)
+                         # => return percentiles within ~0.4% (relative, 0.003 std) of the scenario file ones
+                         #    with 5000 sims - (-1, 1) for all stocks: up to ~1.5% on monthly returns
+t_stats_range_val = (-8, 8) # log(price) range of the price histograms, to be widened for high vol / long horizons
+                            # => price percentiles within ~0.3% (relative) with 4000 bins
+
+# --------------------- Adaptive Simulation Count -----------------------------#
+adaptive_sim = False # if True, simulations added by batches until converged (i_num_sim: maximum)
+i_adapt_batch = 1000 # simulations added between two convergence checks
+d_adapt_tol = 0.005 # relative standard error targeted on the discounted mean prices (all stocks / steps)
+l_adapt_quantile = [] # percentiles of the discounted prices also checked, e.g. [0.05, 0.95]
+
+# --------------------- Sensitivities -----------------------------------------#
+l_sensitivity = [] # variants on the same random numbers, e.g. [{'Name': 'YCUp', 'YieldCurve': 0.01},
+                   #  {'Name': 'VolUp', 'Volatility': 1.1}, {'Name': 'RetDn', 'Return': -0.01}, {'Name': 'DivUp', 'Dividend': 0.005}]
+
+# --------------------- Validation --------------------------------------------#
+validate = False # if True, martingale, vol and correlation tests (name_output_validation.csv)
+d_valid_alpha = 0.01 # probability of a false failure by test family (Bonferroni)
+
+# --------------------- Interest Rate Model -----------------------------------#
+rate_model = None #  None (no rate simulated, stock outputs only)   'CIR'   'HW'
+rate_scheme = 'euler' #  'euler' (full truncation)  'exact' (CIR noncentral chi-square)
+l_zc_maturity = [1, 10] # ZC bond prices maturities in output
+
+# --------------------- Scenario Cache ----------------------------------------#
+path_cache = None # directory of the scenario cache (None: no cache), outputs reused if same inputs
+i_cache_size = 20 * 2**30 # maximum size of the cache in bytes (least recently used removed)
+
+# --------------------- Run Report --------------------------------------------#
+run_report = False # if True, time and peak memory by stage in name_output_report.json
+report_log = None # optional log file of the stages (None: no log)
 
 # --------------------- Technical ---------------------------------------------#
 rn_sim = False # if True, asset return will be the yield curve minus div yield
@@ -77,13 +172,21 @@ name_output = 'RW'
 ################################################################################
  
 
+# Stages timed from here (see esglib.stage_timer)
+if run_report == True:
+    esglib.enable_report(name_log = report_log)
+
+
 # --------------------- Load tables Parameters --------------------------------#
-xcel_file = pd.ExcelFile(list(CWD.rglob(excel_parameters))[0])
-dF_StockParam = pd.read_excel(xcel_file, 'Stock_Param', index_col = 0)
-dF_IntParam = pd.read_excel(xcel_file, 'Int_Param', index_col = 0)
-dF_YieldCurve = pd.read_excel(xcel_file, 'Yield_Curve', index_col = 0)
-nA_Correlation = pd.read_excel(xcel_file, 'Correlation', header = None)
-nA_Correlation = nA_Correlation.to_numpy()
+# Workbook located once (outputs written in its directory), parsed tables cached
+with esglib.stage_timer('LoadParameters'):
+    spath_param = esglib.find_file(excel_parameters, CWD)
+    spath_out = spath_param.parent.as_posix()
+    d_Param = esglib.load_parameters(spath_param, esglib.d_param_sheets)
+dF_StockParam = d_Param['Stock_Param']
+dF_IntParam = d_Param['Int_Param']
+dF_YieldCurve = d_Param['Yield_Curve']
+nA_Correlation = d_Param['Correlation'].to_numpy()
 
 
 # Check consistency
@@ -98,42 +201,23 @@ dF_Test.loc[dF_Test.shape[0]] = ['Import - Correl Matrix Size', nA_Correlation.s
 l_asset = list(dF_StockParam.index) + list(dF_IntParam.index)
 l_stocks = list(dF_StockParam.index)
 l_simulation = list(np.arange(0, i_num_sim))
-# Define time steps to be used
-i_step_modulo = i_step_length // i_outpoutstep_length # modulo for extraction output
-l_step_out = list(np.arange(0, i_step_length * i_num_steps + 1, i_step_modulo)) # selected steps for extraction
-# Steps for indexes
-l_step_year = list(np.arange(0, i_step_length * i_num_steps, i_step_modulo) * d_deltaT ) # selected steps for extraction
-l_step_year2 = list(np.arange(0, i_step_length * i_num_steps + 1, i_step_modulo) * d_deltaT ) # selected steps for extraction
-
-
-# Define Stock Indexes
-Stock_index = pd.MultiIndex.from_product([l_simulation, l_step_year, l_stocks],
-                                         names=[ 'Simulation', 'Year', 'Asset'])
-Stock_index2 = pd.MultiIndex.from_product([l_simulation, l_step_year2, l_stocks],
-                                         names=[ 'Simulation', 'Year', 'Asset'])
 
 
-# ------------------------ Get fowrards from spot rate ------------------------#
-# Prepare: reset index and get step length
-dF_YieldCurve = dF_YieldCurve.reset_index()
-dF_YieldCurve['Step'] = dF_YieldCurve['Year'].diff(1).fillna(0)
-# Get the Total Return and divide it by the previous step
-dF_temp2 = np.power(1 +  dF_YieldCurve['Spot'], dF_YieldCurve['Year'])
-dF_temp2 = dF_temp2 / dF_temp2.shift(1)
-# Re-adjust with the step and take off one
-dF_YieldCurve['Forward'] = np.power(dF_temp2, 1 / dF_YieldCurve['Step'] ) - 1
-dF_YieldCurve['Forward']  = dF_YieldCurve['Forward'].fillna(method = 'bfill')
-# Restore Index
-dF_YieldCurve = dF_YieldCurve.set_index('Year')
-
-
-# --------------------- Align Yield Curve on time frame -----------------------#
-# with interpolation
-tindex = np.linspace(0,  dF_YieldCurve.index.max(), int(i_step_length * dF_YieldCurve.index.max() + 1))
-dF_YC_Aligned =  dF_YieldCurve.reindex(tindex)
-dF_YC_Aligned = dF_YC_Aligned.interpolate(method = 'linear' )
-dF_YC_Aligned = dF_YC_Aligned[:i_num_steps].iloc[:-1] # trim to get same size
-dF_YC_Aligned = dF_YC_Aligned.reset_index()
+# ------------------------ Simulation set up ----------------------------------#
+# Time grids, forwards, drift, correlation factor, rate model, variants and blocks,
+# as in ESGenerator (see esglib.setup_model)
+d_Setup = esglib.setup_model(dF_StockParam, dF_IntParam, dF_YieldCurve, nA_Correlation, i_num_sim,
+                             i_num_steps, i_step_length, i_outpoutstep_length, stepping, i_block_size,
+                             seed_val if seed_rand == True else None, rng_type, precision,
+                             variance_reduction, i_mm_group, rate_model, rate_scheme, l_zc_maturity,
+                             rn_sim, l_sensitivity)
+# (sent once to each worker process in parallel mode)
+d_Model = d_Setup['Model']
+# Steps for indexes (returns, values from time 0) and modulo for extraction output
+l_step_year, l_step_year2 = d_Setup['StepYear'], d_Setup['StepYear2']
+i_step_modulo = d_Setup['StepModulo']
+# Forwards from the spot rates, aligned on the calculation steps
+dF_YieldCurve, dF_YC_Aligned = d_Setup['YieldCurve'], d_Setup['YCAligned']
 
 
 
@@ -141,22 +225,20 @@ dF_YC_Aligned = dF_YC_Aligned.reset_index()
 #%%#############################################################################
 ####################### 1. RANDOM NUMBER GENERATION  ###########################
 ################################################################################
-# Creates a nA of size Sim * Time * Asset
+# Creates a nA of size Sim * Time * Asset, block by block of simulations
 
 # -----------------------------------------------------------------------------#
 # ----------------Create the random numbers with a normal distribution --------#
 # -----------------------------------------------------------------------------#
 
-# Initialise mean and covariance
-mean = [0] * i_num_assets 
-cov = nA_Correlation
-# Seed the random number generator
-if seed_rand == True: np.random.seed(seed_val)
-# Generate the Random multivariate vector (size: ( Time * Sim) * Asset)
-nA_Multvar = np.random.multivariate_normal(mean, cov, 
-                        size=(i_step_length * i_num_steps  *i_num_sim))
-# Reshape as an Sim * Time * Asset array
-nA_Multvar = nA_Multvar.reshape(i_num_sim, i_step_length * i_num_steps, i_num_assets)
+# Root seed of the run: each simulation gets its own stream spawned from it
+seed_entropy = d_Model['Seed']
+# Blocks of simulations - results do not depend on the blocks nor on the workers
+# (blocks and adaptive batches aligned on the antithetic pairs or the matching groups,
+# otherwise drawn twice)
+l_blocks, i_block_size = d_Setup['Blocks'], d_Setup['BlockSize']
+i_adapt_batch = -(-i_adapt_batch // d_Setup['Align']) * d_Setup['Align']
+# The vectors are generated in the block loop below (see 4. SIMULATION)
 
 
 
@@ -172,80 +254,252 @@ nA_Multvar = nA_Multvar.reshape(i_num_sim, i_step_length * i_num_steps, i_num_as
 
 l_stocks = list(dF_StockParam.index) 
 n_stocks = len(l_stocks)
-nA_Multvar2 = nA_Multvar[:, :, 0:n_stocks] # Slice the Multvar for further calculation
-
-nA_StockBS = np.zeros( shape = nA_Multvar2.shape, dtype = 'float32')
 
 
 # -----------------------------------------------------------------------------#
-# ------------------ Calculate the B/S returns --------------------------------#
+# ------------------ Calculate the 1st BS Term --------------------------------#
 # -----------------------------------------------------------------------------#
-
-# ------------------------ Calculate the 1st BS Term --------------------------#
+# Identical for all simulations: size Time * Stock
 # Apply the forward curves if this is RN, assumed returns if RW
-if rn_sim == True: 
-    nA_StockBS = np.add(nA_StockBS, dF_YC_Aligned['Forward'][None, :, None])
-else:
-    nA_StockBS = np.add(nA_StockBS, dF_StockParam['Return'][None, None, :])
-# Apply the dividends
-nA_StockBS = np.subtract(nA_StockBS, dF_StockParam['Dividend'][None, None, :])
-# Lognormalise
-nA_StockBS = np.log(1 + nA_StockBS)
-# Substract the volatility term
-nA_temp = np.square(dF_StockParam['Volatility']) / 2
-nA_StockBS = np.subtract(nA_StockBS, nA_temp[None, None, :])
-# Multiply by DeltaT
-nA_StockBS = nA_StockBS * d_deltaT
+nA_StockDrift = d_Setup['StockDrift']
+
+
+
 
-# ------------------------ Calculate the 2nd BS Term --------------------------#
-# Multiply the multivariate term with the vol
-nA_Multvar2 = np.multiply(nA_Multvar2, dF_StockParam['Volatility'][None, None, :])
-# Scale by Sqrt of DeltaT
-nA_Multvar2 = nA_Multvar2 * np.sqrt(d_deltaT)
-# Add 1st and 2nd term
-nA_StockBS = nA_StockBS + nA_Multvar2
-# Exponentialise
-nA_StockBS = np.exp(nA_StockBS)
+#%%#############################################################################
+########################## 3. INTEREST RATE MODEL ##############################
+################################################################################
+# Short rate (CIR or Hull-White) on the rate columns of the random numbers
 
+l_rates = list(dF_IntParam.index)
+n_rates = len(l_rates)
+d_Rate = d_Model['Rate']
+# Outputs by rate: short rate, deflator and ZC prices
+l_rate_series = d_Setup['RateSeries']
 
 
 # -----------------------------------------------------------------------------#
-# ------------------------ Wrangle the data for output ------------------------#
+# ------------------ Sensitivity variants -------------------------------------#
 # -----------------------------------------------------------------------------#
+# Drift and vol by variant (and the rate model if fitted on the shifted curve),
+# simulated with the shocks of the base run (see esglib.simulate_stock_variants)
+d_Variant = d_Model.get('Variant')
+d_VariantParam = d_Setup['VariantParam']
 
-# -------- Calculate Value and extract Value and Returns at output step  ------#
-# Insert first value and add 1 to all returns
-nA_StockBS_Val = np.insert(nA_StockBS, 0, 1.0, axis = 1)
-# Cumulative Product to get Value
-nA_StockBS_Val = nA_StockBS_Val.cumprod(axis=1)
-# Select only the output steps
-nA_StockBS_Val_Out = nA_StockBS_Val[:, l_step_out, :]
-# Calculate the Output Steps returns
-nA_StockBS_Ret_Out = nA_StockBS_Val_Out[:, 1:, :] / nA_StockBS_Val_Out[:, :-1, :] - 1
 
 
 
-# ------------------------- Reshape on a DB format for output -----------------#
-# flatten numpy as 1 dimension and pass it as a dataframe
-dF_StockBS_Val_Out = pd.DataFrame(nA_StockBS_Val_Out.flatten(), 
-                                  index = Stock_index2, columns = ['Price'])
 
+#%%#############################################################################
+############################## 4. SIMULATION  ##################################
+################################################################################
+
+# ------------------------ Scenario cache -------------------------------------#
+# Same tables, seed and settings (except blocks and workers): previous outputs are copied
+l_files_out = [] # outputs written by the run (stored in the cache)
+b_cache_hit = False
+if path_cache is not None and seed_rand == True:
+    cache_key = esglib.get_cache_key({
+        'StockParam': dF_StockParam, 'IntParam': dF_IntParam, 'YieldCurve': dF_YieldCurve,
+        'Correlation': nA_Correlation, 'Seed': seed_val, 'RngType': rng_type, 'Precision': precision,
+        'VarRed': variance_reduction, 'MMGroup': i_mm_group if variance_reduction == 'moment' else None,
+        'NumSim': i_num_sim, 'NumSteps': i_num_steps, 'StepLength': i_step_length,
+        'OutputStepLength': i_outpoutstep_length, 'Stepping': stepping, 'RNSim': rn_sim,
+        'RateModel': rate_model, 'RateScheme': rate_scheme, 'ZCMaturity': l_zc_maturity,
+        'OutputType': output_type, 'DBFormat': db_format, 'XLSXSplit': xlsx_split, 'OnlineStats': online_stats,
+        'Quantile': l_quantile, 'StatsBins': i_stats_bins,
+        'StatsRange': [t_stats_range_ret, t_stats_range_val], 'NameOutput': name_output,
+        'Adaptive': [i_adapt_batch, d_adapt_tol, l_adapt_quantile] if adaptive_sim == True else None,
+        'Validate': d_valid_alpha if validate == True else None, 'Sensitivity': l_sensitivity})
+    with esglib.stage_timer('CacheRestore'):
+        b_cache_hit = esglib.restore_cache(path_cache, cache_key, spath_out)
+    if b_cache_hit == True:
+        print('Outputs restored from the scenario cache (' + cache_key[:12] + ')')
+        # Nothing to simulate nor export
+        l_blocks, output_type, online_stats, adaptive_sim, validate = [], None, False, False, False
 
-dF_StockBS_Ret_Out = pd.DataFrame(nA_StockBS_Ret_Out.flatten(), 
-                                  index = Stock_index, columns = ['Return'])
 
+# -----------------------------------------------------------------------------#
+# ------------------ Prepare the outputs --------------------------------------#
+# -----------------------------------------------------------------------------#
+# Stock returns, and rate outputs (levels, starting at time 0), then the same by variant
+d_Output = {'StockRet': {'Year': l_step_year, 'Asset': l_stocks, 'Column': 'Return', 'Name': name_output,
+                         'Path': spath_out + "/" + name_output + '_results.csv'}}
+if d_Rate is not None:
+    d_Output['Rate'] = {'Year': l_step_year2, 'Asset': l_rate_series, 'Column': 'Value', 'Name': name_output,
+                        'Path': spath_out + "/" + name_output + '_rates_results.csv'}
+l_suffix = [] # result name suffixes of the variants
+for i, name in enumerate(d_Variant['Name'] if d_Variant is not None else []):
+    l_suffix.append('_' + name)
+    d_Output['StockRet_' + name] = dict(d_Output['StockRet'], Name = name_output + '_' + name,
+                                        Path = spath_out + "/" + name_output + '_' + name + '_results.csv')
+    if d_Variant['Rate'][i] is not None:
+        d_Output['Rate_' + name] = dict(d_Output['Rate'], Name = name_output + '_' + name,
+                                        Path = spath_out + "/" + name_output + '_' + name + '_rates_results.csv')
+
+# Matrix outputs are written Time * Simulation: block results are collected
+# in a disk backed spool (Asset * Time * Sim) and exported once all blocks are done
+d_Spool = {}
+if output_type in ['XLSX', 'CSV']:
+    for key, d_Out in d_Output.items():
+        spath_spool = None
+        if worker_export == True:
+            # Named spool, each worker writes its slice
+            i_fd, spath_spool = tempfile.mkstemp(suffix = '.npy')
+            os.close(i_fd)
+            d_Out.update({'Type': 'Spool', 'Path': spath_spool})
+        d_Spool[key] = esglib.create_spool(i_num_sim, len(d_Out['Year']), len(d_Out['Asset']),
+                                           precision, spath_spool)
+    # Sim * Time * Asset views on the returns and rates
+    nA_StockBS_Ret_Out = d_Spool['StockRet'].transpose(2, 1, 0)
+    if d_Rate is not None:
+        nA_Rate_Out = d_Spool['Rate'].transpose(2, 1, 0)
+# Run settings, saved with every output type (name_output_meta.json, header of the NPY store)
+d_Meta = {'Seed': seed_val if seed_rand == True else None, 'SeedEntropy': seed_entropy,
+          'RngType': rng_type, 'Precision': precision, 'Stepping': stepping,
+          'VarianceReduction': variance_reduction,
+          'MMGroup': i_mm_group if variance_reduction == 'moment' else None,
+          'Adaptive': {'Batch': i_adapt_batch, 'Tol': d_adapt_tol, 'Quantile': l_adapt_quantile}
+                      if adaptive_sim == True else None,
+          'NumSteps': i_num_steps, 'StepLength': i_step_length,
+          'OutputStepLength': i_outpoutstep_length, 'RNSim': rn_sim,
+          'RateModel': rate_model, 'RateScheme': rate_scheme, 'ZCMaturity': l_zc_maturity,
+          'StockParam': dF_StockParam, 'IntParam': dF_IntParam,
+          'YieldCurve': dF_YieldCurve, 'Correlation': nA_Correlation}
+if output_type == 'NPY':
+    print('Exporting to binary store...')
+    # Stock values are also stored
+    for suffix in [''] + l_suffix:
+        d_Output['StockVal' + suffix] = {'Year': l_step_year2, 'Asset': l_stocks}
+    for d_Out in d_Output.values():
+        d_Out['Dtype'] = precision
+    spath_store = spath_out + "/" + name_output + '_store'
+    d_Store = esglib.create_store(spath_store, d_Output, d_Meta, i_num_sim)
+    for key, d_Out in d_Output.items():
+        # Each worker writes its slice of the arrays
+        d_Out.update({'Type': 'Store', 'Path': spath_store + "/" + key + '.npy'})
+    # Sim * Time * Asset views on the returns and rates
+    nA_StockBS_Ret_Out = d_Store['StockRet']
+    if d_Rate is not None:
+        nA_Rate_Out = d_Store['Rate']
+if output_type == 'DB':
+    print('Exporting DB to ' + db_format.lower() + '...')
+    for key, d_Out in d_Output.items():
+        # Each worker writes a part file, merged in simulation order at the end (CSV),
+        # or one file of the parquet dataset directory per block (PARQUET)
+        d_Out.update({'Type': 'DB', 'Format': db_format})
+        if db_format == 'PARQUET':
+            d_Out['Path'] = d_Out['Path'][:-len('.csv')] + '.parquet'
+            shutil.rmtree(d_Out['Path'], ignore_errors = True)
+if worker_export == True:
+    d_Model['Export'] = d_Output
+if output_type is None:
+    # Nothing sent back by the workers
+    d_Model['Export'] = {key: {'Type': None} for key in ['StockVal' + suffix for suffix in [''] + l_suffix]
+                         + list(d_Output)}
 
 
+# -----------------------------------------------------------------------------#
+# ------------------ Prepare the streaming statistics -------------------------#
+# -----------------------------------------------------------------------------#
+# Returns and prices at the end of each output step (as loaded by esg_results)
+d_Acc = {}
+if online_stats == True:
+    if t_stats_range_ret is None:
+        t_stats_range_ret = esglib.get_sketch_range(esglib.aggregate_drift(nA_StockDrift, i_step_modulo),
+                                                    dF_StockParam['Volatility'].to_numpy(),
+                                                    1 / i_outpoutstep_length)
+    d_Acc['StockRet'] = esglib.create_accumulator(len(l_step_year), n_stocks,
+                                                  esglib.get_sketch_edges(*t_stats_range_ret, i_stats_bins), 'Return')
+    d_Acc['StockVal'] = esglib.create_accumulator(len(l_step_year), n_stocks,
+                                                  esglib.get_sketch_edges(*t_stats_range_val, i_stats_bins), 'Price')
+    for key in d_Model.get('Export', {}):
+        if key in d_Acc:
+            d_Model['Export'][key] = dict(d_Model['Export'][key], Keep = True)
 
 
+# -----------------------------------------------------------------------------#
+# ------------------ Prepare the validation -----------------------------------#
+# -----------------------------------------------------------------------------#
+# Values, returns and shocks of each block tested against the model (see esglib.create_validation)
+if validate == True:
+    d_Model['Shock'] = True
+    d_Valid = esglib.create_validation(d_Model, nA_Correlation, d_valid_alpha)
+    for key in d_Model.get('Export', {}):
+        if key in ['StockVal', 'StockRet']:
+            d_Model['Export'][key] = dict(d_Model['Export'][key], Keep = True)
 
-#%%#############################################################################
-########################## 2. INTEREST RATE MODEL ##############################
-################################################################################
 
-# TO BE DEVELOPPED
+# -----------------------------------------------------------------------------#
+# ------------------ Prepare the adaptive number of simulations ---------------#
+# -----------------------------------------------------------------------------#
+# Stock values discounted with the market curve, checked after each batch: the outputs
+# are sized for i_num_sim and cut to the simulations used
+if adaptive_sim == True:
+    nA_Discount = np.exp(esglib.calculate_log_discount(dF_YieldCurve.index.to_numpy(),
+                                                       dF_YieldCurve['Forward'].to_numpy(),
+                                                       np.asarray(l_step_year2)))[1:]
+    d_Conv = esglib.create_convergence(nA_Discount, n_stocks, d_adapt_tol, l_adapt_quantile,
+                                       i_stats_bins, variance_reduction == 'antithetic', t_stats_range_val)
+    if 'StockVal' in d_Model.get('Export', {}):
+        d_Model['Export']['StockVal'] = dict(d_Model['Export']['StockVal'], Keep = True)
+    it_blocks = esglib.run_adaptive(d_Model, d_Conv, i_num_sim, i_adapt_batch, i_block_size, i_num_workers)
+else:
+    it_blocks = esglib.run_blocks(d_Model, l_blocks, i_num_workers)
 
 
+# -----------------------------------------------------------------------------#
+# ------------------ Calculate the B/S and rates by block ---------------------#
+# -----------------------------------------------------------------------------#
+# Random numbers, paths, extraction at output steps (in parallel if i_num_workers > 1)
+
+with esglib.stage_timer('Simulation'):
+    l_blocks_done = []
+    for i_start, i_end, d_Result in it_blocks:
+        # ----------------------- Collect or export the block ---------------------#
+        for key in d_Output:
+            if key not in d_Result or key in d_Model.get('Export', {}):
+                continue # exported by the worker
+            with esglib.stage_timer('Collect_' + str(output_type), Block = i_start, Result = key):
+                if output_type in ['XLSX', 'CSV']:
+                    d_Spool[key][:, :, i_start:i_end] = d_Result[key].transpose(2, 1, 0)
+                if output_type == 'NPY':
+                    d_Store[key][i_start:i_end] = d_Result[key]
+                if output_type == 'DB':
+                    # Export (append after the 1st block)
+                    esglib.export_block_db(d_Result[key], i_start, d_Output[key]['Year'],
+                                           d_Output[key]['Asset'], d_Output[key]['Path'],
+                                           i_start == 0, d_Output[key]['Column'], db_format)
+        # ----------------------- Streaming statistics ----------------------------#
+        for key, d_Stat in d_Acc.items():
+            with esglib.stage_timer('Statistics', Block = i_start, Result = key):
+                esglib.update_accumulator(d_Stat, d_Result[key][:, 1:] if key == 'StockVal' else d_Result[key])
+        if validate == True:
+            with esglib.stage_timer('Validation', Block = i_start):
+                esglib.update_validation(d_Valid, d_Result)
+        l_blocks_done.append((i_start, i_end))
+        print('Simulations ' + str(i_start) + ' to ' + str(i_end - 1) + ' done')
+
+    if adaptive_sim == True:
+        i_num_sim = d_Conv['NumSim']
+        print('Adaptive simulation count: ' + str(i_num_sim) + ' simulations, relative standard error '
+              + '{:.5f}'.format(d_Conv['Error']) + (' within' if d_Conv['Converged'] else ' above')
+              + ' the tolerance ' + str(d_adapt_tol))
+        print(esglib.describe_convergence(d_Conv, l_stocks))
+if output_type == 'DB' and db_format == 'CSV' and worker_export == True:
+    with esglib.stage_timer('MergeParts'):
+        for d_Out in d_Output.values():
+            esglib.merge_parts(d_Out['Path'], l_blocks_done)
+if output_type == 'DB':
+    l_files_out += [d_Out['Path'] for d_Out in d_Output.values()]
+for nA_Spool in d_Spool.values():
+    nA_Spool.flush()
+if output_type == 'NPY':
+    nA_StockBS_Ret_Out = nA_Rate_Out = None
+    with esglib.stage_timer('Export_NPY'):
+        esglib.close_store(spath_store, d_Store, i_num_sim)
+    l_files_out.append(spath_store)
+    
 
 
 
@@ -274,11 +528,7 @@ print(dF_Test)
 # -----------------------------------------------------------------------------#
 
 
-if output_type == 'DB':
-    print('Exporting DB to csv...')
-    # Export Returns
-    spath = list(CWD.rglob(excel_parameters))[0].parent.as_posix() + "/" + name_output + '_results.csv'
-    dF_StockBS_Ret_Out.to_csv(spath)
+# Exported block by block in the simulation loop (see 4. SIMULATION)
 
 
 # -----------------------------------------------------------------------------#
@@ -288,16 +538,16 @@ if output_type == 'DB':
 
 if output_type == 'XLSX':
     print('Exporting Results to Excel...')
-    # Setup excel writer
-    spath = list(CWD.rglob(excel_parameters))[0].parent.as_posix() + "/" + name_output + '_results.xlsx'
-    writer = pd.ExcelWriter(spath, engine='xlsxwriter') 
-    # Write Files - Single Simulation
-    for i, stock in enumerate(l_stocks):
-        dF_temp = pd.DataFrame(nA_StockBS_Ret_Out[:, :, i])
-        dF_temp.T.to_excel(writer, sheet_name=stock, freeze_panes=(1,1))    
-    # Close writer
-    writer.save()
-    writer.close()
+    # One workbook for the stocks, one for the rates (or one per asset)
+    for key, d_Out in d_Output.items():
+        if xlsx_split == True:
+            spath = [spath_out + "/" + d_Out['Name'] + "_" + asset + '_results.xlsx' for asset in d_Out['Asset']]
+        else:
+            spath = spath_out + "/" + d_Out['Name'] + ('_results.xlsx' if key.startswith('StockRet') else '_rates_results.xlsx')
+        # Write Files - Single Simulation, one sheet per asset
+        with esglib.stage_timer('Export_XLSX', Result = key):
+            esglib.export_matrix_xlsx(d_Spool[key][:, :, :i_num_sim], d_Out['Asset'], spath, i_num_workers)
+        l_files_out += spath if xlsx_split == True else [spath]
 
 
 # -----------------------------------------------------------------------------#
@@ -307,11 +557,54 @@ if output_type == 'XLSX':
 
 if output_type == 'CSV':
     print('Exporting Results to Csv...')
-    spath = list(CWD.rglob(excel_parameters))[0].parent.as_posix()
-    # Write Files - Single Simulation
-    for i, stock in enumerate(l_stocks):
-        name_file = spath + "/" + name_output + "_" + stock + '_results.csv'
-        pd.DataFrame(nA_StockBS_Ret_Out[:, :, i]).T.to_csv(name_file)  
+    # Write Files - Single Simulation (stocks then rates)
+    for key, d_Out in d_Output.items():
+        for i, asset in enumerate(d_Out['Asset']):
+            name_file = spath_out + "/" + d_Out['Name'] + "_" + asset + '_results.csv'
+            with esglib.stage_timer('Export_CSV', Result = asset):
+                esglib.export_matrix_csv(d_Spool[key][i][:, :i_num_sim], name_file)
+            l_files_out.append(name_file)
+
+# Remove the named spools (written by the workers)
+if output_type in ['XLSX', 'CSV'] and worker_export == True:
+    nA_StockBS_Ret_Out = nA_Rate_Out = nA_Spool = None
+    for key, d_Out in d_Output.items():
+        d_Spool[key] = None
+        os.remove(d_Out['Path'])
+
+
+
+
+# -----------------------------------------------------------------------------#
+#---------------------  Export Analysis (streaming statistics) ----------------#
+# -----------------------------------------------------------------------------#
+# Same workbook as scripts/esg_results.py
+
+if online_stats == True:
+    print('Exporting Analysis to Excel...')
+    with esglib.stage_timer('Analysis'):
+        dF_Global_StockRet = esglib.describe_accumulator(d_Acc['StockRet'], l_stocks, l_step_year, 'Return',
+                                                         l_quantile, False, i_outpoutstep_length)
+        dF_Period_StockRet = esglib.describe_accumulator(d_Acc['StockRet'], l_stocks, l_step_year, 'Return',
+                                                         l_quantile, True, i_outpoutstep_length)
+        dF_Period_StockVal = esglib.describe_accumulator(d_Acc['StockVal'], l_stocks, l_step_year, 'Price',
+                                                         l_quantile, True)
+        esglib.export_analysis(spath_out + "/" + name_output + '_analysis.xlsx',
+                               dF_Global_StockRet, dF_Period_StockVal, dF_Period_StockRet)
+        l_files_out.append(spath_out + "/" + name_output + '_analysis.xlsx')
+
+
+# -----------------------------------------------------------------------------#
+#---------------------  Export Validation -------------------------------------#
+# -----------------------------------------------------------------------------#
+# One row by test, summary by test family
+
+if validate == True:
+    spath = spath_out + "/" + name_output + '_validation.csv'
+    dF_Valid = esglib.describe_validation(d_Valid, l_stocks, l_step_year2[1:], l_stocks + l_rates)
+    dF_Valid.to_csv(spath, index = False)
+    l_files_out.append(spath)
+    print(esglib.summarize_validation(dF_Valid))
 
 
 
@@ -320,17 +613,67 @@ if output_type == 'CSV':
 #---------------------  Export Expected Returns -------------------------------#
 # -----------------------------------------------------------------------------#
 
-spath = list(CWD.rglob(excel_parameters))[0].parent.as_posix() + "/" + name_output + '_exp_returns.csv'
-# ------------------------ Calculate the expected returns
-dF_temp = dF_YC_Aligned  # add YC only for Risk neutral cases
-# Develop the dataframe with the stock indexes
-dF_temp = dF_temp.assign(key=1).merge(dF_StockParam.reset_index().assign(key=1), on='key').drop('key', 1)
-# Calculate the expected return (annualised)
-if rn_sim == True:
-    dF_temp['ExpRet'] = dF_temp['Forward']
-else:
-    dF_temp['ExpRet'] = dF_temp['Return']
-# Take out the dividends
-dF_temp['ExpRet'] = dF_temp['ExpRet']  - dF_temp['Dividend']
-dF_temp = dF_temp[['Year', 'StockName', 'ExpRet']]
-dF_temp.to_csv(spath)
+# Base run then the sensitivity variants
+with esglib.stage_timer('ExpectedReturns'):
+    l_exp = [(name_output, dF_StockParam, dF_YC_Aligned)] + \
+        [(name_output + '_' + name, dF_Param_Var, dF_YC_Var)
+         for name, (dF_Param_Var, dF_YC_Var) in d_VariantParam.items()]
+    for name_exp, dF_StockParam_Exp, dF_YC_Exp in l_exp:
+        spath = spath_out + "/" + name_exp + '_exp_returns.csv'
+        # ------------------------ Calculate the expected returns
+        dF_temp = dF_YC_Exp  # add YC only for Risk neutral cases
+        # Develop the dataframe with the stock indexes
+        dF_temp = dF_temp.merge(dF_StockParam_Exp.reset_index(), how = 'cross')
+        # Calculate the expected return (annualised)
+        if rn_sim == True:
+            dF_temp['ExpRet'] = dF_temp['Forward']
+        else:
+            dF_temp['ExpRet'] = dF_temp['Return']
+        # Take out the dividends
+        dF_temp['ExpRet'] = dF_temp['ExpRet']  - dF_temp['Dividend']
+        dF_temp = dF_temp[['Year', 'StockName', 'ExpRet']]
+        dF_temp.to_csv(spath)
+
+
+
+
+# -----------------------------------------------------------------------------#
+#---------------------  Export Run Settings -----------------------------------#
+# -----------------------------------------------------------------------------#
+# Seed, random generation and variance reduction of the scenarios, whatever the output type
+# (restored with the outputs on a cache hit)
+
+if b_cache_hit == False:
+    spath = spath_out + "/" + name_output + '_meta.json'
+    esglib.write_meta(spath, dict(d_Meta, NumSim = i_num_sim, OutputType = output_type,
+                                  Sensitivity = l_sensitivity))
+    l_files_out.append(spath)
+
+
+
+
+# -----------------------------------------------------------------------------#
+#---------------------  Scenario cache ----------------------------------------#
+# -----------------------------------------------------------------------------#
+
+if path_cache is not None and seed_rand == True and b_cache_hit == False:
+    with esglib.stage_timer('CacheStore'):
+        esglib.store_cache(path_cache, cache_key, l_files_out, i_cache_size)
+
+
+
+
+# -----------------------------------------------------------------------------#
+#---------------------  Run report --------------------------------------------#
+# -----------------------------------------------------------------------------#
+# Time and peak memory by stage (not part of the cached outputs)
+
+if run_report == True:
+    spath = esglib.write_report(spath_out + "/" + name_output + '_report.json',
+                                {'NumSim': i_num_sim, 'NumSteps': i_num_steps, 'StepLength': i_step_length,
+                                 'BlockSize': i_block_size, 'Workers': i_num_workers,
+                                 'Seed': seed_val if seed_rand == True else None, 'RngType': rng_type,
+                                 'Precision': precision, 'VarianceReduction': variance_reduction,
+                                 'MMGroup': i_mm_group if variance_reduction == 'moment' else None,
+                                 'OutputType': output_type, 'CacheHit': b_cache_hit})
+    print('Run report written to ' + spath)
@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Pascal Winter
+www.winter-aas.com
+
+Economic scenario generator as an object: same model and random streams as
+esg_main.py, the scenarios are returned in memory (no file written)
+
+    esg = ESGenerator('RW_param.xlsx', i_num_sim = 1000)
+    d_Scen = esg.run()
+    d_Scen['StockRet'] # Sim * Time * Stock
+"""
+
+import numpy as np
+
+import libpw.esglib as esglib
+
+
+
+
+class ESGenerator:
+    '''
+    Stocks (B&S) and short rates (CIR / HW) simulated by blocks of simulations
+    ----------
+    d_Param : dict of the parameter tables (see esglib.load_parameters and esglib.d_param_sheets)
+              or path of the parameter workbook
+    Options : as in esg_main.py (seed_val = None: random seed, precision: type of the scenarios)
+    '''
+
+    def __init__(self, d_Param, i_num_sim = 5000, i_num_steps = 55 + 5 + 5, i_step_length = 48,
+                 i_outpoutstep_length = 12, stepping = 'calc', i_block_size = 250,
+                 seed_val = 453624, rng_type = 'PCG64', precision = 'float64',
+                 variance_reduction = None, i_mm_group = 500, i_num_workers = 1,
+                 rate_model = None, rate_scheme = 'euler', l_zc_maturity = [1, 10], rn_sim = False):
+        if not isinstance(d_Param, dict):
+            d_Param = esglib.load_parameters(d_Param, esglib.d_param_sheets)
+        self.dF_StockParam = d_Param['Stock_Param']
+        self.dF_IntParam = d_Param['Int_Param']
+        self.nA_Correlation = d_Param['Correlation'].to_numpy()
+        self.i_num_sim = i_num_sim
+        self.i_num_steps = i_num_steps
+        self.i_step_length = i_step_length
+        self.i_outpoutstep_length = i_outpoutstep_length
+        self.stepping = stepping
+        self.i_block_size = i_block_size
+        self.seed_val = seed_val
+        self.rng_type = rng_type
+        self.precision = precision
+        self.variance_reduction = variance_reduction
+        self.i_mm_group = i_mm_group
+        self.i_num_workers = i_num_workers
+        self.rate_model = rate_model
+        self.rate_scheme = rate_scheme
+        self.l_zc_maturity = l_zc_maturity
+        self.rn_sim = rn_sim
+        self.dF_YieldCurve = d_Param['Yield_Curve']
+        self.setup()
+
+
+    def setup(self):
+        '''
+        Time grids, drift, correlation factor and rate model: the simulation set up (d_Model),
+        as in esg_main.py (see esglib.setup_model)
+        '''
+        d_Setup = esglib.setup_model(self.dF_StockParam, self.dF_IntParam, self.dF_YieldCurve,
+                                     self.nA_Correlation, self.i_num_sim, self.i_num_steps,
+                                     self.i_step_length, self.i_outpoutstep_length, self.stepping,
+                                     self.i_block_size, self.seed_val, self.rng_type, self.precision,
+                                     self.variance_reduction, self.i_mm_group, self.rate_model,
+                                     self.rate_scheme, self.l_zc_maturity, self.rn_sim)
+        self.d_Model = d_Setup['Model']
+        self.l_blocks = d_Setup['Blocks']
+        self.seed_entropy = self.d_Model['Seed']
+        self.l_step_year = d_Setup['StepYear']
+        self.l_step_year2 = d_Setup['StepYear2']
+        self.dF_YieldCurve = d_Setup['YieldCurve']
+        self.dF_YC_Aligned = d_Setup['YCAligned']
+        self.l_stocks = list(self.dF_StockParam.index)
+        self.l_rates = list(self.dF_IntParam.index)
+        self.l_rate_series = d_Setup['RateSeries']
+        # Axes of the results
+        self.d_Layout = {'StockRet': {'Year': self.l_step_year, 'Asset': self.l_stocks},
+                         'StockVal': {'Year': self.l_step_year2, 'Asset': self.l_stocks}}
+        if self.d_Model['Rate'] is not None:
+            self.d_Layout['Rate'] = {'Year': self.l_step_year2, 'Asset': self.l_rate_series}
+
+
+    def run_blocks(self):
+        '''
+        Yields (start, end, dict of results) by block of simulations (see esglib.run_blocks)
+        '''
+        return esglib.run_blocks(self.d_Model, self.l_blocks, self.i_num_workers)
+
+
+    def run(self, l_keys = None):
+        '''
+        Simulate all the scenarios in memory
+        ----------
+        l_keys : results kept among 'StockRet', 'StockVal', 'Rate' (None: all)
+        Returns a dict with the arrays (Sim * Time * Asset) by result,
+        'Simulation', and the axes of each result in 'Year' and 'Asset' (dict by result)
+        '''
+        l_keys = list(self.d_Layout) if l_keys is None else l_keys
+        d_Scen = {key: np.empty((self.i_num_sim, len(self.d_Layout[key]['Year']),
+                                 len(self.d_Layout[key]['Asset'])), dtype = self.precision) for key in l_keys}
+        for i_start, i_end, d_Result in self.run_blocks():
+            for key in l_keys:
+                d_Scen[key][i_start:i_end] = d_Result[key]
+        d_Scen['Simulation'] = np.arange(self.i_num_sim)
+        d_Scen['Year'] = {key: np.asarray(self.d_Layout[key]['Year']) for key in l_keys}
+        d_Scen['Asset'] = {key: list(self.d_Layout[key]['Asset']) for key in l_keys}
+        return d_Scen
+
+
+    def validate(self, d_alpha = 0.01):
+        '''
+        Martingale, vol and correlation tests on the scenarios, streamed block by block
+        (nothing kept in memory), see esglib.describe_validation
+        '''
+        d_Model = dict(self.d_Model, Shock = True)
+        d_Valid = esglib.create_validation(d_Model, self.nA_Correlation, d_alpha)
+        for i_start, i_end, d_Result in esglib.run_blocks(d_Model, self.l_blocks, self.i_num_workers):
+            esglib.update_validation(d_Valid, d_Result)
+        return esglib.describe_validation(d_Valid, self.l_stocks, self.l_step_year2[1:],
+                                          self.l_stocks + self.l_rates)
+
+
+    def get_scenarios(self, d_Scen, key = 'StockRet'):
+        '''
+        One result in the layout of esglib.load_scenarios ('Ret', 'Simulation', 'Year', 'Asset'),
+        e.g. for esglib.describe_scenarios
+        '''
+        return {'Ret': d_Scen[key], 'Simulation': d_Scen['Simulation'],
+                'Year': d_Scen['Year'][key], 'Asset': d_Scen['Asset'][key]}
@@ -2,17 +2,1259 @@
 
 import pandas as pd
 import numpy as np
+import tempfile
+import os
+import json
+import shutil
+import hashlib
+import re
+import warnings
+import logging
+import time
+import sys
+import multiprocessing
+from collections import deque
+from functools import partial
+from statistics import NormalDist
+from contextlib import contextmanager
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
 
 
 
 
+#%%#############################################################################
+############################ 0. SIMULATION  ####################################
+################################################################################
+
+
+
+def get_blocks(i_num_sim, i_block_size):
+    '''
+    Split the simulations in consecutive blocks
+    ----------
+    i_num_sim : number of simulations
+    i_block_size : number of simulations per block (None: one single block)
+    Returns a list of (start, end) simulation bounds
+    '''
+    if i_block_size is None or i_block_size >= i_num_sim:
+        return [(0, i_num_sim)]
+    if i_block_size < 1:
+        raise ValueError('Block size must be a positive integer')
+    return [(i, min(i + i_block_size, i_num_sim)) for i in range(0, i_num_sim, i_block_size)]
+
+
+_d_factor_cache = {} # Correlation factors already calculated (key: matrix bytes)
+
+
+def get_correl_factor(nA_Correlation):
+    '''
+    Factor F of the correlation matrix (F @ F.T = Correlation), calculated once per matrix
+    ----------
+    nA_Correlation : correlation matrix
+    Cholesky decomposition, if the matrix is not positive definite it is repaired
+    (negative eigen values floored at 0 and unit diagonal restored)
+    '''
+    nA_Correlation = np.ascontiguousarray(nA_Correlation, dtype = 'float64')
+    key = (nA_Correlation.shape, nA_Correlation.tobytes())
+    if key not in _d_factor_cache:
+        try:
+            nA_Factor = np.linalg.cholesky(nA_Correlation)
+        except np.linalg.LinAlgError:
+            # PSD repair: clip the eigen values and rescale on a unit diagonal
+            nA_w, nA_v = np.linalg.eigh((nA_Correlation + nA_Correlation.T) / 2)
+            nA_Factor = nA_v * np.sqrt(np.clip(nA_w, 0, None))[None, :]
+            nA_Factor = nA_Factor / np.sqrt(np.square(nA_Factor).sum(axis = 1))[:, None]
+        nA_Factor.setflags(write = False)
+        _d_factor_cache[key] = nA_Factor
+    return _d_factor_cache[key]
+
+
+def get_rng(seed_val = None, rng_type = 'PCG64'):
+    '''
+    Random Generator based on a PCG64 or Philox bit generator
+    ----------
+    seed_val : seed or SeedSequence (None: not reproducible)
+    rng_type : 'PCG64' or 'Philox'
+    '''
+    if rng_type not in ['PCG64', 'Philox']:
+        raise ValueError('Unknown bit generator: ' + str(rng_type))
+    return np.random.Generator(getattr(np.random, rng_type)(seed_val))
+
+
+def get_seed_entropy(seed_val = None):
+    '''
+    Root entropy of the run: the seed, or fresh entropy if not seeded
+    (to be shared by all the blocks and workers of a run)
+    '''
+    return np.random.SeedSequence(seed_val).entropy
+
+
+def get_sim_rngs(seed_entropy, i_start, i_end, rng_type = 'PCG64'):
+    '''
+    One independent Generator per simulation, spawned from the root seed
+    ----------
+    seed_entropy : root entropy of the run (see get_seed_entropy)
+    i_start, i_end : simulations i_start to i_end - 1
+    The stream of simulation i only depends on the seed and i: results do not
+    depend on the blocks nor on the number of workers
+    '''
+    return [get_rng(np.random.SeedSequence(seed_entropy, spawn_key = (i,)), rng_type)
+            for i in range(i_start, i_end)]
+
+
+def get_draw_range(d_Model, i_start, i_end):
+    '''
+    Streams drawn for simulations i_start to i_end - 1 (variance reduction 'VarRed' of the model)
+    ----------
+    None, 'sobol' : one stream per simulation
+    'antithetic' : simulations 2k and 2k + 1 share the stream k with opposite signs
+    'moment' : whole groups of 'MMGroup' simulations are drawn and matched (see moment_match)
+    The streams and groups only depend on the simulation index: results do not depend
+    on the blocks nor on the number of workers
+    Returns the streams drawn (start, end), and for each simulation its row in the draws and
+    its sign (None: all positive)
+    '''
+    nA_Sim = np.arange(i_start, i_end)
+    var_red = d_Model.get('VarRed')
+    if var_red is None or var_red == 'sobol':
+        return i_start, i_end, nA_Sim - i_start, None
+    if var_red == 'antithetic':
+        i_draw_start, i_draw_end = i_start // 2, (i_end + 1) // 2
+        return i_draw_start, i_draw_end, nA_Sim // 2 - i_draw_start, np.where(nA_Sim % 2 == 1, -1, 1)
+    if var_red == 'moment':
+        i_group = d_Model['MMGroup']
+        i_draw_start = (i_start // i_group) * i_group
+        i_draw_end = min(-(-i_end // i_group) * i_group, d_Model['NumSim'])
+        return i_draw_start, i_draw_end, nA_Sim - i_draw_start, None
+    raise ValueError('Unknown variance reduction: ' + str(var_red))
+
+
+def moment_match(nA_Rand, i_group):
+    '''
+    Moment matching of independent standard normals (Sim * Time * Asset), in place:
+    at each time step the sample mean is 0 and the sample covariance the identity,
+    by group of i_group simulations along the 1st axis (a group with no more
+    simulations than assets is left unchanged)
+    '''
+    i_num_assets = nA_Rand.shape[2]
+    for i in range(0, nA_Rand.shape[0], i_group):
+        # Time * Sim * Asset, in float64
+        nA_temp = nA_Rand[i:i + i_group].astype('float64').transpose(1, 0, 2)
+        if nA_temp.shape[1] <= i_num_assets:
+            continue
+        nA_temp -= nA_temp.mean(axis = 1, keepdims = True)
+        nA_Cov = np.matmul(nA_temp.transpose(0, 2, 1), nA_temp) / (nA_temp.shape[1] - 1)
+        # Whitened by the inverse Cholesky factor of the sample covariance
+        nA_Inv = np.linalg.inv(np.linalg.cholesky(nA_Cov))
+        nA_Rand[i:i + i_group] = np.matmul(nA_temp, nA_Inv.transpose(0, 2, 1)).transpose(1, 0, 2)
+    return nA_Rand
+
+
+_d_sobol_cache = {} # Sobol engines and bridge orders of the process
+
+
+def get_bridge_order(i_num_steps):
+    '''
+    Brownian bridge on i_num_steps steps of length 1: the last point first, then the
+    middle points level by level (the first dimensions carry most of the variance)
+    Returns nA of the built point, its left and right points, and nA of the left weight,
+    right weight and standard deviation, by construction step
+    '''
+    key = ('Bridge', i_num_steps)
+    if key not in _d_sobol_cache:
+        l_order = [(i_num_steps, 0, 0, 0., 0., np.sqrt(i_num_steps))]
+        l_todo = deque([(0, i_num_steps)])
+        while l_todo:
+            i_left, i_right = l_todo.popleft()
+            if i_right - i_left < 2:
+                continue
+            i_mid = (i_left + i_right) // 2
+            l_order.append((i_mid, i_left, i_right, (i_right - i_mid) / (i_right - i_left),
+                            (i_mid - i_left) / (i_right - i_left),
+                            np.sqrt((i_mid - i_left) * (i_right - i_mid) / (i_right - i_left))))
+            l_todo.extend([(i_left, i_mid), (i_mid, i_right)])
+        nA_Order = np.array(l_order)
+        _d_sobol_cache[key] = (nA_Order[:, 0:3].astype('int64'), nA_Order[:, 3:6])
+    return _d_sobol_cache[key]
+
+
+def generate_sobol_normals(seed_entropy, l_rng, i_start, i_end, i_num_time, i_num_out, i_num_factors,
+                           dtype = 'float64', out = None, i_num_qmc = 16):
+    '''
+    Independent standard normals (Sim * Time * Factor) from scrambled Sobol points (quasi Monte Carlo)
+    ----------
+    seed_entropy : root entropy of the run, seeds the scrambling
+    l_rng : Generators of the simulations (see get_sim_rngs), for the finer bridge levels and
+            the steps between output steps
+    i_start, i_end : simulations i_start to i_end - 1, i.e. points i_start to i_end - 1 of the sequence
+    i_num_time, i_num_out : number of calculation steps and of output steps (multiple of it)
+    i_num_factors : number of factors (stocks then rates)
+    i_num_qmc : bridge steps by factor taken from the Sobol points (the coarse levels)
+    The Brownian paths on the output steps are built by a Brownian bridge: its first i_num_qmc
+    steps from the Sobol dimensions (i_num_qmc * factors), the finer levels from the pseudo random
+    draws of the simulation (Sobol points in high dimension are correlated on pairs of
+    dimensions at the usual numbers of simulations). The increments of the calculation steps
+    are bridged between the output steps with the pseudo random draws of the simulation
+    '''
+    from scipy.stats import qmc
+    from scipy.special import ndtri
+    i_sub = i_num_time // i_num_out
+    if i_sub * i_num_out != i_num_time:
+        raise ValueError('Calculation steps must be a multiple of the output steps')
+    i_num_qmc = min(i_num_qmc, i_num_out)
+    i_dim = i_num_qmc * i_num_factors
+    key = ('Sobol', seed_entropy, i_dim)
+    if key not in _d_sobol_cache:
+        # Scrambling seeded apart from the streams of the simulations (spawn key of length 2)
+        _d_sobol_cache[key] = qmc.Sobol(i_dim, scramble = True,
+                                        seed = np.random.default_rng(np.random.SeedSequence(seed_entropy,
+                                                                                            spawn_key = (0, 0))))
+    sobol = _d_sobol_cache[key]
+    sobol.reset()
+    if i_start > 0:
+        sobol.fast_forward(i_start)
+    with warnings.catch_warnings():
+        # Balance properties: warning if the block is not a power of 2, the sequence is the same
+        warnings.simplefilter('ignore', UserWarning)
+        nA_Point = sobol.random(i_end - i_start)
+    # Dimensions by bridge step then factor, then the finer levels drawn by simulation
+    nA_Normal = np.empty((i_end - i_start, i_num_out, i_num_factors))
+    nA_Normal[:, :i_num_qmc] = ndtri(np.clip(nA_Point, 2.**-31, None)).reshape(i_end - i_start, i_num_qmc,
+                                                                               i_num_factors)
+    for i, rng_sim in enumerate(l_rng):
+        rng_sim.standard_normal(out = nA_Normal[i, i_num_qmc:])
+    nA_Index, nA_Weight = get_bridge_order(i_num_out)
+    nA_Path = np.zeros((i_end - i_start, i_num_out + 1, i_num_factors))
+    for k in range(i_num_out):
+        i_point, i_left, i_right = nA_Index[k]
+        nA_Path[:, i_point] = (nA_Weight[k, 0] * nA_Path[:, i_left] + nA_Weight[k, 1] * nA_Path[:, i_right]
+                               + nA_Weight[k, 2] * nA_Normal[:, k])
+    nA_Incr = np.diff(nA_Path, axis = 1)
+    # Calculation steps: centred pseudo random draws plus the share of the output step increment
+    shape = (i_end - i_start, i_num_time, i_num_factors)
+    if out is None:
+        out = np.empty(shape, dtype = dtype)
+    if i_sub == 1:
+        out[:] = nA_Incr
+        return out
+    for i, rng_sim in enumerate(l_rng):
+        rng_sim.standard_normal(dtype = dtype, out = out[i])
+    nA_Sub = out.reshape(i_end - i_start, i_num_out, i_sub, i_num_factors)
+    nA_Sub -= nA_Sub.mean(axis = 2, keepdims = True)
+    nA_Sub += (nA_Incr / np.sqrt(i_sub)).astype(dtype)[:, :, None, :]
+    return out
+
+
+def generate_correlated_normals(rng, nA_Factor, i_num_sim, i_num_time, dtype = 'float64',
+                                nA_Buffer = None, out = None, i_mm_group = None):
+    '''
+    Correlated standard normals of size Sim * Time * Asset
+    ----------
+    rng : numpy Generator, or list of Generators (one per simulation)
+    nA_Factor : factor of the correlation matrix (see get_correl_factor)
+    i_num_sim, i_num_time : number of simulations and time steps
+    dtype : 'float32' or 'float64'
+    nA_Buffer : optional preallocated array receiving the independent draws
+    out : optional preallocated array receiving the correlated draws
+    i_mm_group : if set, independent draws moment matched by group of simulations (see moment_match)
+    Draws are sequential by simulation: drawing by blocks gives the same numbers
+    with a single Generator, as does a list of Generators (see get_sim_rngs)
+    '''
+    shape = (i_num_sim, i_num_time, nA_Factor.shape[0])
+    if nA_Buffer is None:
+        nA_Buffer = np.empty(shape, dtype = dtype)
+    if nA_Buffer.shape != shape or nA_Buffer.dtype != np.dtype(dtype):
+        raise ValueError('Buffer must be of shape ' + str(shape) + ' and type ' + str(dtype))
+    if isinstance(rng, np.random.Generator):
+        rng.standard_normal(dtype = dtype, out = nA_Buffer)
+    else:
+        for i, rng_sim in enumerate(rng):
+            rng_sim.standard_normal(dtype = dtype, out = nA_Buffer[i])
+    if i_mm_group is not None:
+        moment_match(nA_Buffer, i_mm_group)
+    # Apply the factor on the asset axis
+    return np.matmul(nA_Buffer, nA_Factor.T.astype(dtype), out = out)
+
+
+def calculate_forward(dF_YieldCurve):
+    '''
+    Forward rates from the spot rates of the yield curve
+    ----------
+    dF_YieldCurve : Dataframe indexed by Year with a 'Spot' column
+    Returns the curve with the 'Step' and 'Forward' columns
+    '''
+    # Prepare: reset index and get step length
+    dF_YieldCurve = dF_YieldCurve.reset_index()
+    # (the 1st step starts at 0: the 1st forward is the 1st spot, if the curve does not start at 0)
+    dF_YieldCurve['Step'] = dF_YieldCurve['Year'].diff(1).fillna(dF_YieldCurve['Year'])
+    # Get the Total Return and divide it by the previous step
+    dF_temp2 = np.power(1 +  dF_YieldCurve['Spot'], dF_YieldCurve['Year'])
+    dF_temp2 = dF_temp2 / dF_temp2.shift(1).fillna(1)
+    # Re-adjust with the step and take off one (step of length 0: forward of the next step)
+    dF_YieldCurve['Forward'] = (np.power(dF_temp2, 1 / dF_YieldCurve['Step'] ) - 1).where(dF_YieldCurve['Step'] > 0)
+    dF_YieldCurve['Forward']  = dF_YieldCurve['Forward'].fillna(method = 'bfill')
+    # Restore Index
+    return dF_YieldCurve.set_index('Year')
+
+
+def shock_parameters(dF_StockParam, dF_YieldCurve, d_Sensi):
+    '''
+    Stock parameters and yield curve of a sensitivity variant
+    ----------
+    d_Sensi : dict of the shocks (all optional)
+        'YieldCurve' : parallel shift of the spot rates (0.01: +100bp), forwards recalculated
+        'Volatility' : factor on the volatilities
+        'Return', 'Dividend' : shift of the returns and dividend yields
+    Returns copies of dF_StockParam and dF_YieldCurve
+    '''
+    dF_StockParam = dF_StockParam.copy()
+    dF_StockParam['Volatility'] = dF_StockParam['Volatility'] * d_Sensi.get('Volatility', 1)
+    for col in ['Return', 'Dividend']:
+        dF_StockParam[col] = dF_StockParam[col] + d_Sensi.get(col, 0)
+    dF_YieldCurve = dF_YieldCurve.copy()
+    if d_Sensi.get('YieldCurve', 0) != 0:
+        dF_YieldCurve['Spot'] = dF_YieldCurve['Spot'] + d_Sensi['YieldCurve']
+        dF_YieldCurve = calculate_forward(dF_YieldCurve)
+    return dF_StockParam, dF_YieldCurve
+
+
+def align_yield_curve(dF_YieldCurve, i_step_length, i_num_steps):
+    '''
+    Yield curve interpolated on the calculation steps (Time rows, 'Year' column)
+    '''
+    tindex = np.linspace(0,  dF_YieldCurve.index.max(), int(i_step_length * dF_YieldCurve.index.max() + 1))
+    dF_YC_Aligned =  dF_YieldCurve.reindex(tindex)
+    dF_YC_Aligned = dF_YC_Aligned.interpolate(method = 'linear' )
+    dF_YC_Aligned = dF_YC_Aligned[:i_num_steps].iloc[:-1] # trim to get same size
+    return dF_YC_Aligned.reset_index()
+
+
+def calculate_bs_drift(dF_StockParam, nA_Forward, rn_sim, d_deltaT):
+    '''
+    Calculate the 1st B&S term (log drift * DeltaT), common to all simulations
+    ----------
+    dF_StockParam : Dataframe - Stock parameters (Return, Dividend, Volatility)
+    nA_Forward : forward curve aligned on the calculation steps (used if rn_sim)
+    rn_sim : if True, asset return will be the forward curve minus div yield
+    d_deltaT : length of a calculation step
+    Returns a nA of size Time * Stock
+    '''
+    nA_Drift = np.zeros(shape = (len(nA_Forward), dF_StockParam.shape[0]), dtype = 'float64')
+    # Apply the forward curves if this is RN, assumed returns if RW
+    if rn_sim == True:
+        nA_Drift = np.add(nA_Drift, np.asarray(nA_Forward, dtype = 'float64')[:, None])
+    else:
+        nA_Drift = np.add(nA_Drift, dF_StockParam['Return'].to_numpy()[None, :])
+    # Apply the dividends
+    nA_Drift = np.subtract(nA_Drift, dF_StockParam['Dividend'].to_numpy()[None, :])
+    # Lognormalise
+    nA_Drift = np.log(1 + nA_Drift)
+    # Substract the volatility term
+    nA_temp = np.square(dF_StockParam['Volatility'].to_numpy()) / 2
+    nA_Drift = np.subtract(nA_Drift, nA_temp[None, :])
+    # Multiply by DeltaT
+    return nA_Drift * d_deltaT
+
+
+def aggregate_drift(nA_Drift, i_step_modulo):
+    '''
+    1st B&S term integrated over each output step, for an exact simulation on the output grid
+    ----------
+    nA_Drift : 1st B&S term on the calculation steps, size Time * Stock (see calculate_bs_drift)
+    i_step_modulo : number of calculation steps per output step
+    Log drifts add up over the calculation steps and the shocks are scaled by
+    sqrt(i_step_modulo * DeltaT): the output steps have the same distribution
+    Returns a nA of size OutTime * Stock
+    '''
+    if nA_Drift.shape[0] % i_step_modulo != 0:
+        raise ValueError('Calculation steps must be a multiple of the output steps')
+    return nA_Drift.reshape(-1, i_step_modulo, nA_Drift.shape[1]).sum(axis = 1)
+
+
+def simulate_stock_block(nA_Multvar, nA_Drift, nA_Vol, d_deltaT, l_step_out):
+    '''
+    B&S paths for a block of simulations, extracted at the output steps
+    ----------
+    nA_Multvar : correlated normal shocks of size Sim * Time * Stock (overwritten)
+    nA_Drift : 1st B&S term of size Time * Stock (see calculate_bs_drift)
+    nA_Vol : volatility by stock
+    d_deltaT : length of a calculation step
+    l_step_out : calculation steps selected for output (0 being the start value)
+    Returns the values (Sim * OutTime+1 * Stock) and returns (Sim * OutTime * Stock)
+    in the type of the shocks (float32 or float64)
+    Log increments are calculated in place on the shocks (in their type) and summed by output
+    step: the full resolution values are never built. The sums and the exponential are done in
+    float64, so that float32 shocks only round the increments and the outputs (no error growing
+    with the number of steps)
+    '''
+    if l_step_out[0] != 0:
+        raise ValueError('The 1st output step must be the start value (step 0)')
+    with stage_timer('StockPaths'):
+        dtype = nA_Multvar.dtype
+        # 2nd B&S term: multiply by the vol and scale by sqrt of DeltaT
+        np.multiply(nA_Multvar, (np.asarray(nA_Vol)[None, None, :] * np.sqrt(d_deltaT)).astype(dtype),
+                    out = nA_Multvar)
+        # Add 1st and 2nd term: log increments
+        np.add(nA_Multvar, nA_Drift[None, :, :].astype(dtype, copy = False), out = nA_Multvar)
+    with stage_timer('OutputExtraction'):
+        # Sum the log increments by output step (in float64)
+        nA_LogRet = np.add.reduceat(nA_Multvar[:, :l_step_out[-1], :], l_step_out[:-1],
+                                    axis = 1, dtype = 'float64')
+        # Log values at output steps, starting from 0 (value 1)
+        nA_Val_Out = np.zeros((nA_LogRet.shape[0], nA_LogRet.shape[1] + 1, nA_LogRet.shape[2]),
+                              dtype = 'float64')
+        np.cumsum(nA_LogRet, axis = 1, out = nA_Val_Out[:, 1:, :])
+        # Exponentialise: values and output steps returns
+        np.exp(nA_Val_Out, out = nA_Val_Out)
+        nA_Ret_Out = np.expm1(nA_LogRet, out = nA_LogRet)
+    return nA_Val_Out.astype(dtype, copy = False), nA_Ret_Out.astype(dtype, copy = False)
+
+
+def simulate_stock_variants(nA_ShockSum, nA_Drift, nA_Vol, d_deltaT, l_step_out, dtype = 'float64'):
+    '''
+    B&S paths of several parameter variants on the same shocks, at the output steps
+    ----------
+    nA_ShockSum : normal shocks of the stocks summed by output step, size Sim * OutTime * Stock
+    nA_Drift : 1st B&S term by variant, size Variant * Time * Stock (see calculate_bs_drift)
+    nA_Vol : volatility by variant and stock
+    d_deltaT, l_step_out : see simulate_stock_block
+    dtype : type of the outputs (calculated in float64)
+    Returns the values (Variant * Sim * OutTime+1 * Stock) and returns (Variant * Sim * OutTime * Stock)
+    The log return of an output step is the drift summed over the step plus vol * sqrt(DeltaT)
+    * sum of the shocks: the shocks are summed once, the variants are broadcast
+    '''
+    with stage_timer('StockPaths', Variants = nA_Drift.shape[0]):
+        nA_LogDrift = np.add.reduceat(nA_Drift[:, :l_step_out[-1], :], l_step_out[:-1], axis = 1)
+        nA_Scale = np.asarray(nA_Vol, dtype = 'float64') * np.sqrt(d_deltaT)
+        nA_LogRet = nA_LogDrift[:, None, :, :] + nA_Scale[:, None, None, :] * nA_ShockSum[None, :, :, :]
+    with stage_timer('OutputExtraction', Variants = nA_Drift.shape[0]):
+        nA_Val_Out = np.zeros(nA_LogRet.shape[:2] + (nA_LogRet.shape[2] + 1, nA_LogRet.shape[3]))
+        np.cumsum(nA_LogRet, axis = 2, out = nA_Val_Out[:, :, 1:, :])
+        np.exp(nA_Val_Out, out = nA_Val_Out)
+        nA_Ret_Out = np.expm1(nA_LogRet, out = nA_LogRet)
+    return nA_Val_Out.astype(dtype, copy = False), nA_Ret_Out.astype(dtype, copy = False)
+
+
+# -----------------------------------------------------------------------------#
+# ------------------------ Interest Rate Model --------------------------------#
+# -----------------------------------------------------------------------------#
+# Short rate models on the rate columns of the correlated shocks
+# CIR: dr = a (b - r) dt + sigma sqrt(r) dW
+# HW: dr = (theta(t) - a r) dt + sigma dW, theta fitted on the yield curve
+
+
+def get_rate_series(l_rates, l_zc_maturity):
+    '''
+    Names of the rate outputs: short rate, deflator and ZC bond prices by maturity
+    '''
+    return [rate + '_' + serie for rate in l_rates
+            for serie in ['Rate', 'Deflator'] + ['P' + str(m) for m in l_zc_maturity]]
+
+
+def _get_curve_interval(nA_CurveYear, nA_Time):
+    # Interval of the forward curve of each time: k for Year_k-1 < t <= Year_k (0 before Year_0,
+    # the last one after the last year)
+    return np.minimum(np.searchsorted(nA_CurveYear, nA_Time, side = 'left'), len(nA_CurveYear) - 1)
+
+
+def calculate_inst_forward(nA_CurveYear, nA_CurveFwd, nA_Time):
+    '''
+    Instantaneous forward ln(1 + Forward): each annual forward of the curve (see calculate_forward)
+    is constant over its interval [Year_k-1, Year_k], the last one is extended
+    '''
+    nA_CurveYear = np.asarray(nA_CurveYear, dtype = 'float64')
+    return np.log1p(np.asarray(nA_CurveFwd, dtype = 'float64'))[_get_curve_interval(nA_CurveYear, nA_Time)]
+
+
+def calculate_log_discount(nA_CurveYear, nA_CurveFwd, nA_Time):
+    '''
+    Market log discount factors ln P(0,T) = - integral of ln(1 + Forward)
+    ----------
+    nA_CurveYear, nA_CurveFwd : forward curve (annual forward of each interval [Year_k-1, Year_k],
+                                flat after the last year, see calculate_inst_forward)
+    nA_Time : times (years)
+    Integrated exactly: P(0,T) = (1 + Spot_T)^-T at the years of the curve
+    '''
+    nA_CurveYear = np.asarray(nA_CurveYear, dtype = 'float64')
+    nA_Time = np.asarray(nA_Time, dtype = 'float64')
+    nA_LogFwd = np.log1p(np.asarray(nA_CurveFwd, dtype = 'float64'))
+    # Start of each interval and log discount factor at this start
+    nA_Start = np.concatenate([[0.], nA_CurveYear[:-1]])
+    nA_StartLogDisc = - np.concatenate([[0.], np.cumsum(nA_LogFwd * (nA_CurveYear - nA_Start))[:-1]])
+    nA_Pos = _get_curve_interval(nA_CurveYear, nA_Time)
+    return nA_StartLogDisc[nA_Pos] - nA_LogFwd[nA_Pos] * (nA_Time - nA_Start[nA_Pos])
+
+
+def calculate_rate_setup(dF_IntParam, rate_model, rate_scheme, l_zc_maturity,
+                         i_num_time, d_deltaT, l_step_out, nA_CurveYear, nA_CurveFwd):
+    '''
+    Deterministic part of the short rate model
+    ----------
+    dF_IntParam : Dataframe - Rate parameters (Int_a, Int_b, Int_sigma, Int_r0)
+    rate_model : 'CIR' or 'HW' (Int_b and Int_r0 not used, fitted on the curve)
+    rate_scheme : 'euler' (CIR full truncation) or 'exact' (CIR noncentral chi-square)
+                  HW is always sampled exactly
+    l_zc_maturity : maturities (years) of the ZC bond prices in output
+    i_num_time, d_deltaT, l_step_out : calculation steps and output steps
+    nA_CurveYear, nA_CurveFwd : forward curve (see calculate_log_discount)
+    Returns a dict used by simulate_rate_block, ZC prices being exp(LogA - B * r)
+    '''
+    if rate_model not in ['CIR', 'HW']:
+        raise ValueError('Unknown rate model: ' + str(rate_model))
+    if rate_scheme not in ['euler', 'exact']:
+        raise ValueError('Unknown rate scheme: ' + str(rate_scheme))
+    a = dF_IntParam['Int_a'].to_numpy(dtype = 'float64')
+    b = dF_IntParam['Int_b'].to_numpy(dtype = 'float64')
+    sigma = dF_IntParam['Int_sigma'].to_numpy(dtype = 'float64')
+    r0 = dF_IntParam['Int_r0'].to_numpy(dtype = 'float64')
+    nA_Tau = np.asarray(l_zc_maturity, dtype = 'float64')[None, :] # 1 * Maturity
+    nA_TimeOut = np.asarray(l_step_out, dtype = 'float64') * d_deltaT
+    d_Rate = {'Model': rate_model, 'Scheme': rate_scheme, 'a': a, 'b': b, 'sigma': sigma}
+    if rate_model == 'CIR':
+        d_Rate['r0'] = r0
+        # ZC bond prices: closed form (constant in time) - size Rate * Maturity
+        h = np.sqrt(np.square(a) + 2 * np.square(sigma))[:, None]
+        nA_temp = (h + a[:, None]) * np.expm1(h * nA_Tau) + 2 * h
+        d_Rate['B'] = 2 * np.expm1(h * nA_Tau) / nA_temp
+        nA_LogA = (2 * a * b / np.square(sigma))[:, None] * \
+            np.log(2 * h * np.exp((a[:, None] + h) * nA_Tau / 2) / nA_temp)
+        d_Rate['LogA'] = np.broadcast_to(nA_LogA[None, :, :], (len(l_step_out),) + nA_LogA.shape)
+        # Exact scheme: r(t + dt) = c * noncentral chi-square(d, r(t) * exp(-a dt) / c)
+        d_Rate['c'] = np.square(sigma) * (-np.expm1(-a * d_deltaT)) / (4 * a)
+        d_Rate['d'] = 4 * a * b / np.square(sigma)
+        if rate_scheme == 'exact' and np.any(d_Rate['d'] <= 1):
+            raise ValueError('Exact CIR scheme requires 4ab / sigma^2 > 1, use the euler scheme')
+    else:
+        # r(t) = x(t) + phi(t), x Ornstein-Uhlenbeck starting at 0
+        nA_Time = np.arange(0, i_num_time + 1) * d_deltaT
+        nA_InstFwd = calculate_inst_forward(nA_CurveYear, nA_CurveFwd, nA_Time)
+        d_Rate['Phi'] = nA_InstFwd[:, None] + \
+            np.square(sigma / a)[None, :] / 2 * np.square(-np.expm1(-a[None, :] * nA_Time[:, None]))
+        d_Rate['r0'] = d_Rate['Phi'][0]
+        # ZC bond prices: P(t,T) = P(0,T) / P(0,t) * exp(B f(0,t) - sigma^2/4a (1-exp(-2at)) B^2 - B r)
+        d_Rate['B'] = -np.expm1(-a[:, None] * nA_Tau) / a[:, None]
+        nA_LogDisc_T = calculate_log_discount(nA_CurveYear, nA_CurveFwd, nA_TimeOut[:, None] + nA_Tau)
+        nA_LogDisc_t = calculate_log_discount(nA_CurveYear, nA_CurveFwd, nA_TimeOut)
+        nA_Fwd_t = calculate_inst_forward(nA_CurveYear, nA_CurveFwd, nA_TimeOut)
+        d_Rate['LogA'] = (nA_LogDisc_T - nA_LogDisc_t[:, None])[:, None, :] + \
+            d_Rate['B'][None, :, :] * nA_Fwd_t[:, None, None] - \
+            (np.square(sigma) / (4 * a))[None, :, None] * \
+            (-np.expm1(-2 * a[None, :] * nA_TimeOut[:, None]))[:, :, None] * \
+            np.square(d_Rate['B'])[None, :, :]
+        # Exact OU step
+        d_Rate['Decay'] = np.exp(-a * d_deltaT)
+        d_Rate['StdDev'] = sigma * np.sqrt(-np.expm1(-2 * a * d_deltaT) / (2 * a))
+    return d_Rate
+
+
+def simulate_rate_block(nA_Shock, d_Rate, d_deltaT, l_step_out, nA_Chi2 = None):
+    '''
+    Short rate paths for a block of simulations, extracted at the output steps
+    ----------
+    nA_Shock : correlated normal shocks of the rates, size Sim * Time * Rate
+    d_Rate : see calculate_rate_setup
+    d_deltaT : length of a calculation step
+    l_step_out : calculation steps selected for output (0 being the start value)
+    nA_Chi2 : chi-square draws with d - 1 degrees of freedom (exact CIR scheme only),
+              the noncentral chi-square being (Z + sqrt(lambda))^2 + chi-square(d - 1)
+              so that the correlation is carried by the shock Z
+    Returns a nA of size Sim * OutTime+1 * Series (see get_rate_series):
+    short rate, deflator exp(-integral of r) and ZC bond prices by rate, in the type of
+    the shocks (the state and the integral of the short rate are carried in float64)
+    '''
+    if l_step_out[0] != 0:
+        raise ValueError('The 1st output step must be the start value (step 0)')
+    i_num_sim, i_num_time, i_num_rates = nA_Shock.shape
+    i_num_mat = d_Rate['B'].shape[1]
+    a, b, sigma = d_Rate['a'], d_Rate['b'], d_Rate['sigma']
+    # Position of each calculation step in the output (-1 if not an output)
+    nA_OutPos = np.full(i_num_time + 1, -1)
+    nA_OutPos[np.asarray(l_step_out)] = np.arange(len(l_step_out))
+    nA_Rate = np.empty((i_num_sim, len(l_step_out), i_num_rates), dtype = 'float64')
+    nA_Integral = np.empty_like(nA_Rate)
+    # State: r (or x for HW), effective short rate and integral of the short rate
+    nA_State = np.zeros((i_num_sim, i_num_rates)) + (0 if d_Rate['Model'] == 'HW' else d_Rate['r0'])
+    nA_r = np.zeros((i_num_sim, i_num_rates)) + d_Rate['r0']
+    nA_Int = np.zeros((i_num_sim, i_num_rates))
+    nA_Rate[:, 0] = nA_r
+    nA_Integral[:, 0] = nA_Int
+    for i in range(i_num_time):
+        nA_Z = nA_Shock[:, i, :]
+        if d_Rate['Model'] == 'HW':
+            nA_State = nA_State * d_Rate['Decay'] + d_Rate['StdDev'] * nA_Z
+            nA_r_new = nA_State + d_Rate['Phi'][i + 1]
+        elif d_Rate['Scheme'] == 'euler':
+            # Full truncation Euler
+            nA_State = nA_State + a * (b - nA_r) * d_deltaT + sigma * np.sqrt(nA_r * d_deltaT) * nA_Z
+            nA_r_new = np.maximum(nA_State, 0)
+        else:
+            nA_Lambda = nA_State * np.exp(-a * d_deltaT) / d_Rate['c']
+            nA_State = d_Rate['c'] * (np.square(nA_Z + np.sqrt(nA_Lambda)) + nA_Chi2[:, i, :])
+            nA_r_new = nA_State
+        # Integral of the short rate (trapezes)
+        nA_Int = nA_Int + (nA_r + nA_r_new) / 2 * d_deltaT
+        nA_r = nA_r_new
+        if nA_OutPos[i + 1] >= 0:
+            nA_Rate[:, nA_OutPos[i + 1]] = nA_r
+            nA_Integral[:, nA_OutPos[i + 1]] = nA_Int
+    # Outputs by rate: short rate, deflator and ZC bond prices
+    nA_Out = np.empty((i_num_sim, len(l_step_out), i_num_rates, 2 + i_num_mat), dtype = nA_Shock.dtype)
+    nA_Out[:, :, :, 0] = nA_Rate
+    nA_Out[:, :, :, 1] = np.exp(-nA_Integral)
+    nA_Out[:, :, :, 2:] = np.exp(d_Rate['LogA'][None, :, :, :] -
+                                 d_Rate['B'][None, None, :, :] * nA_Rate[:, :, :, None])
+    return nA_Out.reshape(i_num_sim, len(l_step_out), i_num_rates * (2 + i_num_mat))
+
+
+def setup_model(dF_StockParam, dF_IntParam, dF_YieldCurve, nA_Correlation, i_num_sim, i_num_steps,
+                i_step_length, i_outpoutstep_length, stepping = 'calc', i_block_size = 250, seed_val = None,
+                rng_type = 'PCG64', precision = 'float64', variance_reduction = None, i_mm_group = 500,
+                rate_model = None, rate_scheme = 'euler', l_zc_maturity = [1, 10], rn_sim = False,
+                l_sensitivity = []):
+    '''
+    Simulation set up of esg_main.py and ESGenerator: time grids, forward curve, drift,
+    correlation factor, rate model, sensitivity variants and blocks of simulations
+    ----------
+    dF_YieldCurve : spot curve (the forwards are added, see calculate_forward)
+    Options : as in esg_main.py (seed_val = None: random seed)
+    Returns a dict with 'Model' (set up of simulate_scenarios, sent to the workers),
+    'Blocks' and 'BlockSize' (aligned on 'Align': antithetic pairs or matching groups),
+    the output grids 'StepYear' (returns) and 'StepYear2' (values, from time 0), 'StepModulo',
+    the curves 'YieldCurve' and 'YCAligned', 'StockDrift' (by calculation step), 'RateSeries'
+    and 'VariantParam' (stock parameters and aligned curve by variant name)
+    '''
+    d_deltaT = 1 / i_step_length
+    # Output steps
+    i_step_modulo = i_step_length // i_outpoutstep_length
+    l_step_out = list(np.arange(0, i_step_length * i_num_steps + 1, i_step_modulo))
+    l_step_year = list(np.arange(0, i_step_length * i_num_steps, i_step_modulo) * d_deltaT)
+    l_step_year2 = list(np.arange(0, i_step_length * i_num_steps + 1, i_step_modulo) * d_deltaT)
+    # Simulation grid: calculation steps, or output steps if exact stepping
+    i_sim_modulo = i_step_modulo if stepping == 'exact' else 1
+    i_sim_num_time = i_step_length * i_num_steps // i_sim_modulo
+    d_sim_deltaT = d_deltaT * i_sim_modulo
+    l_sim_step_out = list(np.asarray(l_step_out) // i_sim_modulo)
+    # Forwards from the spot rates, aligned on the calculation steps
+    with stage_timer('CurveAlignment'):
+        dF_YieldCurve = calculate_forward(dF_YieldCurve)
+        dF_YC_Aligned = align_yield_curve(dF_YieldCurve, i_step_length, i_num_steps)
+    # Stocks: 1st B&S term (forwards if RN, assumed returns if RW)
+    nA_StockDrift = calculate_bs_drift(dF_StockParam, dF_YC_Aligned['Forward'], rn_sim, d_deltaT)
+    # Rates: short rate, deflator and ZC prices by rate
+    d_Rate = None
+    l_rate_series = []
+    if rate_model is not None and dF_IntParam.shape[0] > 0:
+        with stage_timer('RateSetup'):
+            d_Rate = calculate_rate_setup(dF_IntParam, rate_model, rate_scheme, l_zc_maturity,
+                                          i_sim_num_time, d_sim_deltaT, l_sim_step_out,
+                                          dF_YieldCurve.index.to_numpy(), dF_YieldCurve['Forward'].to_numpy())
+        l_rate_series = get_rate_series(list(dF_IntParam.index), l_zc_maturity)
+    # Variants: drift and vol (and the rate model if fitted on the shifted curve),
+    # simulated with the shocks of the base run (see simulate_stock_variants)
+    d_Variant = None
+    d_VariantParam = {}
+    if len(l_sensitivity) > 0:
+        d_Variant = {'Name': [], 'Drift': [], 'Vol': [], 'Rate': []}
+        for d_Sensi in l_sensitivity:
+            dF_StockParam_Var, dF_YieldCurve_Var = shock_parameters(dF_StockParam, dF_YieldCurve, d_Sensi)
+            dF_YC_Aligned_Var = align_yield_curve(dF_YieldCurve_Var, i_step_length, i_num_steps)
+            nA_Drift_Var = calculate_bs_drift(dF_StockParam_Var, dF_YC_Aligned_Var['Forward'], rn_sim, d_deltaT)
+            d_Rate_Var = None
+            if d_Rate is not None and rate_model == 'HW' and d_Sensi.get('YieldCurve', 0) != 0:
+                d_Rate_Var = calculate_rate_setup(dF_IntParam, rate_model, rate_scheme, l_zc_maturity,
+                                                  i_sim_num_time, d_sim_deltaT, l_sim_step_out,
+                                                  dF_YieldCurve_Var.index.to_numpy(),
+                                                  dF_YieldCurve_Var['Forward'].to_numpy())
+            d_Variant['Name'].append(d_Sensi['Name'])
+            d_Variant['Drift'].append(aggregate_drift(nA_Drift_Var, i_sim_modulo))
+            d_Variant['Vol'].append(dF_StockParam_Var['Volatility'].to_numpy())
+            d_Variant['Rate'].append(d_Rate_Var)
+            d_VariantParam[d_Sensi['Name']] = (dF_StockParam_Var, dF_YC_Aligned_Var)
+        d_Variant['Drift'], d_Variant['Vol'] = np.stack(d_Variant['Drift']), np.stack(d_Variant['Vol'])
+    # Blocks - results do not depend on the blocks nor on the workers (blocks aligned
+    # on the antithetic pairs or the matching groups, otherwise drawn twice)
+    i_align = {'antithetic': 2, 'moment': i_mm_group}.get(variance_reduction, 1)
+    if i_block_size is not None:
+        i_block_size = -(-i_block_size // i_align) * i_align
+    # Exact stepping: the GBM is sampled directly on the output steps with the
+    # drift integrated over each output step (i_step_modulo less draws)
+    d_Model = {'Factor': get_correl_factor(nA_Correlation), 'Seed': get_seed_entropy(seed_val),
+               'RngType': rng_type, 'Dtype': precision, 'NumTime': i_sim_num_time,
+               'Drift': aggregate_drift(nA_StockDrift, i_sim_modulo),
+               'Vol': dF_StockParam['Volatility'].to_numpy(),
+               'DeltaT': d_sim_deltaT, 'StepOut': l_sim_step_out, 'Rate': d_Rate,
+               'VarRed': variance_reduction, 'MMGroup': i_mm_group, 'NumSim': i_num_sim}
+    if d_Variant is not None:
+        d_Model['Variant'] = d_Variant
+    return {'Model': d_Model, 'Blocks': get_blocks(i_num_sim, i_block_size), 'BlockSize': i_block_size,
+            'Align': i_align, 'StepYear': l_step_year, 'StepYear2': l_step_year2, 'StepModulo': i_step_modulo,
+            'YieldCurve': dF_YieldCurve, 'YCAligned': dF_YC_Aligned, 'StockDrift': nA_StockDrift,
+            'RateSeries': l_rate_series, 'VariantParam': d_VariantParam}
+
+
+def create_spool(i_num_sim, i_num_time, i_num_assets, dtype = 'float64', name_file = None):
+    '''
+    Disk backed array of size Asset * Time * Sim used to collect block results
+    before a matrix export without holding them in memory
+    ----------
+    name_file : .npy file (can then be opened by other processes, see open_spool),
+                None: anonymous temporary file
+    '''
+    shape = (i_num_assets, i_num_time, i_num_sim)
+    if name_file is None:
+        return np.memmap(tempfile.TemporaryFile(), dtype = dtype, mode = 'w+', shape = shape)
+    return np.lib.format.open_memmap(name_file, mode = 'w+', dtype = dtype, shape = shape)
+
+
+def open_spool(name_file):
+    '''
+    Open an existing spool (see create_spool) for writing
+    '''
+    return np.lib.format.open_memmap(name_file, mode = 'r+')
+
+
+_d_buffer_cache = {} # Buffers reused from one block to the next (key: name, dtype)
+
+
+def get_buffer(name, shape, dtype = 'float64'):
+    '''
+    Preallocated array of a given shape, reused by the following blocks of the process
+    (a view on the 1st simulations is returned for a smaller block)
+    '''
+    key = (name, np.dtype(dtype).str)
+    nA_Buffer = _d_buffer_cache.get(key)
+    if nA_Buffer is None or nA_Buffer.shape[1:] != tuple(shape[1:]) or nA_Buffer.shape[0] < shape[0]:
+        nA_Buffer = np.empty(shape, dtype = dtype)
+        _d_buffer_cache[key] = nA_Buffer
+    return nA_Buffer[:shape[0]]
+
+
+def simulate_scenarios(d_Model, i_start, i_end):
+    '''
+    Random draws, B&S paths and short rate paths for simulations i_start to i_end - 1
+    ----------
+    d_Model : dict with the simulation set up
+        'Factor' : correlation factor (see get_correl_factor), stocks then rates
+        'Seed', 'RngType', 'Dtype' : root entropy, bit generator and precision ('float32' or
+                                     'float64'): type of the draws, the increments and the outputs
+        'VarRed', 'MMGroup', 'NumSim' : optional variance reduction (see get_draw_range)
+        'NumTime' : number of calculation steps
+        'Drift', 'Vol', 'DeltaT', 'StepOut' : see simulate_stock_block
+        'Rate' : optional, see calculate_rate_setup
+        'Shock' : optional, if True the shocks are also returned (see update_validation)
+        'Variant' : optional sensitivities on the same shocks, dict with 'Name', 'Drift' and 'Vol'
+                    by variant (stacked on a 1st axis), and 'Rate' (list, None: rates of the base)
+    Returns a dict of nA of size Sim * Time * Asset:
+        'StockVal', 'StockRet' : values and returns at output steps
+        'Rate' : rate outputs at output steps (see simulate_rate_block)
+        'Shock' : correlated shocks summed by output step and normalised (stocks then rates)
+        'StockVal_<name>', 'StockRet_<name>', 'Rate_<name>' : the same by variant
+    '''
+    with stage_timer('RandomGeneration', Block = i_start):
+        i_draw_start, i_draw_end, nA_Pos, nA_Sign = get_draw_range(d_Model, i_start, i_end)
+        l_rng = get_sim_rngs(d_Model['Seed'], i_draw_start, i_draw_end, d_Model['RngType'])
+        shape = (i_draw_end - i_draw_start, d_Model['NumTime'], d_Model['Factor'].shape[0])
+        if d_Model.get('VarRed') == 'sobol':
+            nA_Rand = generate_sobol_normals(d_Model['Seed'], l_rng, i_start, i_end, d_Model['NumTime'],
+                                             len(d_Model['StepOut']) - 1, shape[2], d_Model['Dtype'],
+                                             get_buffer('Rand', shape, d_Model['Dtype']))
+            nA_Multvar = np.matmul(nA_Rand, d_Model['Factor'].T.astype(d_Model['Dtype']),
+                                   out = get_buffer('Multvar', shape, d_Model['Dtype']))
+        else:
+            nA_Multvar = generate_correlated_normals(l_rng, d_Model['Factor'], i_draw_end - i_draw_start,
+                                                     d_Model['NumTime'], d_Model['Dtype'],
+                                                     get_buffer('Rand', shape, d_Model['Dtype']),
+                                                     get_buffer('Multvar', shape, d_Model['Dtype']),
+                                                     d_Model.get('MMGroup') if d_Model.get('VarRed') == 'moment'
+                                                     else None)
+        # Rows of the simulations of the block
+        if nA_Sign is None:
+            nA_Multvar = nA_Multvar[nA_Pos[0]:nA_Pos[-1] + 1]
+        else:
+            nA_temp = get_buffer('Antithetic', (i_end - i_start,) + shape[1:], d_Model['Dtype'])
+            nA_Multvar = np.take(nA_Multvar, nA_Pos, axis = 0, out = nA_temp)
+            nA_Multvar *= nA_Sign.astype(nA_Multvar.dtype)[:, None, None]
+        d_Result = {}
+        n_stocks = len(d_Model['Vol'])
+        d_Variant = d_Model.get('Variant')
+        if d_Variant is not None:
+            # Stock shocks by output step, common to all the variants
+            l_step_out = d_Model['StepOut']
+            nA_ShockSum = np.add.reduceat(nA_Multvar[:, :l_step_out[-1], :n_stocks], l_step_out[:-1],
+                                          axis = 1, dtype = 'float64')
+        if d_Model.get('Shock', False):
+            # Standard normals by output step, before the stock paths overwrite the shocks
+            l_step_out = d_Model['StepOut']
+            d_Result['Shock'] = np.add.reduceat(nA_Multvar[:, :l_step_out[-1], :], l_step_out[:-1],
+                                                axis = 1, dtype = 'float64')
+            d_Result['Shock'] /= np.sqrt(np.diff(l_step_out))[None, :, None]
+    # Rates: shocks after the stocks
+    d_Rate = d_Model.get('Rate')
+    if d_Rate is not None:
+        with stage_timer('RatePaths', Block = i_start):
+            nA_Chi2 = None
+            if d_Rate['Model'] == 'CIR' and d_Rate['Scheme'] == 'exact':
+                # Drawn after the normals on the stream of each simulation
+                nA_Chi2 = np.stack([rng.chisquare(d_Rate['d'] - 1, size = (d_Model['NumTime'], len(d_Rate['d'])))
+                                    for rng in l_rng])[nA_Pos]
+            nA_Shock = nA_Multvar[:, :, n_stocks:n_stocks + len(d_Rate['a'])]
+            d_Result['Rate'] = simulate_rate_block(nA_Shock, d_Rate, d_Model['DeltaT'],
+                                                   d_Model['StepOut'], nA_Chi2)
+            # Variants with their own rates (Hull-White fitted on a shifted curve)
+            for i, d_Rate_Var in enumerate(d_Variant['Rate'] if d_Variant is not None else []):
+                if d_Rate_Var is not None:
+                    d_Result['Rate_' + d_Variant['Name'][i]] = simulate_rate_block(
+                        nA_Shock, d_Rate_Var, d_Model['DeltaT'], d_Model['StepOut'], nA_Chi2)
+    # Stocks: slice of the shocks (overwritten)
+    d_Result['StockVal'], d_Result['StockRet'] = simulate_stock_block(
+        nA_Multvar[:, :, 0:n_stocks], d_Model['Drift'], d_Model['Vol'],
+        d_Model['DeltaT'], d_Model['StepOut'])
+    if d_Variant is not None:
+        nA_Val, nA_Ret = simulate_stock_variants(nA_ShockSum, d_Variant['Drift'], d_Variant['Vol'],
+                                                 d_Model['DeltaT'], d_Model['StepOut'], d_Model['Dtype'])
+        for i, name in enumerate(d_Variant['Name']):
+            d_Result['StockVal_' + name], d_Result['StockRet_' + name] = nA_Val[i], nA_Ret[i]
+    return d_Result
+
+
+def run_block(d_Model, i_start, i_end):
+    '''
+    Calculate a block of simulations and export the results set in the model
+    ----------
+    d_Model : see simulate_scenarios, plus optionally
+        'Export' : dict by result name (see simulate_scenarios) of
+                   {'Type': 'Spool', 'Path': ...} - written in the spool slice
+                   {'Type': 'Store', 'Path': ...} - written in the store array slice
+                   {'Type': 'DB', 'Path': ..., 'Year': ..., 'Asset': ..., 'Column': ..., 'Format': ...}
+                   - written in a part file (see export_block_db and merge_parts)
+                   {'Type': None} - not returned
+                   with 'Keep': True the result is also returned
+    Returns the dict of results which are not exported
+    '''
+    d_Result = simulate_scenarios(d_Model, i_start, i_end)
+    for key, d_Export in d_Model.get('Export', {}).items():
+        nA_Result = d_Result[key] if d_Export.get('Keep', False) else d_Result.pop(key)
+        if d_Export['Type'] is None:
+            continue
+        with stage_timer('Export_' + d_Export['Type'], Block = i_start, Result = key):
+            if d_Export['Type'] == 'Spool':
+                nA_Spool = open_spool(d_Export['Path'])
+                nA_Spool[:, :, i_start:i_end] = nA_Result.transpose(2, 1, 0)
+                nA_Spool.flush()
+                del nA_Spool
+            elif d_Export['Type'] == 'Store':
+                nA_Array = np.lib.format.open_memmap(d_Export['Path'], mode = 'r+')
+                nA_Array[i_start:i_end] = nA_Result
+                nA_Array.flush()
+                del nA_Array
+            elif d_Export['Type'] == 'DB':
+                db_format = d_Export.get('Format', 'CSV')
+                export_block_db(nA_Result, i_start, d_Export['Year'], d_Export['Asset'],
+                                get_part_name(d_Export['Path'], i_start) if db_format == 'CSV'
+                                else d_Export['Path'], True, d_Export['Column'], db_format)
+            else:
+                raise ValueError('Unknown export type: ' + str(d_Export['Type']))
+    return d_Result
+
+
+def get_process_context():
+    '''
+    Start method of the process pools: fork where available (nothing re-run in the workers).
+    spawn re-runs the main script in each worker: it is only used if the main module is
+    interactive or protected by if __name__ == '__main__', None otherwise (run serially)
+    '''
+    if 'fork' in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context('fork')
+    path_main = getattr(sys.modules.get('__main__'), '__file__', None)
+    if path_main is not None:
+        try:
+            with open(path_main) as f:
+                b_guard = re.search(r'__name__\s*==\s*[\'"]__main__[\'"]', f.read()) is not None
+        except OSError:
+            b_guard = False
+        if not b_guard:
+            warnings.warn('No fork start method and the main script is not protected by '
+                          "if __name__ == '__main__': calculated in a single process", RuntimeWarning)
+            return None
+    return multiprocessing.get_context('spawn')
+
+
+_d_worker_model = {} # Simulation set up of the worker process
+
+
+def _init_worker(d_Model, t_report = (False, False, None)):
+    _d_worker_model.clear()
+    _d_worker_model.update(d_Model)
+    # Run report of the main process: stages kept and sent back with each block
+    _d_report.update({'Enabled': t_report[0], 'Memory': t_report[1], 'Start': t_report[2],
+                      'Worker': True, 'Stages': [], 'Stack': []})
+
+
+def _run_worker_block(t_block):
+    return run_block(_d_worker_model, t_block[0], t_block[1]), _pop_worker_stages()
+
+
+def run_blocks(d_Model, l_blocks, i_num_workers = 1):
+    '''
+    Calculate the blocks of simulations, in a pool of processes if i_num_workers > 1
+    ----------
+    d_Model : see run_block
+    l_blocks : list of (start, end) simulation bounds (see get_blocks)
+    i_num_workers : number of processes
+    Yields (start, end, result of run_block) in simulation order,
+    at most 2 blocks per worker are pending at any time to bound the memory
+    '''
+    mp_context = get_process_context() if i_num_workers is not None and i_num_workers > 1 else None
+    if mp_context is None:
+        for i_start, i_end in l_blocks:
+            yield i_start, i_end, run_block(d_Model, i_start, i_end)
+        return
+    t_report = (_d_report['Enabled'], _d_report['Memory'], _d_report['Start'])
+    with ProcessPoolExecutor(i_num_workers, mp_context = mp_context,
+                             initializer = _init_worker, initargs = (d_Model, t_report)) as executor:
+        l_todo = deque(l_blocks)
+        l_pending = deque()
+        while l_todo or l_pending:
+            while l_todo and len(l_pending) < 2 * i_num_workers:
+                t_block = l_todo.popleft()
+                l_pending.append((t_block, executor.submit(_run_worker_block, t_block)))
+            t_block, future = l_pending.popleft()
+            d_Result, l_Stages = future.result()
+            for d_Stage in l_Stages:
+                _add_stage(d_Stage)
+            yield t_block[0], t_block[1], d_Result
+
+
+def run_adaptive(d_Model, d_Conv, i_max_sim, i_batch, i_block_size = None, i_num_workers = 1):
+    '''
+    Calculate batches of simulations until the convergence target is met (see create_convergence)
+    ----------
+    d_Model : see run_block, 'StockVal' must be returned (not exported or 'Keep': True)
+    d_Conv : convergence monitor, updated in place ('NumSim', 'Error', 'Converged')
+    i_max_sim : maximum number of simulations
+    i_batch : simulations added between two checks (multiple of the antithetic pairs / matching groups)
+    i_block_size, i_num_workers : blocks of each batch and number of processes (see run_blocks)
+    Yields (start, end, result of run_block) in simulation order, as run_blocks
+    The checks are done at fixed numbers of simulations: the number of simulations used
+    only depends on the seed, not on the blocks nor on the number of workers
+    '''
+    i_start = 0
+    while i_start < i_max_sim and d_Conv['Converged'] == False:
+        i_end = min(i_start + i_batch, i_max_sim)
+        l_blocks = [(i_start + i, i_start + j) for i, j in get_blocks(i_end - i_start, i_block_size)]
+        for i_block_start, i_block_end, d_Result in run_blocks(d_Model, l_blocks, i_num_workers):
+            update_convergence(d_Conv, d_Result['StockVal'])
+            yield i_block_start, i_block_end, d_Result
+        d_Conv['NumSim'] = i_end
+        check_convergence(d_Conv)
+        i_start = i_end
+
+
+
+
 #%%#############################################################################
 ################## 1. TRANSFORM NUMPY SQUARE in PD LONG  #######################
 ################################################################################
 
 
 
+def get_db_columns(i_start, i_num_sim, l_step_year, l_stocks):
+    '''
+    Index columns ['Simulation', 'Year', 'Asset'] of simulations i_start to
+    i_start + i_num_sim - 1 in DB format, generated arithmetically
+    (same order as a flattened Sim * Time * Asset array)
+    '''
+    i_num_time, i_num_assets = len(l_step_year), len(l_stocks)
+    return {'Simulation': np.repeat(np.arange(i_start, i_start + i_num_sim), i_num_time * i_num_assets),
+            'Year': np.tile(np.repeat(np.asarray(l_step_year, dtype = 'float64'), i_num_assets), i_num_sim),
+            'Asset': np.tile(np.asarray(l_stocks, dtype = object), i_num_sim * i_num_time)}
+
+
+def export_block_db(nA_Ret, i_start, l_step_year, l_stocks, name_file, b_header, col_res = 'Return',
+                    db_format = 'CSV', i_chunk_sim = 50):
+    '''
+    Export a block of results (Sim * Time * Asset) in a DB format
+    with fields ['Simulation', 'Year', 'Asset', col_res]
+    ----------
+    i_start : 1st simulation of the block
+    b_header : write the header (and overwrite the file), otherwise append (CSV only)
+    db_format : 'CSV' - rows appended to the csv file name_file
+                'PARQUET' - part file of the block in the parquet dataset directory name_file
+                (one row group per chunk of simulations, requires pyarrow)
+    i_chunk_sim : number of simulations converted at once
+    '''
+    if db_format == 'PARQUET':
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        os.makedirs(name_file, exist_ok = True)
+        schema = pa.schema([('Simulation', pa.int64()), ('Year', pa.float64()),
+                            ('Asset', pa.string()), (col_res, pa.from_numpy_dtype(nA_Ret.dtype))])
+        with pq.ParquetWriter(os.path.join(name_file, 'part-%09d.parquet' % i_start), schema) as writer:
+            for i in range(0, nA_Ret.shape[0], i_chunk_sim):
+                nA_temp = nA_Ret[i:i + i_chunk_sim]
+                d_Col = get_db_columns(i_start + i, nA_temp.shape[0], l_step_year, l_stocks)
+                d_Col[col_res] = nA_temp.ravel()
+                writer.write_table(pa.table(d_Col, schema = schema))
+        return
+    if db_format != 'CSV':
+        raise ValueError('Unknown DB format: ' + str(db_format))
+    with open(name_file, 'w' if b_header else 'a', newline = '') as f:
+        for i in range(0, nA_Ret.shape[0], i_chunk_sim):
+            nA_temp = nA_Ret[i:i + i_chunk_sim]
+            dF_Ret = pd.DataFrame(get_db_columns(i_start + i, nA_temp.shape[0], l_step_year, l_stocks))
+            dF_Ret[col_res] = nA_temp.ravel()
+            dF_Ret.to_csv(f, index = False, header = b_header and i == 0)
+
+
+def get_part_name(name_file, i_start):
+    '''
+    Name of the part file of a block (see merge_parts)
+    '''
+    return name_file + '.part' + str(i_start)
+
+
+def merge_parts(name_file, l_blocks, b_header = True):
+    '''
+    Concatenate the part files of the blocks in simulation order and delete them
+    (header kept only from the 1st part if b_header)
+    '''
+    with open(name_file, 'wb') as f:
+        for i, (i_start, i_end) in enumerate(l_blocks):
+            name_part = get_part_name(name_file, i_start)
+            with open(name_part, 'rb') as f_part:
+                if b_header and i > 0:
+                    f_part.readline()
+                shutil.copyfileobj(f_part, f)
+            os.remove(name_part)
+
+
+def _read_matrix(input_type, path, sheet = None, dtype = 'float64'):
+    # Time * Simulation matrix of one asset (csv file or xlsx sheet), returned Sim * Time
+    if input_type == 'CSV':
+        dF_temp = pd.read_csv(path, index_col = 0)
+    else:
+        dF_temp = pd.read_excel(path, sheet, index_col = 0)
+    return dF_temp.index.to_numpy(), dF_temp.to_numpy(dtype = dtype).T
+
+
+def load_scenarios(input_type, path, l_assets = None, i_inputstep_length = 12, i_num_workers = 4,
+                   dtype = None):
+    '''
+    Load ESG returns in a Sim * Time * Asset array
+    ----------
+    input_type : 'CSV' - path is a dict {asset: csv file} (matrix Time * Simulation)
+                 'XLSX' - path is the xlsx file (one sheet per asset)
+                 'DB' - path is the csv file, or the parquet dataset directory
+                 'NPY' - path is the binary store directory (see load_store)
+    l_assets : assets to be loaded (None: all)
+    i_inputstep_length : output steps per year of matrix formats (12: month, 1: year)
+    i_num_workers : files (CSV) or sheets (XLSX) read concurrently
+    dtype : type of the returns, 'float32' or 'float64' (None: as stored for NPY, float64 otherwise)
+    Returns a dict with the returns ('Ret') and the axis labels ('Simulation', 'Year', 'Asset')
+    '''
+    if input_type in ['CSV', 'XLSX']:
+        if input_type == 'CSV':
+            l_assets = list(path.keys()) if l_assets is None else l_assets
+            l_args = [(input_type, path[asset], None, dtype or 'float64') for asset in l_assets]
+            # csv parsing releases the GIL: threads
+            Executor = ThreadPoolExecutor
+        else:
+            l_assets = pd.ExcelFile(path).sheet_names if l_assets is None else l_assets
+            l_args = [(input_type, path, asset, dtype or 'float64') for asset in l_assets]
+            # xlsx parsing is pure python: processes (forked, the calling script is not re-run)
+            Executor = ThreadPoolExecutor
+            if 'fork' in multiprocessing.get_all_start_methods():
+                Executor = partial(ProcessPoolExecutor, mp_context = multiprocessing.get_context('fork'))
+        with Executor(max(1, min(i_num_workers, len(l_args)))) as executor:
+            l_read = list(executor.map(_read_matrix, *zip(*l_args)))
+        nA_Ret = np.stack([nA_temp for _, nA_temp in l_read], axis = 2)
+        nA_Year = l_read[0][0] / i_inputstep_length
+        nA_Sim = np.arange(nA_Ret.shape[0])
+    elif input_type == 'DB':
+        if os.path.isdir(path):
+            dF_temp = pd.read_parquet(path)
+        else:
+            dF_temp = pd.read_csv(path)
+        col_res = [col for col in dF_temp.columns if col not in ['Simulation', 'Year', 'Asset']][0]
+        if l_assets is not None:
+            dF_temp = dF_temp.loc[dF_temp['Asset'].isin(l_assets)]
+        # Position of each row on the axes, then a single scatter
+        nA_SimPos, nA_Sim = pd.factorize(dF_temp['Simulation'], sort = True)
+        nA_YearPos, nA_Year = pd.factorize(dF_temp['Year'], sort = True)
+        nA_AssetPos, nA_Asset = pd.factorize(dF_temp['Asset'])
+        if l_assets is not None:
+            nA_AssetPos = pd.Index(l_assets).get_indexer(nA_Asset)[nA_AssetPos]
+            nA_Asset = l_assets
+        nA_Ret = np.full((len(nA_Sim), len(nA_Year), len(nA_Asset)), np.nan, dtype = dtype or 'float64')
+        nA_Ret[nA_SimPos, nA_YearPos, nA_AssetPos] = dF_temp[col_res].to_numpy()
+        nA_Sim, nA_Year, l_assets = np.asarray(nA_Sim), np.asarray(nA_Year), list(nA_Asset)
+    elif input_type == 'NPY':
+        d_Store = load_store(path)
+        l_store_assets = d_Store['Meta']['Arrays']['StockRet']['Asset']
+        l_assets = l_store_assets if l_assets is None else l_assets
+        nA_Ret = np.stack([select_store(d_Store, 'StockRet', asset) for asset in l_assets], axis = 2,
+                          dtype = dtype)
+        nA_Year = np.asarray(d_Store['Meta']['Arrays']['StockRet']['Year'])
+        nA_Sim = np.arange(nA_Ret.shape[0])
+    else:
+        raise ValueError('Unknown input type: ' + str(input_type))
+    return {'Ret': nA_Ret, 'Simulation': nA_Sim, 'Year': nA_Year, 'Asset': list(l_assets)}
+
+
+def calculate_prices(nA_Ret):
+    '''
+    Prices from returns (Sim * Time * Asset), starting from 1: price at the end
+    of each period, cumulative product along the time axis (accumulated in float64,
+    returned in the type of the returns)
+    '''
+    return np.cumprod(np.add(nA_Ret, 1, dtype = 'float64'), axis = 1).astype(nA_Ret.dtype, copy = False)
+
+
+def scenarios_to_long(d_Scen, key = 'Ret', col_res = 'Return'):
+    '''
+    Long DataFrame ['Year', 'Simulation', col_res, 'Asset'] from a Sim * Time * Asset
+    array of the scenarios (see load_scenarios), ordered by asset, simulation and year
+    '''
+    nA_temp = np.asarray(d_Scen[key]).transpose(2, 0, 1) # Asset * Sim * Time
+    i_num_assets, i_num_sim, i_num_time = nA_temp.shape
+    return pd.DataFrame({
+        'Year': np.tile(np.asarray(d_Scen['Year']), i_num_assets * i_num_sim),
+        'Simulation': np.tile(np.repeat(np.asarray(d_Scen['Simulation']), i_num_time), i_num_assets),
+        col_res: nA_temp.ravel(),
+        'Asset': np.repeat(np.asarray(d_Scen['Asset'], dtype = object), i_num_sim * i_num_time)})
+
+
+def export_matrix_csv(nA_Matrix, name_file, i_chunk_rows = 60):
+    '''
+    Export a Time * Simulation matrix to csv, by chunks of rows
+    (same layout as pd.DataFrame(nA_Matrix).to_csv)
+    ----------
+    nA_Matrix : nA (or memmap) of size Time * Simulation
+    name_file : path of the csv file
+    i_chunk_rows : number of time rows written at once
+    '''
+    with open(name_file, 'w', newline = '') as f:
+        for i in range(0, nA_Matrix.shape[0], i_chunk_rows):
+            dF_temp = pd.DataFrame(np.asarray(nA_Matrix[i:i + i_chunk_rows]),
+                                   index = np.arange(i, min(i + i_chunk_rows, nA_Matrix.shape[0])))
+            dF_temp.to_csv(f, header = (i == 0))
+
+
+# Workbooks written with xlsxwriter in constant memory mode: rows are streamed in order
+# (each row written once, released when the next one starts), same layout as
+# DataFrame.to_excel (bold bordered headers, panes frozen on the 1st row and column)
+d_xlsx_header = {'bold': True, 'border': 1, 'align': 'center', 'valign': 'top'}
+
+
+def open_workbook_xlsx(name_file):
+    '''
+    xlsxwriter workbook in constant memory mode and its header format
+    '''
+    import xlsxwriter
+    workbook = xlsxwriter.Workbook(name_file, {'constant_memory': True, 'nan_inf_to_errors': True})
+    return workbook, workbook.add_format(d_xlsx_header)
+
+
+def write_matrix_xlsx(worksheet, nA_Matrix, fmt_header, i_chunk_rows = 60):
+    '''
+    Write a Time * Simulation matrix row by row (row and column numbers as headers)
+    ----------
+    nA_Matrix : nA (or memmap, read by chunks of i_chunk_rows rows) of size Time * Simulation
+    '''
+    worksheet.write_row(0, 1, range(nA_Matrix.shape[1]), fmt_header)
+    for i in range(0, nA_Matrix.shape[0], i_chunk_rows):
+        for j, nA_Row in enumerate(np.asarray(nA_Matrix[i:i + i_chunk_rows], dtype = 'float64'), i):
+            worksheet.write_number(j + 1, 0, j, fmt_header)
+            worksheet.write_row(j + 1, 1, nA_Row.tolist())
+    worksheet.freeze_panes(1, 1)
+
+
+def write_frame_xlsx(worksheet, dF_Data, fmt_header):
+    '''
+    Write a Dataframe row by row, layout of DataFrame.to_excel (repeated column labels merged)
+    except the outer index labels: written on the 1st row of each group, not merged
+    '''
+    i_num_idx = dF_Data.index.nlevels
+    l_names = [name if name is not None else '' for name in dF_Data.index.names]
+    i_row = 0
+    if dF_Data.columns.nlevels > 1:
+        for level in range(dF_Data.columns.nlevels):
+            if dF_Data.columns.names[level] is not None:
+                worksheet.write(i_row, i_num_idx - 1, dF_Data.columns.names[level], fmt_header)
+            l_labels = list(dF_Data.columns.get_level_values(level))
+            j = 0
+            while j < len(l_labels):
+                k = j
+                while level < dF_Data.columns.nlevels - 1 and k + 1 < len(l_labels) and l_labels[k + 1] == l_labels[j]:
+                    k += 1
+                if k > j:
+                    worksheet.merge_range(i_row, i_num_idx + j, i_row, i_num_idx + k, l_labels[j], fmt_header)
+                else:
+                    worksheet.write(i_row, i_num_idx + j, l_labels[j], fmt_header)
+                j = k + 1
+            i_row += 1
+        if any(l_names):
+            worksheet.write_row(i_row, 0, l_names, fmt_header)
+            i_row += 1
+    else:
+        if any(l_names):
+            worksheet.write_row(i_row, 0, l_names, fmt_header)
+        worksheet.write_row(i_row, i_num_idx, list(dF_Data.columns), fmt_header)
+        i_row += 1
+    # Body (missing values left blank)
+    nA_Values = dF_Data.to_numpy(dtype = 'float64')
+    t_prev = None
+    for i, t_idx in enumerate(dF_Data.index):
+        t_idx = t_idx if isinstance(t_idx, tuple) else (t_idx,)
+        for level, val in enumerate(t_idx):
+            if level == i_num_idx - 1 or t_prev is None or t_idx[:level + 1] != t_prev[:level + 1]:
+                worksheet.write(i_row, level, val, fmt_header)
+        worksheet.write_row(i_row, i_num_idx, [None if np.isnan(val) else val for val in nA_Values[i].tolist()])
+        t_prev = t_idx
+        i_row += 1
+    worksheet.freeze_panes(1, 1)
+
+
+_d_worker_export = {} # Matrices exported by the worker processes
+
+
+def _init_worker_export(nA_Matrices):
+    _d_worker_export['Matrices'] = nA_Matrices
+
+
+def _export_worker_xlsx(t_asset):
+    i, asset, name_file = t_asset
+    export_matrix_xlsx(_d_worker_export['Matrices'][i:i + 1], [asset], name_file)
+    return name_file
+
+
+def export_matrix_xlsx(nA_Matrices, l_asset, name_file, i_num_workers = 1):
+    '''
+    Export Time * Simulation matrices to xlsx, one sheet per asset, streamed row by row
+    ----------
+    nA_Matrices : nA (or memmap) of size Asset * Time * Simulation (e.g. a spool, see create_spool)
+    l_asset : sheet names
+    name_file : path of the xlsx file, or list of paths: one workbook per asset,
+                written in parallel by i_num_workers processes
+    '''
+    if isinstance(name_file, (list, tuple)):
+        l_todo = [(i, asset, name) for i, (asset, name) in enumerate(zip(l_asset, name_file))]
+        # fork where available (the spool is shared), see get_process_context
+        mp_context = get_process_context() if i_num_workers is not None and i_num_workers > 1 else None
+        if mp_context is None:
+            return [export_matrix_xlsx(nA_Matrices[i:i + 1], [asset], name) for i, asset, name in l_todo]
+        with ProcessPoolExecutor(min(i_num_workers, len(l_todo)), mp_context = mp_context,
+                                 initializer = _init_worker_export, initargs = (nA_Matrices,)) as executor:
+            return list(executor.map(_export_worker_xlsx, l_todo))
+    workbook, fmt_header = open_workbook_xlsx(name_file)
+    for i, asset in enumerate(l_asset):
+        write_matrix_xlsx(workbook.add_worksheet(asset), nA_Matrices[i], fmt_header)
+    workbook.close()
+    return name_file
+
+
 
 
 
@@ -23,57 +1265,1098 @@ import numpy as np
 
 
 
-def calculate_percentile(dF_data, list_agg, col_res, list_percentile):
+def calculate_stats(nA_Data, l_quantile, i_step = None, i_block_time = 60):
+    '''
+    Percentiles, mean and vol along the simulation axis of a Sim * Time * Asset array
+    ----------
+    nA_Data : nA (or memory map) of size Sim * Time * Asset
+    l_quantile : list of percentiles
+    i_step : steps per year to annualise the vol (None: no vol)
+    i_block_time : time steps processed at once (bounds the memory used)
+    Returns a dict of nA: 'Quantile' (Quantile * Time * Asset), 'Mean' and 'Vol' (Time * Asset)
+    '''
+    i_num_sim, i_num_time, i_num_assets = nA_Data.shape
+    d_Stats = {'Quantile': np.empty((len(l_quantile), i_num_time, i_num_assets)),
+               'Mean': np.empty((i_num_time, i_num_assets))}
+    if i_step is not None:
+        d_Stats['Vol'] = np.empty((i_num_time, i_num_assets))
+    for i in range(0, i_num_time, i_block_time):
+        nA_temp = np.asarray(nA_Data[:, i:i + i_block_time, :], dtype = 'float64')
+        d_Stats['Mean'][i:i + i_block_time] = nA_temp.mean(axis = 0)
+        if i_step is not None:
+            d_Stats['Vol'][i:i + i_block_time] = nA_temp.std(axis = 0, ddof = 1) * np.sqrt(i_step)
+        d_Stats['Quantile'][:, i:i + i_block_time] = np.quantile(nA_temp, l_quantile, axis = 0)
+    return d_Stats
+
+
+def describe_scenarios(d_Scen, key, col_res, l_quantile, by_year = True, i_step = None):
+    '''
+    Percentiles, mean and vol of the scenarios (see load_scenarios) in one pass:
+    the percentiles (Indicator being the percentile), then 'Mean' and 'Vol' (if i_step)
+    by Asset (sorted) and Year
+    ----------
+    d_Scen : dict of Sim * Time * Asset arrays and axis labels
+    key : array to be analysed ('Ret', 'Val')
+    col_res : name of the result column
+    l_quantile : list of percentiles
+    by_year : if True by Asset and Year, otherwise by Asset (all years together)
+    i_step : steps per year to annualise the vol (None: no vol)
+    Returns a Dataframe indexed by Asset, (Year,) Indicator
+    '''
+    nA_Data = d_Scen[key]
+    l_year = list(d_Scen['Year'])
+    if not by_year:
+        nA_Data = np.asarray(nA_Data).reshape(-1, 1, nA_Data.shape[2])
+        l_year = [None]
+    d_Stats = calculate_stats(nA_Data, l_quantile, i_step)
+    return stats_to_frame(d_Stats, d_Scen['Asset'], l_year, l_quantile, col_res, by_year)
+
+
+def stats_to_frame(d_Stats, l_asset, l_year, l_quantile, col_res, by_year = True):
+    '''
+    Dataframe of the statistics (see calculate_stats) indexed by Asset, (Year,) Indicator:
+    percentiles, then mean and vol, assets sorted as in a groupby
+    '''
+    l_pos = [list(l_asset).index(asset) for asset in sorted(l_asset)]
+    l_asset = sorted(l_asset)
+    i_num_time = len(l_year)
+    # Percentiles (by Asset, Year, Percentile) then Mean and Vol (by Asset, Year)
+    l_frames = []
+    nA_temp = d_Stats['Quantile'][:, :, l_pos].transpose(2, 1, 0)
+    l_frames.append(({'Asset': np.repeat(l_asset, i_num_time * len(l_quantile)),
+                      'Year': np.tile(np.repeat(l_year, len(l_quantile)), len(l_asset)),
+                      'Indicator': np.tile(np.asarray(l_quantile, dtype = object), len(l_asset) * i_num_time)},
+                     nA_temp.ravel()))
+    for indicator in ['Mean', 'Vol']:
+        if indicator in d_Stats:
+            l_frames.append(({'Asset': np.repeat(l_asset, i_num_time),
+                              'Year': np.tile(l_year, len(l_asset)),
+                              'Indicator': np.repeat(np.asarray([indicator], dtype = object),
+                                                     len(l_asset) * i_num_time)},
+                             d_Stats[indicator][:, l_pos].T.ravel()))
+    dF_Result = pd.concat([pd.DataFrame(dict(d_Index, **{col_res: nA_Values}))
+                           for d_Index, nA_Values in l_frames], axis = 0)
+    if not by_year:
+        return dF_Result.drop(columns = 'Year').set_index(['Asset', 'Indicator'])
+    return dF_Result.set_index(['Asset', 'Year', 'Indicator'])
+
+
+def export_analysis(name_file, dF_Global_StockRet, dF_Period_StockVal, dF_Period_StockRet):
+    '''
+    Analysis workbook: global returns, prices and returns by year (one column per year)
+    '''
+    # Setup excel writer (streamed, see write_frame_xlsx)
+    workbook, fmt_header = open_workbook_xlsx(name_file)
+    write_frame_xlsx(workbook.add_worksheet('Global_Stock'), dF_Global_StockRet, fmt_header)
+    write_frame_xlsx(workbook.add_worksheet('Year_Stock_Val'), dF_Period_StockVal.unstack(level="Year"), fmt_header)
+    write_frame_xlsx(workbook.add_worksheet('Year_Stock_Ret'), dF_Period_StockRet.unstack(level="Year"), fmt_header)
+    # Close writer
+    workbook.close()
+
+
+# -----------------------------------------------------------------------------#
+# ------------------ Streaming statistics -------------------------------------#
+# -----------------------------------------------------------------------------#
+# Statistics collected block by block while the simulations are generated:
+# exact running mean / variance (Chan et al. merge) and fixed bin histograms
+# in log space (log(1 + return) or log(price)) for the percentiles.
+# Accumulators with the same bins are merged in any order (blocks, workers, runs).
+
+# Default histogram ranges in log space: bin width = range / number of bins, values outside
+# fall in the underflow / overflow bins (percentiles there interpolated up to the exact min / max)
+# (returns: by asset from the model with get_sketch_range, finer for low vol assets)
+d_sketch_range = {'Return': (-1, 1), # log(1 + return): returns from -63% to +172% by output step
+                  'Price': (-8, 8)} # log(price): prices from 0.0003 to 2981 times the start value
+
+
+def get_sketch_edges(d_min, d_max, i_num_bins):
+    '''
+    Bin edges of the percentile histograms (log space), values outside are
+    counted in an underflow / overflow bin bounded by the exact min / max
+    (d_min / d_max by asset: edges of size Asset * Bins + 1, see get_sketch_range)
+    '''
+    return np.linspace(d_min, d_max, i_num_bins + 1, axis = -1)
+
+
+def get_sketch_range(nA_Drift, nA_Vol, d_step, d_num_sd = 8):
+    '''
+    Histogram range by asset of the returns over an output step (log(1 + return)),
+    from the input model: log drift of the steps +/- d_num_sd standard deviations
+    ----------
+    nA_Drift : log drift of each output step (Time * Asset)
+    nA_Vol : volatility by asset
+    d_step : length of an output step (years)
+    Returns the lower and upper bounds (nA of size Asset), for get_sketch_edges
+    '''
+    nA_Width = d_num_sd * np.asarray(nA_Vol, dtype = 'float64') * np.sqrt(d_step)
+    return np.min(nA_Drift, axis = 0) - nA_Width, np.max(nA_Drift, axis = 0) + nA_Width
+
+
+def create_accumulator(i_num_time, i_num_assets, nA_Edges, space = 'Return'):
+    '''
+    Empty statistics accumulator of size Time * Asset
+    ----------
+    nA_Edges : bin edges in log space, common or by asset (see get_sketch_edges)
+    space : 'Return' (histogram of log(1 + x)) or 'Price' (histogram of log(x))
+    '''
+    return {'Space': space, 'Edges': np.asarray(nA_Edges, dtype = 'float64'), 'Count': 0,
+            'Mean': np.zeros((i_num_time, i_num_assets)), 'M2': np.zeros((i_num_time, i_num_assets)),
+            'Min': np.full((i_num_time, i_num_assets), np.inf),
+            'Max': np.full((i_num_time, i_num_assets), -np.inf),
+            'Hist': np.zeros((i_num_time, i_num_assets, np.shape(nA_Edges)[-1] + 1), dtype = 'int64')}
+
+
+def _merge_moments(d_Acc, i_count, nA_Mean, nA_M2):
+    # Chan et al. pairwise update of count, mean and sum of squared deviations
+    i_total = d_Acc['Count'] + i_count
+    if i_total == 0:
+        return
+    nA_Delta = nA_Mean - d_Acc['Mean']
+    d_Acc['M2'] += nA_M2 + nA_Delta ** 2 * (d_Acc['Count'] * i_count / i_total)
+    d_Acc['Mean'] += nA_Delta * (i_count / i_total)
+    d_Acc['Count'] = i_total
+
+
+def update_accumulator(d_Acc, nA_Data):
+    '''
+    Add a block of simulations (nA of size Sim * Time * Asset) to the accumulator
+    '''
+    nA_Data = np.asarray(nA_Data, dtype = 'float64')
+    if nA_Data.shape[0] == 0:
+        return d_Acc
+    nA_Mean = nA_Data.mean(axis = 0)
+    _merge_moments(d_Acc, nA_Data.shape[0], nA_Mean, ((nA_Data - nA_Mean) ** 2).sum(axis = 0))
+    np.minimum(d_Acc['Min'], nA_Data.min(axis = 0), out = d_Acc['Min'])
+    np.maximum(d_Acc['Max'], nA_Data.max(axis = 0), out = d_Acc['Max'])
+    # Histogram: bin of each value, counted at once on the flattened Time * Asset * Bin
+    nA_Log = np.log1p(nA_Data) if d_Acc['Space'] == 'Return' else np.log(nA_Data)
+    i_num_bins = d_Acc['Hist'].shape[2]
+    if d_Acc['Edges'].ndim == 1:
+        nA_Bin = np.searchsorted(d_Acc['Edges'], nA_Log, side = 'right')
+    else:
+        nA_Bin = np.stack([np.searchsorted(nA_Edge, nA_Log[..., k], side = 'right')
+                           for k, nA_Edge in enumerate(d_Acc['Edges'])], axis = -1)
+    nA_Bin += np.arange(nA_Bin[0].size).reshape(nA_Bin.shape[1:]) * i_num_bins
+    d_Acc['Hist'] += np.bincount(nA_Bin.ravel(), minlength = d_Acc['Hist'].size).reshape(d_Acc['Hist'].shape)
+    return d_Acc
+
+
+def merge_accumulator(d_Acc, d_Other):
+    '''
+    Merge d_Other in d_Acc (same size and bins), e.g. the accumulators of several workers
+    '''
+    if not np.array_equal(d_Acc['Edges'], d_Other['Edges']) or d_Acc['Space'] != d_Other['Space']:
+        raise ValueError('Accumulators with different bins cannot be merged')
+    _merge_moments(d_Acc, d_Other['Count'], d_Other['Mean'], d_Other['M2'])
+    np.minimum(d_Acc['Min'], d_Other['Min'], out = d_Acc['Min'])
+    np.maximum(d_Acc['Max'], d_Other['Max'], out = d_Acc['Max'])
+    d_Acc['Hist'] += d_Other['Hist']
+    return d_Acc
+
+
+def collapse_accumulator(d_Acc):
+    '''
+    Accumulator of all the time steps together (size 1 * Asset)
+    '''
+    i_num_time = d_Acc['Mean'].shape[0]
+    nA_Mean = d_Acc['Mean'].mean(axis = 0, keepdims = True)
+    return {'Space': d_Acc['Space'], 'Edges': d_Acc['Edges'], 'Count': d_Acc['Count'] * i_num_time,
+            'Mean': nA_Mean,
+            'M2': (d_Acc['M2'] + d_Acc['Count'] * (d_Acc['Mean'] - nA_Mean) ** 2).sum(axis = 0, keepdims = True),
+            'Min': d_Acc['Min'].min(axis = 0, keepdims = True),
+            'Max': d_Acc['Max'].max(axis = 0, keepdims = True),
+            'Hist': d_Acc['Hist'].sum(axis = 0, keepdims = True)}
+
+
+def calculate_stats_accumulator(d_Acc, l_quantile, i_step = None, i_block_time = 60):
+    '''
+    Same statistics as calculate_stats from an accumulator, the percentiles are
+    interpolated in the histogram bins (values spread evenly in each bin)
+    '''
+    i_num_time, i_num_assets = d_Acc['Mean'].shape
+    d_Stats = {'Quantile': np.empty((len(l_quantile), i_num_time, i_num_assets)),
+               'Mean': d_Acc['Mean'].copy()}
+    if i_step is not None:
+        d_Stats['Vol'] = np.sqrt(d_Acc['M2'] / (d_Acc['Count'] - 1)) * np.sqrt(i_step)
+    # Position of the percentile (centre of the value of rank q * (n - 1))
+    nA_Pos = np.asarray(l_quantile) * (d_Acc['Count'] - 1) + 0.5
+    for i in range(0, i_num_time, i_block_time):
+        nA_Hist = d_Acc['Hist'][i:i + i_block_time]
+        nA_Min = np.log1p(d_Acc['Min'][i:i + i_block_time]) if d_Acc['Space'] == 'Return' \
+            else np.log(d_Acc['Min'][i:i + i_block_time])
+        nA_Max = np.log1p(d_Acc['Max'][i:i + i_block_time]) if d_Acc['Space'] == 'Return' \
+            else np.log(d_Acc['Max'][i:i + i_block_time])
+        # Bounds of the bins (underflow and overflow bounded by the min / max)
+        nA_Lower = np.concatenate([nA_Min[..., None],
+                                   np.broadcast_to(d_Acc['Edges'], nA_Hist.shape[:2] + d_Acc['Edges'].shape[-1:])],
+                                  axis = 2)
+        nA_Upper = np.concatenate([nA_Lower[..., 1:], nA_Max[..., None]], axis = 2)
+        nA_Lower = np.clip(nA_Lower, nA_Min[..., None], nA_Max[..., None])
+        nA_Upper = np.clip(nA_Upper, nA_Min[..., None], nA_Max[..., None])
+        nA_Cum = np.cumsum(nA_Hist, axis = 2)
+        for j, d_pos in enumerate(nA_Pos):
+            nA_Bin = (nA_Cum <= d_pos).sum(axis = 2, keepdims = True)
+            nA_Bin = np.minimum(nA_Bin, nA_Hist.shape[2] - 1)
+            nA_Count = np.take_along_axis(nA_Hist, nA_Bin, axis = 2)[..., 0]
+            nA_Before = np.take_along_axis(nA_Cum, nA_Bin, axis = 2)[..., 0] - nA_Count
+            nA_Low = np.take_along_axis(nA_Lower, nA_Bin, axis = 2)[..., 0]
+            nA_Up = np.take_along_axis(nA_Upper, nA_Bin, axis = 2)[..., 0]
+            nA_Frac = np.clip((d_pos - nA_Before) / np.maximum(nA_Count, 1), 0, 1)
+            nA_Log = nA_Low + nA_Frac * (nA_Up - nA_Low)
+            d_Stats['Quantile'][j, i:i + i_block_time] = np.expm1(nA_Log) if d_Acc['Space'] == 'Return' \
+                else np.exp(nA_Log)
+    return d_Stats
+
+
+def describe_accumulator(d_Acc, l_asset, l_year, col_res, l_quantile, by_year = True, i_step = None):
+    '''
+    Percentiles, mean and vol from an accumulator, same layout as describe_scenarios
+    '''
+    if not by_year:
+        d_Acc = collapse_accumulator(d_Acc)
+        l_year = [None]
+    d_Stats = calculate_stats_accumulator(d_Acc, l_quantile, i_step)
+    return stats_to_frame(d_Stats, l_asset, list(l_year), l_quantile, col_res, by_year)
+
+
+# -----------------------------------------------------------------------------#
+# ------------------ Convergence ----------------------------------------------#
+# -----------------------------------------------------------------------------#
+# Relative standard errors of the discounted stock prices by output step and asset,
+# from accumulators: mean (std / sqrt(n)) and percentiles (sqrt(p (1 - p) / n) / density,
+# the density estimated from the percentiles at p - h and p + h, h = n^(-1/3))
+
+def create_convergence(nA_Discount, i_num_assets, d_tol, l_quantile = [], i_num_bins = 4000, b_pairs = False,
+                       t_range = d_sketch_range['Price']):
+    '''
+    Convergence monitor of the discounted stock prices (see run_adaptive)
+    ----------
+    nA_Discount : discount factors of the output steps after time 0
+    i_num_assets : number of stocks
+    d_tol : target relative standard error, on all the output steps and stocks
+    l_quantile : percentiles also checked (histograms of i_num_bins bins)
+    b_pairs : antithetic pairs, the error of the mean is the one of the pair averages
+    t_range : log(price) range of the histograms (see d_sketch_range)
+    With quasi Monte Carlo or moment matching the errors are those of independent draws (prudent)
+    '''
+    nA_Discount = np.asarray(nA_Discount, dtype = 'float64')
+    nA_Edges = get_sketch_edges(t_range[0], t_range[1], i_num_bins if len(l_quantile) > 0 else 1)
+    d_Conv = {'Discount': nA_Discount, 'Tol': d_tol, 'Quantile': list(l_quantile),
+              'Acc': create_accumulator(len(nA_Discount), i_num_assets, nA_Edges, 'Price'),
+              'NumSim': 0, 'Error': np.inf, 'Converged': False}
+    if b_pairs:
+        d_Conv['AccPair'] = create_accumulator(len(nA_Discount), i_num_assets,
+                                              get_sketch_edges(t_range[0], t_range[1], 1), 'Price')
+    return d_Conv
+
+
+def update_convergence(d_Conv, nA_StockVal):
+    '''
+    Add a block of stock values (Sim * Time * Asset, from time 0) to the convergence monitor
+    '''
+    nA_Price = nA_StockVal[:, 1:] * d_Conv['Discount'][None, :, None]
+    update_accumulator(d_Conv['Acc'], nA_Price)
+    if 'AccPair' in d_Conv:
+        # Blocks start on a pair, an incomplete last pair is left out
+        i_num = nA_Price.shape[0] // 2 * 2
+        update_accumulator(d_Conv['AccPair'], (nA_Price[0:i_num:2] + nA_Price[1:i_num:2]) / 2)
+    return d_Conv
+
+
+def calculate_std_error(d_Acc, l_quantile = [], d_AccMean = None):
+    '''
+    Relative standard errors from an accumulator of positive values
+    ----------
+    l_quantile : percentiles (the accumulator needs a histogram)
+    d_AccMean : optional accumulator for the error of the mean (e.g. antithetic pair averages)
+    Returns a dict 'Mean' (Time * Asset) and 'Quantile' (Quantile * Time * Asset)
+    '''
+    d_AccMean = d_Acc if d_AccMean is None else d_AccMean
+    i_count = d_AccMean['Count']
+    d_Error = {'Mean': np.sqrt(d_AccMean['M2'] / max(i_count - 1, 1) / max(i_count, 1)) / np.abs(d_AccMean['Mean'])}
+    nA_Q = np.asarray(l_quantile, dtype = 'float64')
+    d_Error['Quantile'] = np.empty((0,) + d_Error['Mean'].shape)
+    if len(nA_Q) > 0:
+        i_count = d_Acc['Count']
+        nA_h = np.minimum(i_count ** (-1 / 3), np.minimum(nA_Q, 1 - nA_Q) / 2)
+        d_Stats = calculate_stats_accumulator(d_Acc, np.concatenate([nA_Q, nA_Q - nA_h, nA_Q + nA_h]))
+        nA_Val, nA_Low, nA_Up = np.split(d_Stats['Quantile'], 3)
+        d_Error['Quantile'] = ((np.sqrt(nA_Q * (1 - nA_Q) / i_count) / (2 * nA_h))[:, None, None]
+                               * (nA_Up - nA_Low) / np.abs(nA_Val))
+    return d_Error
+
+
+def check_convergence(d_Conv):
+    '''
+    Standard errors of the simulations added so far ('ErrorMean', 'ErrorQuantile'), their
+    maximum ('Error') and whether it is within the tolerance ('Converged')
+    '''
+    if d_Conv['Acc']['Count'] < 2:
+        return d_Conv
+    d_Error = calculate_std_error(d_Conv['Acc'], d_Conv['Quantile'], d_Conv.get('AccPair'))
+    d_Conv['ErrorMean'], d_Conv['ErrorQuantile'] = d_Error['Mean'], d_Error['Quantile']
+    d_Conv['Error'] = max(d_Error['Mean'].max(), d_Error['Quantile'].max(initial = 0))
+    d_Conv['Converged'] = bool(d_Conv['Error'] <= d_Conv['Tol'])
+    return d_Conv
+
+
+def describe_convergence(d_Conv, l_asset):
+    '''
+    Maximum relative standard error over the output steps, by stock (mean and percentiles)
+    '''
+    dF_Conv = pd.DataFrame({'Mean': d_Conv['ErrorMean'].max(axis = 0)}, index = pd.Index(l_asset, name = 'Asset'))
+    for j, d_q in enumerate(d_Conv['Quantile']):
+        dF_Conv[d_q] = d_Conv['ErrorQuantile'][j].max(axis = 0)
+    return dF_Conv
+
+
+# -----------------------------------------------------------------------------#
+# ------------------ Validation -----------------------------------------------#
+# -----------------------------------------------------------------------------#
+# Consistency of the generated arrays with the model, block by block:
+# - Mean: mean stock value / expected value (drift of the model, i.e. forward curve
+#   minus dividend if risk neutral) by output step, target 1
+# - Vol: realised vol of the log returns by output step, target the input vol
+# - Correl: realised correlation of the shocks (all output steps), target nA_Correlation
+# Each test with its Monte Carlo standard error, failed if |z| is above the critical
+# value of the test family (Bonferroni: probability alpha of a false failure by family)
+
+def get_expected_values(d_Model):
+    '''
+    Expected stock values at the output steps after time 0 (size Time * Stock),
+    E(S_t) = exp(sum of the 1st B&S term + vol^2 / 2 t), see simulate_scenarios for d_Model
+    '''
+    l_step_out = d_Model['StepOut']
+    nA_LogDrift = np.add.reduceat(d_Model['Drift'][:l_step_out[-1]], l_step_out[:-1], axis = 0)
+    nA_Time = np.diff(l_step_out) * d_Model['DeltaT']
+    nA_Var = np.square(np.asarray(d_Model['Vol'], dtype = 'float64'))[None, :] * nA_Time[:, None]
+    return np.exp(np.cumsum(nA_LogDrift + nA_Var / 2, axis = 0))
+
+
+def _create_moments(shape):
+    return {'Count': 0, 'Mean': np.zeros(shape), 'M2': np.zeros(shape)}
+
+
+def _update_moments(d_Mom, nA_Data):
+    # Running mean and sum of squared deviations on the 1st axis (see _merge_moments)
+    if nA_Data.shape[0] > 0:
+        nA_Data = np.asarray(nA_Data, dtype = 'float64')
+        nA_Mean = nA_Data.mean(axis = 0)
+        _merge_moments(d_Mom, nA_Data.shape[0], nA_Mean, ((nA_Data - nA_Mean) ** 2).sum(axis = 0))
+
+
+def create_validation(d_Model, nA_Correlation, d_alpha = 0.01):
+    '''
+    Empty validation of the scenarios of a model (see update_validation and describe_validation)
+    ----------
+    d_Model : simulation set up (see simulate_scenarios), with 'Shock': True the correlations
+              are tested on all the factors, otherwise on the stocks only (from the returns)
+    nA_Correlation : input correlation matrix (stocks then rates)
+    d_alpha : probability of a false failure by test family
+    Antithetic pairs: errors of the mean from the pair averages, vol and correlation
+    on half the draws. Quasi Monte Carlo, moment matching: errors of independent draws (prudent)
+    '''
+    l_step_out = d_Model['StepOut']
+    i_num_out, n_stocks = len(l_step_out) - 1, len(d_Model['Vol'])
+    nA_Time = np.diff(l_step_out) * d_Model['DeltaT']
+    d_Valid = {'ExpVal': get_expected_values(d_Model), 'Vol': np.asarray(d_Model['Vol'], dtype = 'float64'),
+               'Time': nA_Time, 'Correlation': np.asarray(nA_Correlation, dtype = 'float64'),
+               'LogDrift': np.add.reduceat(d_Model['Drift'][:l_step_out[-1]], l_step_out[:-1], axis = 0),
+               'Alpha': d_alpha, 'Pairs': d_Model.get('VarRed') == 'antithetic',
+               'Val': _create_moments((i_num_out, n_stocks)), 'LogRet': _create_moments((i_num_out, n_stocks)),
+               'Shock': None}
+    if d_Valid['Pairs']:
+        d_Valid['ValPair'] = _create_moments((i_num_out, n_stocks))
+    return d_Valid
+
+
+def update_validation(d_Valid, d_Result):
+    '''
+    Add a block of results (see simulate_scenarios: 'StockVal', 'StockRet' and optionally 'Shock')
+    '''
+    nA_Val = d_Result['StockVal'][:, 1:] / d_Valid['ExpVal'][None, :, :]
+    _update_moments(d_Valid['Val'], nA_Val)
+    if d_Valid['Pairs']:
+        # Blocks start on a pair, an incomplete last pair is left out
+        i_num = nA_Val.shape[0] // 2 * 2
+        _update_moments(d_Valid['ValPair'], (nA_Val[0:i_num:2] + nA_Val[1:i_num:2]) / 2)
+    nA_LogRet = np.log1p(np.asarray(d_Result['StockRet'], dtype = 'float64'))
+    _update_moments(d_Valid['LogRet'], nA_LogRet)
+    # Shocks of all the output steps together (independent increments)
+    if 'Shock' in d_Result:
+        nA_Shock = d_Result['Shock']
+    else:
+        nA_Shock = (nA_LogRet - d_Valid['LogDrift'][None]) / \
+            (d_Valid['Vol'][None, :] * np.sqrt(d_Valid['Time'])[:, None])[None]
+    nA_Shock = nA_Shock.reshape(-1, nA_Shock.shape[2])
+    if d_Valid['Shock'] is None:
+        d_Valid['Shock'] = {'Count': 0, 'Mean': np.zeros(nA_Shock.shape[1]),
+                            'M2': np.zeros((nA_Shock.shape[1], nA_Shock.shape[1]))}
+    # Co-moments merged as the moments (Chan et al.)
+    d_Shock = d_Valid['Shock']
+    i_count, i_total = nA_Shock.shape[0], d_Shock['Count'] + nA_Shock.shape[0]
+    nA_Mean = nA_Shock.mean(axis = 0)
+    nA_Delta = nA_Mean - d_Shock['Mean']
+    nA_Dev = nA_Shock - nA_Mean
+    d_Shock['M2'] += nA_Dev.T @ nA_Dev + np.outer(nA_Delta, nA_Delta) * (d_Shock['Count'] * i_count / i_total)
+    d_Shock['Mean'] += nA_Delta * (i_count / i_total)
+    d_Shock['Count'] = i_total
+    return d_Valid
+
+
+def describe_validation(d_Valid, l_asset, l_year, l_factor = None):
+    '''
+    Tests of the validation in a Dataframe: 'Check' ('Mean', 'Vol', 'Correl'), 'Asset', 'Asset2'
+    (correlations), 'Year' (end of the output step), 'Value', 'Target', 'StdError', 'ZScore', 'Pass'
+    ----------
+    l_asset : stocks
+    l_year : years of the output steps after time 0
+    l_factor : stocks then rates (names of the correlation factors, default: l_asset)
+    '''
+    l_factor = list(l_asset if l_factor is None else l_factor)
+    l_Frame = []
+    def add_check(check, nA_Value, nA_Target, nA_Error, d_Axes):
+        dF_temp = pd.DataFrame(dict(d_Axes, Value = nA_Value.ravel(), Target = nA_Target.ravel(),
+                                    StdError = nA_Error.ravel()))
+        dF_temp.insert(0, 'Check', check)
+        l_Frame.append(dF_temp)
+    nA_Year, nA_Asset = np.repeat(np.asarray(l_year), len(l_asset)), np.tile(np.asarray(l_asset), len(l_year))
+    # Mean value / expected value
+    d_Mean = d_Valid.get('ValPair', d_Valid['Val'])
+    i_count = d_Mean['Count']
+    add_check('Mean', d_Valid['Val']['Mean'], np.ones_like(d_Mean['Mean']),
+              np.sqrt(d_Mean['M2'] / max(i_count - 1, 1) / max(i_count, 1)),
+              {'Asset': nA_Asset, 'Year': nA_Year})
+    # Vol of the log returns (standard error of a normal sample)
+    d_LogRet = d_Valid['LogRet']
+    i_count = d_LogRet['Count'] // 2 if d_Valid['Pairs'] else d_LogRet['Count']
+    nA_Vol = np.sqrt(d_LogRet['M2'] / max(d_LogRet['Count'] - 1, 1) / d_Valid['Time'][:, None])
+    add_check('Vol', nA_Vol, np.broadcast_to(d_Valid['Vol'], nA_Vol.shape),
+              nA_Vol / np.sqrt(2 * max(i_count - 1, 1)), {'Asset': nA_Asset, 'Year': nA_Year})
+    # Correlations (upper triangle)
+    d_Shock = d_Valid['Shock']
+    if d_Shock is not None:
+        n_factors = d_Shock['M2'].shape[0]
+        i_count = d_Shock['Count'] // 2 if d_Valid['Pairs'] else d_Shock['Count']
+        nA_Std = np.sqrt(np.diag(d_Shock['M2']))
+        nA_Correl = d_Shock['M2'] / np.outer(nA_Std, nA_Std)
+        nA_i, nA_j = np.triu_indices(n_factors, 1)
+        add_check('Correl', nA_Correl[nA_i, nA_j], d_Valid['Correlation'][nA_i, nA_j],
+                  (1 - np.square(nA_Correl[nA_i, nA_j])) / np.sqrt(max(i_count - 1, 1)),
+                  {'Asset': np.asarray(l_factor[:n_factors])[nA_i], 'Asset2': np.asarray(l_factor[:n_factors])[nA_j]})
+    dF_Valid = pd.concat(l_Frame, ignore_index = True)[['Check', 'Asset', 'Asset2', 'Year', 'Value', 'Target',
+                                                         'StdError']]
+    dF_Valid['ZScore'] = (dF_Valid['Value'] - dF_Valid['Target']) / dF_Valid['StdError']
+    # Critical value by test family
+    dF_Valid['Critical'] = dF_Valid.groupby('Check')['Check'].transform(
+        lambda sR: NormalDist().inv_cdf(1 - d_Valid['Alpha'] / (2 * len(sR))))
+    dF_Valid['Pass'] = dF_Valid['ZScore'].abs() <= dF_Valid['Critical']
+    return dF_Valid
+
+
+def summarize_validation(dF_Valid):
+    '''
+    Validation by test family: number of tests and failures, largest |z| and critical value
+    '''
+    dF_temp = dF_Valid.assign(AbsZ = dF_Valid['ZScore'].abs(), Failed = ~dF_Valid['Pass'])
+    dF_Sum = dF_temp.groupby('Check', sort = False).agg(Tests = ('Pass', 'size'), Failed = ('Failed', 'sum'),
+                                                        MaxAbsZ = ('AbsZ', 'max'), Critical = ('Critical', 'first'))
+    dF_Sum['Pass'] = dF_Sum['Failed'] == 0
+    return dF_Sum
+
+
+#%%#############################################################################
+############################# 3. SCENARIO STORE  ###############################
+################################################################################
+# Directory with one .npy file per array (Sim * Time * Asset) and a JSON header
+# Arrays are read back as memory maps: one asset or one period can be read
+# without loading the whole file
+
+
+
+def _json_default(obj):
+    # numpy and pandas types in the store header
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, pd.DataFrame):
+        return obj.reset_index().to_dict(orient = 'list')
+    raise TypeError('Not serialisable in the store header: ' + str(type(obj)))
+
+
+def write_meta(name_file, d_Meta):
     '''
-    Calculate the mean and percentile on a flat ESG file
+    Write run information (seed, random generation, variance reduction, parameters...)
+    to a JSON file
+    '''
+    with open(name_file, 'w') as f:
+        json.dump(d_Meta, f, default = _json_default, indent = 1)
+
+
+def write_store_meta(path_store, d_Meta):
+    '''
+    Write the JSON header of the store
+    '''
+    write_meta(os.path.join(path_store, 'meta.json'), d_Meta)
+
+
+def create_store(path_store, d_Layout, d_Meta, i_num_sim):
+    '''
+    Create a binary scenario store, to be filled by blocks of simulations
+    ----------
+    path_store : directory of the store
+    d_Layout : dict by array name of {'Year': time grid, 'Asset': asset names}
+    d_Meta : run information (seed, parameters...) saved in the header
+    i_num_sim : number of simulations
+    Returns a dict by array name of writable memory maps (Sim * Time * Asset)
+    '''
+    os.makedirs(path_store, exist_ok = True)
+    d_Meta = dict(d_Meta, NumSim = i_num_sim, Complete = False,
+                  Arrays = {key: {'File': key + '.npy', 'Year': list(d_Lay['Year']),
+                                  'Asset': list(d_Lay['Asset']), 'Dtype': d_Lay.get('Dtype', 'float64')}
+                            for key, d_Lay in d_Layout.items()})
+    write_store_meta(path_store, d_Meta)
+    d_Arrays = {}
+    for key, d_Arr in d_Meta['Arrays'].items():
+        d_Arrays[key] = np.lib.format.open_memmap(
+            os.path.join(path_store, d_Arr['File']), mode = 'w+', dtype = d_Arr['Dtype'],
+            shape = (i_num_sim, len(d_Arr['Year']), len(d_Arr['Asset'])))
+    return d_Arrays
+
+
+def close_store(path_store, d_Arrays, i_num_sim = None):
+    '''
+    Flush the arrays and flag the store as complete
     ----------
-    dF_data : Dataframe - ESG flat DB result file
-    list_agg : List of variable to be aggregated 
-    col_res : column which contains the value to be analysed
-    list_percentile : list of percentiles
+    i_num_sim : if less than the simulations of the store (adaptive run), the arrays are cut
+                to the first i_num_sim simulations (the memory maps of d_Arrays are released)
     '''
-    # -------- Percentile
-    dF_Result = dF_data.groupby(list_agg).quantile(list_percentile)[col_res]
-    index_name ='level_' + str(len(list_agg)) # recreate index name to rename properly
-    dF_Result = dF_Result.reset_index().rename(columns={index_name :'Indicator'})
-    # ------- Set Index
-    list_index = list_agg + ['Indicator']
-    dF_Result = dF_Result.set_index(list_index)
-    # dF_Result = dF_Result.reset_index()
-    return dF_Result
+    with open(os.path.join(path_store, 'meta.json')) as f:
+        d_Meta = json.load(f)
+    for key in list(d_Arrays):
+        d_Arrays[key].flush()
+        if i_num_sim is not None and i_num_sim < d_Arrays[key].shape[0]:
+            spath = os.path.join(path_store, d_Meta['Arrays'][key]['File'])
+            with open(spath + '.tmp', 'wb') as f:
+                np.save(f, d_Arrays.pop(key)[:i_num_sim])
+            os.replace(spath + '.tmp', spath)
+            d_Meta['NumSim'] = i_num_sim
+    d_Meta['Complete'] = True
+    write_store_meta(path_store, d_Meta)
 
 
-def calculate_mean(dF_data, list_agg, col_res, list_percentile):
+def load_store(path_store, mmap_mode = 'r'):
     '''
-    Calculate the mean on a flat ESG file - see percentile function
+    Open a scenario store
+    ----------
+    path_store : directory of the store
+    mmap_mode : memory map mode of the arrays ('r': read only)
+    Returns a dict with the header ('Meta') and the memory mapped arrays (Sim * Time * Asset)
     '''
-    # -------- Mean
-    dF_Result =  dF_data.groupby(list_agg).mean()[col_res].reset_index()
-    dF_Result['Indicator'] = 'Mean'
-    dF_Result.reset_index()
-    # ------- Set Index
-    list_index = list_agg + ['Indicator']
-    dF_Result = dF_Result.set_index(list_index)
-    # dF_Result = dF_Result.reset_index()
-    return dF_Result
+    with open(os.path.join(path_store, 'meta.json')) as f:
+        d_Meta = json.load(f)
+    if not d_Meta.get('Complete'):
+        raise ValueError('Incomplete scenario store: ' + str(path_store))
+    d_Store = {'Meta': d_Meta}
+    for key, d_Arr in d_Meta['Arrays'].items():
+        d_Store[key] = np.load(os.path.join(path_store, d_Arr['File']), mmap_mode = mmap_mode)
+        if d_Store[key].shape != (d_Meta['NumSim'], len(d_Arr['Year']), len(d_Arr['Asset'])):
+            raise ValueError('Inconsistent array in the scenario store: ' + d_Arr['File'])
+    return d_Store
+
+
+def select_store(d_Store, key, asset = None, year_start = None, year_end = None, sim = None):
+    '''
+    View on an array of the store, without reading the rest of the file
+    ----------
+    d_Store : see load_store
+    key : array name ('StockRet', 'StockVal', 'Rate')
+    asset : asset name (None: all, Sim * Time * Asset; otherwise Sim * Time)
+    year_start, year_end : period selected (inclusive, None: no bound)
+    sim : simulation index or slice (None: all)
+    '''
+    d_Arr = d_Store['Meta']['Arrays'][key]
+    nA_Year = np.asarray(d_Arr['Year'])
+    i_t0 = 0 if year_start is None else np.searchsorted(nA_Year, year_start - 1e-9, side = 'left')
+    i_t1 = len(nA_Year) if year_end is None else np.searchsorted(nA_Year, year_end + 1e-9, side = 'right')
+    nA_View = d_Store[key][slice(None) if sim is None else sim]
+    if asset is None:
+        return nA_View[..., i_t0:i_t1, :]
+    return nA_View[..., i_t0:i_t1, d_Arr['Asset'].index(asset)]
+
+
+
+
+#%%#############################################################################
+############################# 4. SCENARIO CACHE  ###############################
+################################################################################
+# Output files of previous runs, in a directory by key (hash of the inputs)
+# Each entry has a manifest (size and sha256 of the files) checked on read,
+# the least recently used entries are removed above the size limit
+
 
 
-def calculate_vol(dF_data, list_agg, col_res, list_percentile, i_step):
+def _hash_update(h, obj):
+    # Feed an input (tables, arrays, settings) to the hash, independently of its memory layout
+    if isinstance(obj, dict):
+        for key in sorted(obj):
+            h.update(repr(key).encode())
+            _hash_update(h, obj[key])
+    elif isinstance(obj, (list, tuple)):
+        h.update(b'[' + str(len(obj)).encode())
+        for val in obj:
+            _hash_update(h, val)
+    elif isinstance(obj, pd.DataFrame):
+        h.update(repr((list(obj.columns), list(obj.dtypes.astype(str)), obj.index.name)).encode())
+        h.update(pd.util.hash_pandas_object(obj, index = True).to_numpy().tobytes())
+    elif isinstance(obj, np.ndarray):
+        h.update(repr((obj.shape, obj.dtype.str)).encode())
+        h.update(np.ascontiguousarray(obj).tobytes())
+    else:
+        h.update(json.dumps(obj, default = _json_default).encode())
+
+
+def get_cache_key(d_Inputs):
     '''
-    Calculate the mean on a flat ESG file - see percentile function
+    Key of a run: sha256 of the inputs (parameter tables, seed, settings) and of the code:
+    this library, esgengine.py and the main script (assembly and export of the outputs)
     ----------
-    i_step: setp length for vol adjustem
+    d_Inputs : dict of DataFrames, arrays and settings
+    '''
+    h = hashlib.sha256()
+    l_source = [__file__, os.path.join(os.path.dirname(__file__), 'esgengine.py'),
+                getattr(sys.modules.get('__main__'), '__file__', None)]
+    for name_file in l_source:
+        if name_file is not None and os.path.isfile(name_file):
+            with open(name_file, 'rb') as f:
+                h.update(f.read())
+    _hash_update(h, d_Inputs)
+    return h.hexdigest()
+
+
+def _hash_file(name_file):
+    h = hashlib.sha256()
+    with open(name_file, 'rb') as f:
+        for chunk in iter(partial(f.read, 2**20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _list_files(path):
+    # Files of an output (file or directory), relative to its parent
+    if not os.path.isdir(path):
+        return [os.path.basename(path)]
+    l_files = []
+    for root, _, files in os.walk(path):
+        for name in sorted(files):
+            l_files.append(os.path.relpath(os.path.join(root, name), os.path.dirname(path)))
+    return sorted(l_files)
+
+
+def _get_size(path):
+    # Size in bytes of the files of a directory
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, files in os.walk(path) for name in files)
+
+
+def restore_cache(path_cache, key, path_out):
     '''
-    # -------- Vol
-    dF_Result =  dF_data.groupby(list_agg).std()[col_res].reset_index()
-    dF_Result[col_res] =  dF_Result[col_res] * np.sqrt( i_step )
-    dF_Result['Indicator'] = 'Vol'
-    dF_Result.reset_index()
-    # ------- Set Index
-    list_index = list_agg + ['Indicator']
-    dF_Result = dF_Result.set_index(list_index)
-    # dF_Result = dF_Result.reset_index()
-    return dF_Result
+    Copy the output files of the cache entry to path_out
+    ----------
+    path_cache : cache directory
+    key : see get_cache_key
+    path_out : output directory
+    Returns True if the entry exists and is intact (a corrupted entry is removed)
+    '''
+    path_entry = os.path.join(path_cache, key)
+    name_manifest = os.path.join(path_entry, 'manifest.json')
+    if not os.path.isfile(name_manifest):
+        return False
+    with open(name_manifest) as f:
+        d_Manifest = json.load(f)
+    # Integrity: all files with their size and hash
+    for name, d_File in d_Manifest['Files'].items():
+        name_file = os.path.join(path_entry, 'files', name)
+        if (not os.path.isfile(name_file) or os.path.getsize(name_file) != d_File['Size']
+                or _hash_file(name_file) != d_File['Sha256']):
+            warnings.warn('Corrupted cache entry removed: ' + key, RuntimeWarning)
+            shutil.rmtree(path_entry, ignore_errors = True)
+            return False
+    for name in d_Manifest['Outputs']:
+        path_src = os.path.join(path_entry, 'files', name)
+        path_dst = os.path.join(path_out, name)
+        if os.path.isdir(path_dst):
+            shutil.rmtree(path_dst)
+        if os.path.isdir(path_src):
+            shutil.copytree(path_src, path_dst)
+        else:
+            shutil.copyfile(path_src, path_dst)
+    # Last use (LRU)
+    os.utime(name_manifest)
+    return True
+
+
+def store_cache(path_cache, key, l_outputs, i_max_size = None):
+    '''
+    Add the output files (or directories) of a run to the cache, then evict
+    the least recently used entries above i_max_size bytes
+    '''
+    os.makedirs(path_cache, exist_ok = True)
+    path_entry = os.path.join(path_cache, key)
+    if not os.path.isdir(path_entry):
+        # Written aside then renamed: an entry is never seen incomplete
+        path_temp = tempfile.mkdtemp(dir = path_cache, prefix = '.tmp_')
+        d_Manifest = {'Outputs': [os.path.basename(path) for path in l_outputs], 'Files': {}}
+        for path in l_outputs:
+            path_dst = os.path.join(path_temp, 'files', os.path.basename(path))
+            if os.path.isdir(path):
+                shutil.copytree(path, path_dst)
+            else:
+                os.makedirs(os.path.dirname(path_dst), exist_ok = True)
+                shutil.copyfile(path, path_dst)
+            for name in _list_files(path):
+                name_file = os.path.join(path_temp, 'files', name)
+                d_Manifest['Files'][name] = {'Size': os.path.getsize(name_file),
+                                             'Sha256': _hash_file(name_file)}
+        with open(os.path.join(path_temp, 'manifest.json'), 'w') as f:
+            json.dump(d_Manifest, f, indent = 1)
+        try:
+            os.rename(path_temp, path_entry)
+        except OSError:
+            # Stored meanwhile by another run
+            shutil.rmtree(path_temp, ignore_errors = True)
+    if i_max_size is not None:
+        evict_cache(path_cache, i_max_size, key)
+
+
+def evict_cache(path_cache, i_max_size, key_keep = None):
+    '''
+    Remove the least recently used entries until the cache is below i_max_size bytes
+    (the entry key_keep is kept)
+    '''
+    l_entries = []
+    for key in os.listdir(path_cache):
+        name_manifest = os.path.join(path_cache, key, 'manifest.json')
+        if key == key_keep or not os.path.isfile(name_manifest):
+            continue
+        l_entries.append((os.path.getmtime(name_manifest), _get_size(os.path.join(path_cache, key)), key))
+    i_total = sum(i_size for _, i_size, _ in l_entries)
+    if key_keep is not None:
+        i_total += _get_size(os.path.join(path_cache, key_keep))
+    for _, i_size, key in sorted(l_entries):
+        if i_total <= i_max_size:
+            break
+        shutil.rmtree(os.path.join(path_cache, key), ignore_errors = True)
+        i_total -= i_size
+
+
+
+
+#%%#############################################################################
+############################ 5. PARAMETERS / FILES  ############################
+################################################################################
+
+
+
+_d_file_index = {} # by root directory: {file name: first path found}
+# Sheets of the parameter workbook (read_excel arguments)
+d_param_sheets = {'Stock_Param': {'index_col': 0}, 'Int_Param': {'index_col': 0},
+                  'Yield_Curve': {'index_col': 0}, 'Correlation': {'header': None}}
+
+
+def find_file(name_file, path_root):
+    '''
+    Path of the first file (or directory) named name_file under path_root (as rglob),
+    the tree is walked once and indexed, walked again only if a file is not found
+    '''
+    path_root = Path(path_root)
+    for b_refresh in [False, True]:
+        if b_refresh or path_root not in _d_file_index:
+            d_Index = {}
+            for root, dirs, files in os.walk(path_root):
+                for name in dirs + files:
+                    d_Index.setdefault(name, Path(root) / name)
+            _d_file_index[path_root] = d_Index
+        path_file = _d_file_index[path_root].get(name_file)
+        if path_file is not None and path_file.exists():
+            return path_file
+    raise FileNotFoundError(str(name_file) + ' not found in ' + str(path_root))
+
+
+def load_parameters(name_file, d_Sheets, b_cache = True):
+    '''
+    Tables of a parameter workbook, with a cache of the parsed tables next to it
+    (.<name>.npz: arrays and a JSON header, read without pickle), reused while the
+    workbook is unchanged (same size and modification time, or same sha256)
+    ----------
+    name_file : path of the xlsx file
+    d_Sheets : dict {sheet name: read_excel arguments}
+    b_cache : if False the workbook is always parsed
+    Returns a dict {sheet name: DataFrame}
+    '''
+    name_file = Path(name_file)
+    name_cache = name_file.parent / ('.' + name_file.name + '.npz')
+    l_stat = [name_file.stat().st_size, name_file.stat().st_mtime_ns]
+    d_Tables = None
+    if b_cache and name_cache.is_file():
+        # Any unreadable or stale cache: the workbook is parsed again
+        try:
+            with np.load(name_cache, allow_pickle = False) as d_Npz:
+                d_Meta = json.loads(str(d_Npz['Meta']))
+                if d_Meta['Sheets'] == repr(d_Sheets) and \
+                        (d_Meta['Stat'] == l_stat or d_Meta['Sha256'] == _hash_file(name_file)):
+                    d_Tables = _read_tables(d_Npz, d_Meta['Tables'])
+        except Exception:
+            d_Tables = None
+        if d_Tables is not None:
+            if d_Meta['Stat'] != l_stat:
+                # Same content (copied or touched): cache refreshed
+                d_Meta['Stat'] = l_stat
+                _write_tables(name_cache, d_Meta, d_Tables)
+            return d_Tables
+    xcel_file = pd.ExcelFile(name_file)
+    d_Tables = {sheet: pd.read_excel(xcel_file, sheet, **d_Args) for sheet, d_Args in d_Sheets.items()}
+    if b_cache:
+        _write_tables(name_cache, {'Stat': l_stat, 'Sha256': _hash_file(name_file),
+                                   'Sheets': repr(d_Sheets)}, d_Tables)
+    return d_Tables
+
+
+def _read_tables(d_Npz, l_Table):
+    # DataFrames from the arrays of the cache (index levels then columns of each table)
+    d_Tables = {}
+    for i, d_Table in enumerate(l_Table):
+        l_Array = [d_Npz['T%d_%d' % (i, k)].astype(dtype) for k, dtype in enumerate(d_Table['Dtypes'])]
+        i_num_index = len(d_Table['Index'])
+        if i_num_index == 1:
+            index = pd.Index(l_Array[0], name = d_Table['Index'][0])
+        else:
+            index = pd.MultiIndex.from_arrays(l_Array[:i_num_index], names = d_Table['Index'])
+        d_Tables[d_Table['Sheet']] = pd.DataFrame(dict(enumerate(l_Array[i_num_index:])), index = index)
+        d_Tables[d_Table['Sheet']].columns = pd.Index(d_Table['Columns'])
+    return d_Tables
+
+
+def _write_tables(name_file, d_Meta, d_Tables):
+    # Index levels and columns stored as arrays (numbers, dates or strings), labels and types
+    # in the JSON header. Written aside then renamed, not written if a table has other
+    # values (e.g. text with blanks) or if the directory is read only
+    d_Arrays = {}
+    l_Table = []
+    for i, (sheet, dF) in enumerate(d_Tables.items()):
+        l_Values = [dF.index.get_level_values(k) for k in range(dF.index.nlevels)] + \
+                   [dF.iloc[:, k] for k in range(dF.shape[1])]
+        l_Dtype = []
+        for k, values in enumerate(l_Values):
+            nA_Values = np.asarray(values)
+            if nA_Values.dtype == object:
+                if not all(isinstance(x, str) for x in nA_Values):
+                    return
+                nA_Values = nA_Values.astype(str)
+            elif nA_Values.dtype.kind not in 'biufmM':
+                return
+            d_Arrays['T%d_%d' % (i, k)] = nA_Values
+            l_Dtype.append(str(np.asarray(values).dtype))
+        d_Table = {'Sheet': sheet, 'Index': list(dF.index.names), 'Columns': list(dF.columns), 'Dtypes': l_Dtype}
+        try:
+            if json.loads(json.dumps(d_Table)) != d_Table:
+                return
+        except (TypeError, ValueError):
+            return # labels not stored in JSON (e.g. dates)
+        l_Table.append(d_Table)
+    try:
+        i_fd, name_temp = tempfile.mkstemp(dir = os.path.dirname(name_file), suffix = '.tmp')
+        with os.fdopen(i_fd, 'wb') as f:
+            np.savez(f, Meta = np.array(json.dumps(dict(d_Meta, Tables = l_Table))), **d_Arrays)
+        os.replace(name_temp, name_file)
+    except OSError:
+        pass
+
+
+
+
+#%%#############################################################################
+############################### 6. RUN REPORT  #################################
+################################################################################
+# Named stages timed with their peak resident memory, kept for a JSON run report,
+# optionally logged and sent to subscribed hooks. When the report is disabled a stage
+# costs a dict lookup. Stages are nested (each peak includes the peaks of its sub-stages),
+# the stages of the worker processes are relayed to the main process by run_blocks.
+
+_d_report = {'Enabled': False, 'Memory': True, 'Worker': False, 'Start': None,
+             'Stages': [], 'Stack': [], 'Hooks': [], 'Handler': None}
+_logger_report = logging.getLogger('esglib.report')
+
+
+def reset_peak_rss():
+    '''
+    Reset the peak resident memory of the process (Linux, VmHWM), no effect elsewhere
+    '''
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def get_peak_rss():
+    '''
+    Peak resident memory of the process in bytes (since the last reset on Linux), None if unknown
+    '''
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    try:
+        import resource
+        i_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return i_rss if sys.platform == 'darwin' else i_rss * 1024
+    except ImportError:
+        return None
+
+
+def enable_report(b_enable = True, name_log = None, b_memory = True):
+    '''
+    Start (or stop) recording the stages of the run, the stages recorded so far are cleared
+    ----------
+    name_log : optional log file, one line per stage (logger 'esglib.report')
+    b_memory : peak memory of each stage (reset of the peak of the process at each stage)
+    '''
+    _d_report.update({'Enabled': b_enable, 'Memory': b_memory, 'Start': time.perf_counter(),
+                      'Stages': [], 'Stack': []})
+    if _d_report['Handler'] is not None:
+        _logger_report.removeHandler(_d_report['Handler'])
+        _d_report['Handler'].close()
+        _d_report['Handler'] = None
+    if name_log is not None:
+        _d_report['Handler'] = logging.FileHandler(name_log)
+        _d_report['Handler'].setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+        _logger_report.addHandler(_d_report['Handler'])
+        _logger_report.setLevel(logging.INFO)
+
+
+def subscribe_report(func):
+    '''
+    Call func(d_Stage) at the end of each stage (see start_stage for the fields)
+    '''
+    _d_report['Hooks'].append(func)
+
+
+def unsubscribe_report(func):
+    if func in _d_report['Hooks']:
+        _d_report['Hooks'].remove(func)
+
+
+def _update_peaks():
+    # Peak since the last reset carried to the open stages
+    i_peak = get_peak_rss() or 0
+    for d_Open in _d_report['Stack']:
+        d_Open['_Peak'] = max(d_Open['_Peak'], i_peak)
+    return i_peak
+
+
+def start_stage(name, **d_Info):
+    '''
+    Start a stage of the run report (to be closed by end_stage), nothing is done if disabled
+    ----------
+    name : stage name
+    d_Info : added to the stage (e.g. Start = i_start of a block)
+    The stage gets 'Stage', 'Parent', 'Depth', 'Process', 'Start' (seconds from enable_report),
+    'Time', 'CPU' (seconds) and 'PeakRSS' (bytes, peak of the process if not on Linux)
+    '''
+    if not _d_report['Enabled']:
+        return
+    l_Stack = _d_report['Stack']
+    if _d_report['Memory']:
+        _update_peaks()
+        reset_peak_rss()
+    l_Stack.append(dict(d_Info, Stage = name, Parent = l_Stack[-1]['Stage'] if l_Stack else None,
+                        Depth = len(l_Stack), Process = os.getpid(), _Peak = 0,
+                        _Time = time.perf_counter(), _CPU = time.process_time()))
+
+
+def end_stage():
+    '''
+    Close the last stage started, returns it (None if disabled)
+    '''
+    if not _d_report['Enabled'] or not _d_report['Stack']:
+        return None
+    d_time, d_cpu = time.perf_counter(), time.process_time()
+    i_peak = _update_peaks() if _d_report['Memory'] else 0
+    d_Stage = _d_report['Stack'].pop()
+    d_Stage['Start'] = d_Stage['_Time'] - _d_report['Start']
+    d_Stage['Time'] = d_time - d_Stage.pop('_Time')
+    d_Stage['CPU'] = d_cpu - d_Stage.pop('_CPU')
+    i_peak = max(i_peak, d_Stage.pop('_Peak'))
+    d_Stage['PeakRSS'] = i_peak if _d_report['Memory'] else None
+    _add_stage(d_Stage)
+    return d_Stage
+
+
+def _add_stage(d_Stage):
+    # Recorded, and in the main process logged and sent to the hooks
+    _d_report['Stages'].append(d_Stage)
+    if _d_report['Worker']:
+        return
+    _logger_report.info('%s%s %.4fs%s', '  ' * d_Stage['Depth'], d_Stage['Stage'], d_Stage['Time'],
+                        '' if d_Stage['PeakRSS'] is None else ' peak %.1f MB' % (d_Stage['PeakRSS'] / 2**20))
+    for func in _d_report['Hooks']:
+        func(d_Stage)
+
+
+@contextmanager
+def stage_timer(name, **d_Info):
+    '''
+    Stage of the run report around a with block (see start_stage)
+    '''
+    if not _d_report['Enabled']:
+        yield
+        return
+    start_stage(name, **d_Info)
+    try:
+        yield
+    finally:
+        end_stage()
+
+
+def _pop_worker_stages():
+    # Stages of a worker process, sent back with the block
+    l_Stages = _d_report['Stages']
+    _d_report['Stages'] = []
+    return l_Stages
+
+
+def get_report(d_Meta = None):
+    '''
+    Run report: 'Meta', 'Total' (seconds from enable_report), 'Stages' (in order of end) and
+    'Summary' by stage name ('Count', 'Time', 'CPU' summed, 'PeakRSS' max)
+    '''
+    d_Summary = {}
+    for d_Stage in _d_report['Stages']:
+        d_Sum = d_Summary.setdefault(d_Stage['Stage'], {'Stage': d_Stage['Stage'], 'Count': 0, 'Time': 0.,
+                                                        'CPU': 0., 'PeakRSS': None})
+        d_Sum['Count'] += 1
+        d_Sum['Time'] += d_Stage['Time']
+        d_Sum['CPU'] += d_Stage['CPU']
+        if d_Stage['PeakRSS'] is not None:
+            d_Sum['PeakRSS'] = max(d_Sum['PeakRSS'] or 0, d_Stage['PeakRSS'])
+    d_Total = None if _d_report['Start'] is None else time.perf_counter() - _d_report['Start']
+    return {'Meta': d_Meta or {}, 'Total': d_Total, 'Stages': list(_d_report['Stages']),
+            'Summary': list(d_Summary.values())}
+
+
+def write_report(name_file, d_Meta = None):
+    '''
+    Write the run report (see get_report) to a JSON file
+    '''
+    with open(name_file, 'w') as f:
+        json.dump(get_report(d_Meta), f, indent = 1, default = _json_default)
+    return name_file
+
+
 
 
 #%%#############################################################################
@@ -0,0 +1,217 @@
+# -*- coding: utf-8 -*-
+"""
+@author: Pascal Winter
+Dividend scheme and fees applied to stochastic scenarios (arrays)
+"""
+
+import pandas as pd
+import numpy as np
+import os
+import time
+import tempfile
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import libpw.esglib as esglib
+
+
+
+
+#%%#############################################################################
+######################### 0. NET OF DIVIDEND ###################################
+################################################################################
+
+# Sheets of the GMDB parameter workbook (read_excel arguments)
+d_gmdb_sheets = {'PolYearParam': {}, 'Dividend': {}}
+
+
+def load_gmdb_parameters(name_file):
+    '''
+    Fees by policy year and dividend bands of a GMDB parameter workbook (parsed once, see
+    esglib.load_parameters)
+    Returns dF_PolParamY, dF_Dividend
+    '''
+    d_Param = esglib.load_parameters(name_file, d_gmdb_sheets)
+    return d_Param['PolYearParam'], d_Param['Dividend']
+
+
+_d_jit_cache = {} # compiled kernel (numba)
+
+
+def get_dividend_table(dF_Dividend):
+    '''
+    Dividend bands as arrays: lower NAV of each band (sorted), and the monthly factor
+    (1 - DivRate / 12) of each band
+    '''
+    nA_NAVmin = dF_Dividend['NAVmin'].to_numpy(dtype = 'float64')
+    nA_DivFactor = 1 - dF_Dividend['DivRate'].to_numpy(dtype = 'float64') / 12
+    return nA_NAVmin, nA_DivFactor
+
+
+def _netofdiv_numpy(nA_Scenario, nA_FeeFactor, nA_NAVmin, nA_DivFactor, nA_NAV, nA_Out):
+    # Time loop on the simulations, NAV carried in nA_NAV, work rows in the type of nA_NAV
+    nA_Factor = np.empty_like(nA_NAV)
+    nA_Row = np.empty_like(nA_NAV)
+    for i in range(nA_Scenario.shape[0]):
+        # NAV after return and fee
+        np.add(nA_Scenario[i], 1, out = nA_Row, dtype = nA_Row.dtype)
+        np.multiply(nA_NAV, nA_Row, out = nA_Row)
+        np.multiply(nA_Row, nA_FeeFactor[i], out = nA_Row)
+        # Dividend band: last band with NAVmin <= NAV (1st band below)
+        nA_Band = np.searchsorted(nA_NAVmin, nA_Row, side = 'right') - 1
+        np.clip(nA_Band, 0, len(nA_NAVmin) - 1, out = nA_Band)
+        np.take(nA_DivFactor, nA_Band, out = nA_Factor)
+        np.multiply(nA_Row, nA_Factor, out = nA_Row)
+        # Net return, then the NAV of the next step
+        np.divide(nA_Row, nA_NAV, out = nA_Factor)
+        nA_NAV[:] = nA_Row
+        np.subtract(nA_Factor, 1, out = nA_Out[i])
+
+
+def _netofdiv_loop(nA_Scenario, nA_FeeFactor, nA_NAVmin, nA_DivFactor, nA_NAV, nA_Out):
+    # Same recursion element by element (compiled with numba)
+    for i in range(nA_Scenario.shape[0]):
+        for j in range(nA_Scenario.shape[1]):
+            d_nav = nA_NAV[j] * (1 + nA_Scenario[i, j]) * nA_FeeFactor[i]
+            i_band = max(np.searchsorted(nA_NAVmin, d_nav, side = 'right') - 1, 0)
+            d_nav = d_nav * nA_DivFactor[i_band]
+            nA_Out[i, j] = d_nav / nA_NAV[j] - 1
+            nA_NAV[j] = d_nav
+
+
+def _get_netofdiv_jit():
+    # Compiled kernel, None if numba is not installed
+    if 'Loop' not in _d_jit_cache:
+        try:
+            import numba
+            _d_jit_cache['Loop'] = numba.njit(cache = True)(_netofdiv_loop)
+        except ImportError:
+            _d_jit_cache['Loop'] = None
+    return _d_jit_cache['Loop']
+
+
+def calc_ret_netofdiv(nA_Scenario, dF_PolParamY, dF_Dividend, NAVStart, b_jit = True, dtype = None):
+    '''
+    Returns net of fees and dividends
+    ----------
+    nA_Scenario : monthly returns, nA of size Time * Simulation
+    dF_PolParamY : fees by policy year ('Year', 'DMPFee')
+    dF_Dividend : dividend rate ('DivRate') by band of NAV ('NAVmin', sorted)
+    NAVStart : NAV at time 0
+    b_jit : compiled kernel if numba is installed (NumPy otherwise)
+    dtype : type of the scenarios and net returns, 'float32' or 'float64'
+            (None: float32 if the scenarios are float32, float64 otherwise)
+    Returns the net returns, nA of size Time * Simulation
+    Only the NAV of the current step is kept: NAV after return and fee, dividend of
+    its band (searchsorted on the lower NAV of the bands), net return. The NAV is
+    carried in float64 whatever the type (no rounding error compounded over the steps)
+    '''
+    if dtype is None:
+        dtype = 'float32' if nA_Scenario.dtype == np.float32 else 'float64'
+    nA_Scenario = np.ascontiguousarray(nA_Scenario, dtype = dtype)
+    # --------------------- Align Fees with time frame
+    index_yearint = (np.arange(0, nA_Scenario.shape[0] ) / 12).astype('int32')
+    nA_DMP_Fees = np.interp(index_yearint, dF_PolParamY['Year'], dF_PolParamY['DMPFee'])
+    nA_FeeFactor = 1 - nA_DMP_Fees / 12
+    nA_NAVmin, nA_DivFactor = get_dividend_table(dF_Dividend)
+
+    # ------------------- CALC DIVIDENDS   -----------------------------------#
+    nA_NAV = np.full(nA_Scenario.shape[1], NAVStart, dtype = 'float64')
+    nA_Out = np.empty(nA_Scenario.shape, dtype = dtype)
+    kernel = _get_netofdiv_jit() if b_jit else None
+    if kernel is None:
+        kernel = _netofdiv_numpy
+    kernel(nA_Scenario, nA_FeeFactor, nA_NAVmin, nA_DivFactor, nA_NAV, nA_Out)
+    return nA_Out
+
+
+
+
+#%%#############################################################################
+############################## 1. BATCH ########################################
+################################################################################
+# Rows of a pricing batch (PricingRuns.xlsx, sheet ESG): each scenario file and each
+# parameter file is loaded once, the rows are calculated in a pool of processes
+# on memory maps of the scenarios
+
+
+
+def load_scenario_csv(name_file, dtype = 'float64'):
+    '''
+    Matrix csv of returns (Time * Simulation, index in the 1st column), as np.loadtxt
+    '''
+    return pd.read_csv(name_file, index_col = 0, float_precision = 'round_trip').to_numpy(dtype = dtype)
+
+
+def _save_scenario_npy(name_csv, name_npy, dtype = 'float64'):
+    # Scenario csv saved as .npy (to be memory mapped), returns the time taken
+    d_time = time.perf_counter()
+    np.save(name_npy, load_scenario_csv(name_csv, dtype))
+    return time.perf_counter() - d_time
+
+
+_d_batch_scenario = {} # memory maps opened by the process
+
+
+def _run_batch_row(t_row):
+    # One row: net returns of the memory mapped scenarios, written to csv
+    i_row, name_npy, dF_PolParamY, dF_Dividend, NAVStart, spath = t_row
+    d_time = time.perf_counter()
+    if name_npy not in _d_batch_scenario:
+        _d_batch_scenario[name_npy] = np.load(name_npy, mmap_mode = 'r')
+    nA_NetReturns = calc_ret_netofdiv(_d_batch_scenario[name_npy], dF_PolParamY, dF_Dividend, NAVStart)
+    d_calc = time.perf_counter() - d_time
+    pd.DataFrame(nA_NetReturns).to_csv(spath)
+    return i_row, d_calc, time.perf_counter() - d_time - d_calc
+
+
+def run_netofdiv_batch(dF_ESG_Specs, path_root, i_num_workers = 4, precision = 'float64'):
+    '''
+    Net of dividend returns for all the rows of a pricing batch
+    ----------
+    dF_ESG_Specs : rows with 'RAW_ResultFile', 'Result_Name', 'Parameter_File', 'NAV_start'
+    path_root : directory where the files are searched (see esglib.find_file),
+                the results are written next to the scenario file
+    i_num_workers : number of processes
+    precision : 'float64' or 'float32' (scenarios memory mapped and net returns, see calc_ret_netofdiv)
+    Returns a Dataframe by row: output path and times in seconds (loading the
+    scenario file is shared by its rows)
+    '''
+    dF_Batch = pd.DataFrame({'Result_Name': dF_ESG_Specs['Result_Name'].to_numpy(),
+                             'RAW_ResultFile': dF_ESG_Specs['RAW_ResultFile'].to_numpy()},
+                            index = dF_ESG_Specs.index)
+    # --------------------- Parameter files: parsed once
+    with esglib.stage_timer('LoadParameters'):
+        d_Param = {name: load_gmdb_parameters(esglib.find_file(name, path_root))
+                   for name in dF_ESG_Specs['Parameter_File'].unique()}
+    with tempfile.TemporaryDirectory() as path_temp:
+        # --------------------- Scenario files: read once (concurrently), saved for memory mapping
+        l_files = list(dF_ESG_Specs['RAW_ResultFile'].unique())
+        d_Path = {name: esglib.find_file(name, path_root) for name in l_files}
+        d_Npy = {name: os.path.join(path_temp, 'scenario_' + str(i) + '.npy') for i, name in enumerate(l_files)}
+        with esglib.stage_timer('LoadScenarios'):
+            with ThreadPoolExecutor(max(1, min(i_num_workers or 1, len(l_files)))) as executor:
+                d_Load = dict(zip(l_files, executor.map(_save_scenario_npy, [d_Path[name] for name in l_files],
+                                                        [d_Npy[name] for name in l_files],
+                                                        [precision] * len(l_files))))
+        dF_Batch['Load'] = dF_Batch['RAW_ResultFile'].map(d_Load)
+        # --------------------- Rows, grouped by scenario file
+        l_rows = []
+        for index, row in dF_ESG_Specs.sort_values('RAW_ResultFile', kind = 'stable').iterrows():
+            spath = d_Path[row['RAW_ResultFile']].parent.as_posix() + "/" + row['Result_Name']
+            dF_Batch.loc[index, 'Output'] = spath
+            l_rows.append((index, d_Npy[row['RAW_ResultFile']]) + d_Param[row['Parameter_File']]
+                          + (row['NAV_start'], spath))
+        # Rows timed as a whole (times by row in the Dataframe)
+        with esglib.stage_timer('NetOfDivBatch', Rows = len(l_rows)):
+            # fork where available, spawn only from a protected main script (see esglib.get_process_context)
+            mp_context = esglib.get_process_context() if i_num_workers is not None and i_num_workers > 1 else None
+            if mp_context is None:
+                l_result = [_run_batch_row(t_row) for t_row in l_rows]
+            else:
+                with ProcessPoolExecutor(i_num_workers, mp_context = mp_context) as executor:
+                    l_result = list(executor.map(_run_batch_row, l_rows))
+        _d_batch_scenario.clear()
+    for index, d_calc, d_write in l_result:
+        dF_Batch.loc[index, 'Calc'] = d_calc
+        dF_Batch.loc[index, 'Write'] = d_write
+    return dF_Batch
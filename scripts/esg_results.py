@@ -4,7 +4,7 @@
 www.winter-aas.com
 
 Provides simple visualisation of ESG output
-Works with DB format ("flat") and Matrix formats
+Works with DB format ("flat"), Matrix formats and binary store
 
 1.DESCRIBE: calculate mean, vol and percentiles
 2. GRAPH
@@ -21,9 +21,6 @@ EXPORT: export result dashboard
 import pandas as pd
 import numpy as np
 from pathlib import Path
-import seaborn as sns
-import matplotlib.pyplot as plt
-import matplotlib.ticker as ticker
 
 CWD = Path(__file__).resolve().parents[1] # Since we are in a sub-directory
 
@@ -34,18 +31,18 @@ import libpw.esglib as esglib
 
 # ------------------------- Results to be loaded ------------------------------#
 name_input = 'RW'
-input_type = 'CSV' #  'DB'  'XLSX'    'CSV'
+input_type = 'CSV' #  'DB'  'XLSX'    'CSV'    'NPY'
 input_funds = ['4p5_9vol', '4p5_8vol', '5p5_9vol', '5p5_8vol', '3p5_9vol', '3p5_8vol'] # only used if type = 'CSV'
 i_inputstep_length = 12 # 12: month, 1: year
 rn_sim = False 
+precision = None #  None (as stored: NPY, float64 otherwise)  'float64'  'float32' (half the memory,
+                 #  prices and statistics accumulated in float64)
+run_report = False # if True, time and peak memory by stage in name_input_results_report.json
 
 
 # ----------------------------- Graph Parameters ------------------------------#
 plt_wd = 345 
 pal_name = 'Blues_d'
-pal = sns.color_palette(pal_name)
-#pal = sns.color_palette('YlGnBu')
-sns.set_palette(pal)
 
 
 
@@ -60,61 +57,35 @@ sns.set_palette(pal)
 # -----------------------------------------------------------------------------#
 
 csv_loadfile_expret = name_input + '_exp_returns.csv' # for the expected returns by funds
-dF_Stock_ExpRet = pd.read_csv(list(CWD.rglob(csv_loadfile_expret))[0], index_col = 0)
+# Located once (the tree is walked once for all the files), outputs written next to it
+spath_expret = esglib.find_file(csv_loadfile_expret, CWD)
+spath_res = spath_expret.parent.as_posix()
+dF_Stock_ExpRet = pd.read_csv(spath_expret, index_col = 0)
 
 
 # -----------------------------------------------------------------------------#
-# --------------------------- Load DB formats  --------------------------------#
+# --------------------------- Load Scenarios  ---------------------------------#
 # -----------------------------------------------------------------------------#
+# Loaded as a Sim * Time * Asset array (files / sheets read concurrently)
 
 if input_type == 'DB':
-    name_input_db =  name_input + '_results.csv' # for DB format
-    dF_Stock_Ret = pd.read_csv(list(CWD.rglob(name_input_db))[0])
-
-
-# -----------------------------------------------------------------------------#
-# --------------------------- Load Matrix XLSX --------------------------------#
-# -----------------------------------------------------------------------------#
-    
+    # csv file, or parquet dataset directory
+    try:
+        path_input = esglib.find_file(name_input + '_results.csv', CWD)
+    except FileNotFoundError:
+        path_input = esglib.find_file(name_input + '_results.parquet', CWD)
 if input_type == 'XLSX':
-    # get excel file path and prepare map
-    name_input_excel = name_input + '_results.xlsx'
-    xcel_file = pd.ExcelFile(list(CWD.rglob(name_input_excel))[0])
-    # predefine DF for output
-    dF_Stock_Ret = pd.DataFrame(columns=['Year', 'Simulation', 'Return', 'Asset'])
-    for sheets in xcel_file.sheet_names:
-        # Read from excel
-        dF_temp = pd.read_excel(xcel_file, sheets, index_col = 0)
-        dF_temp['Year'] = dF_temp.index.values / i_inputstep_length # Calculate Year
-        # Melt to get a DB format and map the type (ret or val) to get proper column name
-        dF_temp = dF_temp.melt(id_vars = 'Year', var_name = 'Simulation', value_name = 'Return')
-        dF_temp['Asset'] = sheets # Add Asset Name from sheet name
-        # Append
-        dF_Stock_Ret =  pd.concat([dF_Stock_Ret, dF_temp], axis=0)
-    # Type correctly simulation
-    dF_Stock_Ret['Simulation'] = dF_Stock_Ret['Simulation'].astype('int64')
-
-# -----------------------------------------------------------------------------#
-# --------------------------- Load Matrix CSV  --------------------------------#
-# -----------------------------------------------------------------------------#
-    
+    path_input = esglib.find_file(name_input + '_results.xlsx', CWD)
 if input_type == 'CSV':
-    # predefine DF for output
-    dF_Stock_Ret = pd.DataFrame(columns=['Year', 'Simulation', 'Return', 'Asset'])
-    # go through the sheets
-    for asset in input_funds:
-        name_input_csv = name_input + '_' + asset + '_results.csv'
-        dF_temp = pd.read_csv(list(CWD.rglob(name_input_csv))[0], index_col = 0)
-        # Calculate Year
-        dF_temp['Year'] = dF_temp.index.values / i_inputstep_length
-        # Melt to get a DB format and map the type (ret or val) to get proper column name
-        dF_temp = dF_temp.melt(id_vars = 'Year', var_name = 'Simulation', value_name = 'Return')
-        # Add Asset Name from sheet name
-        dF_temp['Asset'] = asset
-        # Append
-        dF_Stock_Ret =  pd.concat([dF_Stock_Ret, dF_temp], axis=0)
-    # Type correctly simulation
-    dF_Stock_Ret['Simulation'] = dF_Stock_Ret['Simulation'].astype('int64')
+    path_input = {asset: esglib.find_file(name_input + '_' + asset + '_results.csv', CWD)
+                  for asset in input_funds}
+if input_type == 'NPY':
+    path_input = esglib.find_file(name_input + '_store', CWD)
+
+if run_report == True:
+    esglib.enable_report()
+with esglib.stage_timer('Load', Type = input_type):
+    d_Scen = esglib.load_scenarios(input_type, path_input, None, i_inputstep_length, dtype = precision)
     
 
 # -----------------------------------------------------------------------------#
@@ -122,10 +93,10 @@ if input_type == 'CSV':
 # -----------------------------------------------------------------------------#
 
 # -------------------- Calculate Stock Prices ---------------------------------#
-dF_Stock_Val = dF_Stock_Ret.copy()
-dF_Stock_Val['Return'] = dF_Stock_Val['Return'] + 1
-dF_Stock_Val['Return']  = dF_Stock_Val.groupby(['Asset','Simulation']).cumprod()['Return']
-dF_Stock_Val = dF_Stock_Val.rename(columns={'Return':'Price'})
+# Single cumulative product along the time axis
+with esglib.stage_timer('Prices'):
+    d_Scen['Val'] = esglib.calculate_prices(d_Scen['Ret'])
+
 
 # ------------------- Calculate Expected Prices
 # Calculate step (ie second lowest year)
@@ -153,36 +124,25 @@ l_quantile=[0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
 l_quantile=[0.005, 0.01, 0.05, 0.1, 0.25, 0.50, 0.75, 0.9, 0.95, 0.99, 0.995]
 
 # ------------------- Calculate Global - RETURNS ------------------------------#
-# Percentile returns
-dF_Global_StockRet = esglib.calculate_percentile(dF_Stock_Ret, ['Asset'], 'Return', l_quantile)
-# Mean returns
-dF_temp = esglib.calculate_mean(dF_Stock_Ret, ['Asset'], 'Return', l_quantile)
-dF_Global_StockRet = dF_Global_StockRet.append(dF_temp)
-# Vol returns
-dF_temp = esglib.calculate_vol(dF_Stock_Ret, ['Asset'], 'Return', l_quantile, i_inputstep_length)
-dF_Global_StockRet = dF_Global_StockRet.append(dF_temp)
+# Percentiles, Mean and Vol returns in a single pass on the scenario array
+with esglib.stage_timer('Statistics', Result = 'GlobalReturn'):
+    dF_Global_StockRet = esglib.describe_scenarios(d_Scen, 'Ret', 'Return', l_quantile,
+                                                   False, i_inputstep_length)
 
 
 # ------------------- Calculate Year - RETURNS --------------------------------#
-# Percentile returns
-dF_Period_StockRet = esglib.calculate_percentile(dF_Stock_Ret, ['Asset','Year'], 'Return', l_quantile)
-# Mean returns
-dF_temp = esglib.calculate_mean(dF_Stock_Ret, ['Asset','Year'], 'Return', l_quantile)
-dF_Period_StockRet = dF_Period_StockRet.append(dF_temp)
+# Percentiles, Mean and Vol returns by year
+with esglib.stage_timer('Statistics', Result = 'PeriodReturn'):
+    dF_Period_StockRet = esglib.describe_scenarios(d_Scen, 'Ret', 'Return', l_quantile,
+                                                   True, i_inputstep_length)
 # Annualize Returns
 # dF_Period_StockRet['Return'] = np.power(1 + dF_Period_StockRet['Return'], 12 / i_outpoutstep_length) - 1
-# Vol returns
-dF_temp = esglib.calculate_vol(dF_Stock_Ret, ['Asset','Year'], 'Return', l_quantile, i_inputstep_length)
-dF_Period_StockRet = dF_Period_StockRet.append(dF_temp)
-
 
 
 # ------------------- Calculate Year - VALUE ----------------------------------#
-# Percentile returns
-dF_Period_StockVal = esglib.calculate_percentile(dF_Stock_Val, ['Asset','Year'], 'Price', l_quantile)
-# Mean returns
-dF_temp = esglib.calculate_mean(dF_Stock_Val, ['Asset','Year'], 'Price', l_quantile)
-dF_Period_StockVal = dF_Period_StockVal.append(dF_temp)
+# Percentiles and Mean prices by year
+with esglib.stage_timer('Statistics', Result = 'PeriodPrice'):
+    dF_Period_StockVal = esglib.describe_scenarios(d_Scen, 'Val', 'Price', l_quantile, True)
 
 
 
@@ -193,21 +153,32 @@ dF_Period_StockVal = dF_Period_StockVal.append(dF_temp)
 #%%#############################################################################
 #BOOK############################## 2.GRAPH ####################################
 ################################################################################
+# Plotting libraries imported here only (slow to import)
+import seaborn as sns
+import matplotlib.pyplot as plt
+import matplotlib.ticker as ticker
+
+pal = sns.color_palette(pal_name)
+#pal = sns.color_palette('YlGnBu')
+sns.set_palette(pal)
 
 # -----------------------------------------------------------------------------#
 # -------------------- 2.0 Graph Selected Sims  -------------------------------#
 # -----------------------------------------------------------------------------#
 
 # ----------------------------- Settings --------------------------------------#
-lassets = list(dF_Stock_Ret['Asset'].unique())
+esglib.start_stage('Graph', Figure = 1)
+lassets = list(d_Scen['Asset'])
 nassets = len(lassets)
 num_sim_shown = 10
 
 fig, axes = plt.subplots(nassets, 1, figsize=esglib.set_size(plt_wd, nassets, 1),
                          sharex=True, sharey = 'col')
 
-# Select Mean by Asset and Year
-dF_temp = dF_Stock_Val.loc[dF_Stock_Val['Simulation'] < num_sim_shown]
+# Long format only for the simulations shown
+d_temp = dict(d_Scen, Val = d_Scen['Val'][:num_sim_shown],
+              Simulation = d_Scen['Simulation'][:num_sim_shown])
+dF_temp = esglib.scenarios_to_long(d_temp, 'Val', 'Price')
 pal_temp = sns.diverging_palette(240, 240, n=num_sim_shown)
 
 for i, asset in enumerate(lassets):
@@ -226,8 +197,9 @@ for i, asset in enumerate(lassets):
     axes[i].set_ylabel(asset)
     axes[i].set_yscale('log')
 
-spath = list(CWD.rglob(csv_loadfile_expret))[0].parent.as_posix() + "/" + name_input + '_1.png'
+spath = spath_res + "/" + name_input + '_1.png'
 fig.savefig(spath)
+esglib.end_stage()
 
 
 
@@ -237,7 +209,8 @@ fig.savefig(spath)
 # -----------------------------------------------------------------------------#
 
 # ----------------------------- Settings --------------------------------------#
-lassets = list(dF_Stock_Ret['Asset'].unique())
+esglib.start_stage('Graph', Figure = 2)
+lassets = list(d_Scen['Asset'])
 nassets = len(lassets)
 fig, axes = plt.subplots(nassets, 2, figsize=esglib.set_size(plt_wd, nassets, 2),
                          sharex=True)
@@ -284,8 +257,9 @@ for i, asset in enumerate(lassets):
     axes[i,0].yaxis.set_major_formatter(ticker.PercentFormatter(xmax=1, decimals=1))
 
 
-spath = list(CWD.rglob(csv_loadfile_expret))[0].parent.as_posix() + "/" + name_input + '_2.png'
+spath = spath_res + "/" + name_input + '_2.png'
 fig.savefig(spath)
+esglib.end_stage()
 
 
 #%% ---------------------------------------------------------------------------#
@@ -293,7 +267,8 @@ fig.savefig(spath)
 # -----------------------------------------------------------------------------#
 
 # ----------------------------- Settings --------------------------------------#
-lassets = list(dF_Stock_Ret['Asset'].unique())
+esglib.start_stage('Graph', Figure = 3)
+lassets = list(d_Scen['Asset'])
 nassets = len(lassets)
 pal_temp = sns.diverging_palette(240, 240, n=len(l_quantile))
 fig, axes = plt.subplots(nassets, 3, figsize=esglib.set_size(plt_wd, nassets, 3),
@@ -369,8 +344,9 @@ axes[0,0].set_title('Asset Price')
 axes[0,1].set_title('Asset Return')
 axes[0,2].set_title('Asset Volatility')
   
-spath = list(CWD.rglob(csv_loadfile_expret))[0].parent.as_posix() + "/" + name_input + '_3.png'
+spath = spath_res + "/" + name_input + '_3.png'
 fig.savefig(spath)
+esglib.end_stage()
 
 
 
@@ -380,16 +356,15 @@ fig.savefig(spath)
 
 
 #--------------------------  Output the results -------------------------------#
-spath = list(CWD.rglob(csv_loadfile_expret))[0].parent.as_posix() + "/" + name_input + '_analysis.xlsx'
+spath = spath_res + "/" + name_input + '_analysis.xlsx'
 
 
 print('Exporting Results to Excel...')
-# Setup excel writer
-writer = pd.ExcelWriter(spath, engine='xlsxwriter') 
-# Write Files - Single Simulation
-dF_Global_StockRet.to_excel(writer, sheet_name='Global_Stock', freeze_panes=(1,1))
-dF_Period_StockVal.unstack(level="Year").to_excel(writer, sheet_name='Year_Stock_Val', freeze_panes=(1,1))
-dF_Period_StockRet.unstack(level="Year").to_excel(writer, sheet_name='Year_Stock_Ret', freeze_panes=(1,1))
-# Close writer
-writer.save()
+with esglib.stage_timer('ExportAnalysis'):
+    esglib.export_analysis(spath, dF_Global_StockRet, dF_Period_StockVal, dF_Period_StockRet)
+
 
+#--------------------------  Run report ---------------------------------------#
+if run_report == True:
+    esglib.write_report(spath_res + "/" + name_input + '_results_report.json',
+                        {'Input': name_input, 'Type': input_type})
@@ -13,6 +13,9 @@ from pathlib import Path
 
 CWD = Path(__file__).resolve().parents[1] # Since we are in a sub-directory
 
+import libpw.esglib as esglib
+import libpw.gmdblib as gmdblib
+
 
 
 
@@ -22,48 +25,29 @@ CWD = Path(__file__).resolve().parents[1] # Since we are in a sub-directory
 
 
 
-def calc_ret_netofdiv(name_input, name_output , filename_parameter_xlsx, NAVStart):
+def calc_ret_netofdiv(name_input, name_output , filename_parameter_xlsx, NAVStart, precision = 'float64'):
 
     # ---------------------  INITIALISATION -----------------------------------#
     # --------------------------- Load Matrix CSV
-    csv_address = list(CWD.rglob(name_input))[0]
-    nA_Scenario = np.loadtxt(csv_address, delimiter=',',
-                             skiprows = 1)
-    nA_Scenario = nA_Scenario[:,1:] # Drop the 1st column
-    # --------------------- Load Dividends & Fees
-    file_parameter_xlsx = pd.ExcelFile(list(CWD.rglob(filename_parameter_xlsx))[0])
-    dF_PolParamY = pd.read_excel(file_parameter_xlsx, 'PolYearParam')
-    dF_Dividend = pd.read_excel(file_parameter_xlsx, 'Dividend')
-    # --------------------- Align Fees with time frame 
-    index_yearint = (np.arange(0, nA_Scenario.shape[0] ) / 12).astype('int32')
-    nA_DMP_Fees = np.interp(index_yearint, dF_PolParamY['Year'], dF_PolParamY['DMPFee'])
-    
+    with esglib.stage_timer('Load'):
+        csv_address = esglib.find_file(name_input, CWD)
+        nA_Scenario = np.loadtxt(csv_address, delimiter=',',
+                                 skiprows = 1, dtype = precision)
+        nA_Scenario = nA_Scenario[:,1:] # Drop the 1st column
+        # --------------------- Load Dividends & Fees
+        dF_PolParamY, dF_Dividend = gmdblib.load_gmdb_parameters(esglib.find_file(filename_parameter_xlsx, CWD))
+
+
+    # ------------------- CALC DIVIDENDS   -----------------------------------#
+    with esglib.stage_timer('NetOfDiv'):
+        nA_NetReturns = gmdblib.calc_ret_netofdiv(nA_Scenario, dF_PolParamY, dF_Dividend, NAVStart)
 
-    # ------------------- CALC DIVIDENDS   -----------------------------------# 
-    # ------------------- Calculate Net NAV
-    nA_NAVBop = np.zeros(nA_Scenario.shape, dtype = 'float64')
-    nA_NAVMop = np.zeros(nA_Scenario.shape, dtype = 'float64')
-    nA_NAVEop = np.zeros(nA_Scenario.shape, dtype = 'float64')
-    # Initialise
-    nA_NAVBop[0,:] = NAVStart
-    for i in range(0, nA_Scenario.shape[0]): # Loop on Time
-        # Calculate NAV after retrun and fee
-        nA_NAVMop[i,:] = nA_NAVBop[i,:] * (1 + nA_Scenario[i,:] ) * (1 - nA_DMP_Fees[i] / 12 )
-        # Calculate dividend rate (get index location then apply)
-        nA_temp = np.interp(nA_NAVMop[i,:], dF_Dividend['NAVmin'], dF_Dividend.index).astype('int32')
-        nA_temp = np.interp(nA_temp, dF_Dividend.index, dF_Dividend['DivRate'])
-        nA_NAVEop[i,:]  = nA_NAVMop[i,:] * (1 - nA_temp / 12)
-        # Next Step
-        if i < nA_Scenario.shape[0] - 1: 
-            nA_NAVBop[i + 1,:] =  nA_NAVEop[i,:] 
-    # Get net returns
-    nA_NetReturns = nA_NAVEop / nA_NAVBop - 1
-    
     # ------------------- EXPORT RESULTS  -------------------------------------# 
     
     spath = csv_address.parent.as_posix() + "/" + name_output
     #np.savetxt(spath, , delimiter=',')
-    pd.DataFrame(nA_NetReturns).to_csv(spath)
+    with esglib.stage_timer('Write'):
+        pd.DataFrame(nA_NetReturns).to_csv(spath)
     return nA_NetReturns
     
 #%%#############################################################################
@@ -78,14 +62,35 @@ def calc_ret_netofdiv(name_input, name_output , filename_parameter_xlsx, NAVStar
 #                                   10)
 
 
+# ---------------------- In process: generate -> net of dividend -> statistics
+# (no scenario file written nor read)
+
+# from libpw.esgengine import ESGenerator
+# esg = ESGenerator(esglib.find_file('RN_param.xlsx', CWD), i_num_sim = 1000)
+# d_Scen = esg.run(['StockRet'])
+# dF_PolParamY, dF_Dividend = gmdblib.load_gmdb_parameters(esglib.find_file('GMdB_Parameters_1.xlsx', CWD))
+# nA_Net = np.stack([gmdblib.calc_ret_netofdiv(d_Scen['StockRet'][:, :, i].T, dF_PolParamY, dF_Dividend, 10).T
+#                    for i in range(d_Scen['StockRet'].shape[2])], axis = 2)
+# d_Net = dict(esg.get_scenarios(d_Scen, 'StockRet'), Ret = nA_Net)
+# dF_Period_NetRet = esglib.describe_scenarios(d_Net, 'Ret', 'Return', [0.005, 0.5, 0.995], True, 12)
+
+
 
 # ---------------------- Batch
-file_parameter_xlsx = pd.ExcelFile(list(CWD.rglob('PricingRuns.xlsx'))[0])
-dF_ESG_Specs = pd.read_excel(file_parameter_xlsx, 'ESG')
-
-for index, row in dF_ESG_Specs.iterrows():
-    nA_NetReturns = calc_ret_netofdiv(dF_ESG_Specs.loc[index]['RAW_ResultFile'],
-                                      dF_ESG_Specs.loc[index]['Result_Name'], 
-                                      dF_ESG_Specs.loc[index]['Parameter_File'],
-                                      dF_ESG_Specs.loc[index]['NAV_start'])
-    
+# Scenario and parameter files loaded once, rows calculated in parallel
+i_num_workers = 4
+precision = 'float64' #  'float64'  'float32' (half the memory, NAV still carried in float64)
+run_report = False # if True, time and peak memory by stage in netofdiv_report.json
+
+# Protected: without fork (Windows) the worker processes re-import this script
+if __name__ == '__main__':
+    if run_report == True:
+        esglib.enable_report()
+    file_parameter_xlsx = pd.ExcelFile(esglib.find_file('PricingRuns.xlsx', CWD))
+    dF_ESG_Specs = pd.read_excel(file_parameter_xlsx, 'ESG')
+
+    dF_Batch = gmdblib.run_netofdiv_batch(dF_ESG_Specs, CWD, i_num_workers, precision)
+    print(dF_Batch)
+    if run_report == True:
+        esglib.write_report(esglib.find_file('PricingRuns.xlsx', CWD).parent.as_posix() + '/netofdiv_report.json',
+                            {'Rows': len(dF_ESG_Specs), 'Workers': i_num_workers, 'Precision': precision})
@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter tables built in memory (same layout as the parameter workbooks, see esglib.d_param_sheets)
+"""
+
+import numpy as np
+import pandas as pd
+import pytest
+
+
+def get_test_parameters(l_spot = None):
+    '''
+    3 stocks and 1 short rate, yield curve by year (flat 1.3% if l_spot is None)
+    '''
+    l_year = list(range(1, 71))
+    l_spot = [0.013] * len(l_year) if l_spot is None else l_spot
+    return {'Stock_Param': pd.DataFrame({'Return': [0.02, 0.04, 0.08], 'Dividend': [0., 0.01, 0.],
+                                         'Volatility': [0.07, 0.08, 0.19]},
+                                        index = pd.Index(['Low', 'Mid', 'High'], name = 'StockName')),
+            'Int_Param': pd.DataFrame({'Int_a': [0.2], 'Int_b': [0.04], 'Int_sigma': [0.01], 'Int_r0': [0.02]},
+                                      index = pd.Index(['ZC_0'], name = 'IntName')),
+            'Yield_Curve': pd.DataFrame({'Spot': l_spot}, index = pd.Index(l_year, name = 'Year')),
+            'Correlation': pd.DataFrame([[1., 0.2, 0.1, 0.], [0.2, 1., 0.4, 0.],
+                                         [0.1, 0.4, 1., 0.], [0., 0., 0., 1.]])}
+
+
+@pytest.fixture
+def d_Param():
+    return get_test_parameters()
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+"""
+Parameter workbook and its cache of parsed tables (esglib.load_parameters)
+"""
+
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+import libpw.esglib as esglib
+
+from conftest import get_test_parameters
+
+
+def _write_workbook(name_file):
+    d_Param = get_test_parameters()
+    with pd.ExcelWriter(name_file) as writer:
+        for sheet in ['Stock_Param', 'Int_Param', 'Yield_Curve']:
+            d_Param[sheet].to_excel(writer, sheet_name = sheet)
+        d_Param['Correlation'].to_excel(writer, sheet_name = 'Correlation', header = False, index = False)
+
+
+def _assert_same(d_Tables, d_Ref):
+    assert list(d_Tables) == list(d_Ref)
+    for sheet in d_Ref:
+        pd.testing.assert_frame_equal(d_Tables[sheet], d_Ref[sheet])
+
+
+def _no_parse(*args, **kwargs):
+    raise AssertionError('workbook parsed')
+
+
+def test_cache(tmp_path, monkeypatch):
+    name_file = tmp_path / 'RW_param.xlsx'
+    _write_workbook(name_file)
+    d_Ref = esglib.load_parameters(name_file, esglib.d_param_sheets, False)
+    name_cache = tmp_path / '.RW_param.xlsx.npz'
+    assert not name_cache.exists()
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
+    # Arrays only: readable without pickle
+    with np.load(name_cache, allow_pickle = False) as d_Npz:
+        assert all(d_Npz[key].dtype != object for key in d_Npz.files)
+    monkeypatch.setattr(pd, 'ExcelFile', _no_parse)
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
+    # Copied workbook with its cache: same content, reused
+    os.makedirs(tmp_path / 'copy')
+    shutil.copy(name_file, tmp_path / 'copy' / name_file.name)
+    shutil.copy(name_cache, tmp_path / 'copy' / name_cache.name)
+    _assert_same(esglib.load_parameters(tmp_path / 'copy' / name_file.name, esglib.d_param_sheets), d_Ref)
+
+
+def test_cache_invalid(tmp_path):
+    # Corrupted or foreign cache files: the workbook is parsed again
+    name_file = tmp_path / 'RW_param.xlsx'
+    _write_workbook(name_file)
+    d_Ref = esglib.load_parameters(name_file, esglib.d_param_sheets, False)
+    name_cache = tmp_path / '.RW_param.xlsx.npz'
+    name_cache.write_bytes(b'not a cache')
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
+    np.savez(name_cache, Other = np.zeros(3))
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
+    np.savez(name_cache, Meta = np.array('{"Stat": 1}'))
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
+    np.savez(name_cache, Meta = np.array('[]'))
+    _assert_same(esglib.load_parameters(name_file, esglib.d_param_sheets), d_Ref)
@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+"""
+Short rate models against the input yield curve
+"""
+
+import numpy as np
+import pytest
+
+import libpw.esglib as esglib
+from libpw.esgengine import ESGenerator
+from conftest import get_test_parameters
+
+
+@pytest.mark.parametrize('l_spot', [None, list(0.01 + 0.0004 * np.arange(70))])
+def test_log_discount_nodes(l_spot):
+    # Exact integral of the forwards: (1 + Spot_T)^-T at the years of the curve
+    dF_YieldCurve = get_test_parameters(l_spot)['Yield_Curve']
+    dF_Fwd = esglib.calculate_forward(dF_YieldCurve)
+    nA_Year = dF_Fwd.index.to_numpy()
+    nA_Disc = np.exp(esglib.calculate_log_discount(nA_Year, dF_Fwd['Forward'].to_numpy(), nA_Year))
+    np.testing.assert_allclose(nA_Disc, (1 + dF_YieldCurve['Spot'].to_numpy()) ** -nA_Year, rtol = 1e-12)
+
+
+@pytest.mark.parametrize('l_spot', [None, list(0.01 + 0.0004 * np.arange(70))])
+def test_hw_mean_deflator(l_spot):
+    # Hull-White fitted on the curve: mean deflator = input discount factors (Monte Carlo error)
+    d_Param = get_test_parameters(l_spot)
+    esg = ESGenerator(d_Param, i_num_sim = 4000, i_num_steps = 20, rate_model = 'HW',
+                      variance_reduction = 'antithetic')
+    d_Scen = esg.run(['Rate'])
+    nA_Year = np.asarray(d_Scen['Year']['Rate'])
+    nA_Deflator = d_Scen['Rate'][:, :, d_Scen['Asset']['Rate'].index('ZC_0_Deflator')]
+    l_pos = [i for i, year in enumerate(nA_Year) if year > 0 and abs(year - round(year)) < 1e-9]
+    dF_Curve = d_Param['Yield_Curve']
+    nA_Target = (1 + dF_Curve['Spot'].loc[np.round(nA_Year[l_pos])].to_numpy()) ** -np.round(nA_Year[l_pos])
+    nA_Pair = (nA_Deflator[0::2, l_pos] + nA_Deflator[1::2, l_pos]) / 2
+    nA_Mean = nA_Pair.mean(axis = 0)
+    nA_StdErr = nA_Pair.std(axis = 0, ddof = 1) / np.sqrt(nA_Pair.shape[0])
+    assert np.all(np.abs(nA_Mean - nA_Target) <= 4 * nA_StdErr + 1e-5)
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+"""
+Percentiles of the streaming accumulators against the percentiles of the scenarios
+"""
+
+import numpy as np
+
+import libpw.esglib as esglib
+from libpw.esgengine import ESGenerator
+
+from conftest import get_test_parameters
+
+
+l_quantile = [0.005, 0.05, 0.25, 0.50, 0.75, 0.95, 0.995]
+
+
+def test_return_percentiles():
+    # Monthly returns, histogram range by stock from the input drift and vols
+    esg = ESGenerator(get_test_parameters(), i_num_sim = 5000, i_num_steps = 5)
+    d_Scen = esg.run(['StockRet'])
+    t_range = esglib.get_sketch_range(esglib.aggregate_drift(esg.d_Model['Drift'], 4),
+                                      esg.d_Model['Vol'], 1 / 12)
+    d_Acc = esglib.create_accumulator(len(esg.l_step_year), len(esg.l_stocks),
+                                      esglib.get_sketch_edges(*t_range, 4000), 'Return')
+    for i_start, i_end in esg.l_blocks:
+        esglib.update_accumulator(d_Acc, d_Scen['StockRet'][i_start:i_end])
+    nA_Quantile = esglib.calculate_stats_accumulator(d_Acc, l_quantile)['Quantile']
+    nA_Exact = np.quantile(d_Scen['StockRet'], l_quantile, axis = 0)
+    nA_Std = d_Scen['StockRet'].std(axis = 0)
+    assert np.abs(nA_Quantile - nA_Exact).max() < 0.01 * nA_Std.min()
+    # Away from 0, within 1% (relative)
+    b_Far = np.abs(nA_Exact) > nA_Std / 4
+    assert (np.abs(nA_Quantile - nA_Exact)[b_Far] / np.abs(nA_Exact)[b_Far]).max() < 0.01
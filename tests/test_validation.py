@@ -0,0 +1,31 @@
+# -*- coding: utf-8 -*-
+"""
+Scenarios tested against the model (ESGenerator.validate)
+"""
+
+import pytest
+
+import libpw.esglib as esglib
+from libpw.esgengine import ESGenerator
+
+from conftest import get_test_parameters
+
+
+def test_validate_sobol():
+    # Quasi Monte Carlo over 65 years of monthly output steps (Sobol on the coarse bridge levels)
+    pytest.importorskip('scipy')
+    esg = ESGenerator(get_test_parameters(), i_num_sim = 2048, variance_reduction = 'sobol', rate_model = 'CIR')
+    dF_Summary = esglib.summarize_validation(esg.validate())
+    assert dF_Summary['Pass'].all(), dF_Summary
+
+
+@pytest.mark.parametrize('stepping', ['calc', 'exact'])
+@pytest.mark.parametrize('variance_reduction', [None, 'antithetic', 'moment', 'sobol'])
+def test_validate(variance_reduction, stepping):
+    # Every variance reduction: the scenarios pass the model tests
+    if variance_reduction == 'sobol':
+        pytest.importorskip('scipy')
+    esg = ESGenerator(get_test_parameters(), i_num_sim = 2048, variance_reduction = variance_reduction,
+                      stepping = stepping, rate_model = 'CIR')
+    dF_Summary = esglib.summarize_validation(esg.validate())
+    assert dF_Summary['Pass'].all(), dF_Summary